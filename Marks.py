@@ -1,38 +1,96 @@
-#!/usr/bin/env python3
-"""
-Marks E-Daybook - Telegram Bot for School Grade Management
-"""
-
-import os
-import sys
-
-# Add current directory to path for imports
-sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
-
-import backend
-
-def main():
-    """Main entry point for the Marks E-Daybook bot."""
-    print("Starting Marks E-Daybook...")
-
-    # Check if token is set
-    if not os.getenv("TELEGRAM_TOKEN"):
-        print("Error: TELEGRAM_TOKEN environment variable not set!")
-        print("Please set your Telegram bot token:")
-        print("export TELEGRAM_TOKEN='your_bot_token_here'")
-        return
-
-    # The bot polling is handled in backend.py when run as main
-    if backend.bot:
-        print("Bot is running. Press Ctrl+C to stop.")
-        try:
-            backend.bot.polling(none_stop=True)
-        except KeyboardInterrupt:
-            print("\nBot stopped by user.")
-        except Exception as e:
-            print(f"Error running bot: {e}")
-    else:
-        print("Failed to initialize bot. Check your token and dependencies.")
-
-if __name__ == "__main__":
+#!/usr/bin/env python3
+"""
+Marks E-Daybook - Telegram Bot for School Grade Management
+"""
+
+import argparse
+import os
+import sys
+
+# Add current directory to path for imports
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import backend
+
+def run_polling(config: backend.Config):
+    """Blocking TeleBot long polling with telebot's worker thread pool."""
+    bot = backend.create_app(config)
+    if not bot:
+        print("Failed to initialize bot. Check your token and dependencies.")
+        return
+    print("Bot is running. Press Ctrl+C to stop.")
+    try:
+        bot.polling(none_stop=True)
+    finally:
+        backend.stop_workers()
+
+def run_async(config: backend.Config):
+    """AsyncTeleBot on an asyncio loop; storage work runs in a dedicated executor."""
+    import async_runtime
+    print("Bot is running (asyncio). Press Ctrl+C to stop.")
+    async_runtime.run(config)
+
+def run_webhook(config: backend.Config):
+    """Built-in HTTP server receiving updates pushed by Telegram."""
+    import threading
+    import webhook
+    # Handle each update on its request thread, so MARKS_WEBHOOK_MAX_IN_FLIGHT bounds handler work
+    bot = backend.create_app(config, threaded=config.dispatch_shards > 0)
+    if not bot:
+        print("Failed to initialize bot. Check your token and dependencies.")
+        return
+    server = webhook.serve(bot, config)
+    print(f"Webhook listening on {config.webhook_host}:{config.webhook_port}{config.webhook_path}. "
+          "Press Ctrl+C to stop.")
+    try:
+        threading.Event().wait()
+    finally:
+        server.shutdown()
+        backend.stop_workers()
+
+def run_workers(config: backend.Config):
+    """Supervisor process polling for several handler processes, sharded by chat id."""
+    import supervisor
+    print("Bot is running (worker processes). Press Ctrl+C to stop.")
+    supervisor.run(config)
+
+RUNTIMES = {
+    "polling": run_polling,
+    "async": run_async,
+    "webhook": run_webhook,
+    "workers": run_workers,
+}
+
+def main():
+    """Main entry point for the Marks E-Daybook bot."""
+    # Loads .env first, so MARKS_RUNTIME can come from there too
+    config = backend.Config.from_env()
+    parser = argparse.ArgumentParser(description="Marks E-Daybook Telegram bot")
+    parser.add_argument("--mode", choices=sorted(RUNTIMES), default=config.runtime,
+                        help="runtime to serve updates with (default: $MARKS_RUNTIME or polling)")
+    args = parser.parse_args()
+    # argparse does not check a default against choices
+    if args.mode not in RUNTIMES:
+        parser.error(f"MARKS_RUNTIME must be one of {', '.join(sorted(RUNTIMES))}, not {args.mode!r}")
+
+    print("Starting Marks E-Daybook...")
+
+    # Check if token is set
+    if not config.token:
+        print("Error: TELEGRAM_TOKEN environment variable not set!")
+        print("Please set your Telegram bot token:")
+        print("export TELEGRAM_TOKEN='your_bot_token_here'")
+        return
+
+    try:
+        RUNTIMES[args.mode](config)
+    except KeyboardInterrupt:
+        print("\nBot stopped by user.")
+    except Exception as e:
+        print(f"Error running bot: {e}")
+    finally:
+        # Drain queued log lines before the process exits
+        backend.log_writer.close()
+
+if __name__ == "__main__":
     main()
\ No newline at end of file
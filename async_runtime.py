@@ -0,0 +1,104 @@
+"""asyncio runtime for the bot, built on telebot's AsyncTeleBot.
+
+The handlers in ``backend.register_handlers`` are written against the blocking
+TeleBot API and the blocking sqlite3 model layer. Rather than keeping a second
+copy of them, ``SyncBridge`` registers each one on an AsyncTeleBot as a
+coroutine that runs the handler in a dedicated storage executor, so database
+work never blocks the event loop. Bot API calls made from inside a handler are
+scheduled back onto the loop and awaited there (aiohttp), so waiting for
+Telegram does not hold a storage thread any longer than the reply takes.
+"""
+
+import asyncio
+import functools
+import inspect
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import backend
+
+
+class SyncBridge(object):
+    """Presents an AsyncTeleBot through the synchronous TeleBot interface."""
+
+    def __init__(self, async_bot, loop: asyncio.AbstractEventLoop, executor: ThreadPoolExecutor):
+        self.async_bot = async_bot
+        self.loop = loop
+        self.executor = executor
+
+    def _wrap_handler(self, handler):
+        @functools.wraps(handler)
+        async def run_in_executor(update):
+            await self.loop.run_in_executor(self.executor, handler, update)
+        return run_in_executor
+
+    def message_handler(self, *args, **kwargs):
+        def decorator(handler):
+            self.async_bot.message_handler(*args, **kwargs)(self._wrap_handler(handler))
+            return handler
+        return decorator
+
+    def callback_query_handler(self, *args, **kwargs):
+        def decorator(handler):
+            self.async_bot.callback_query_handler(*args, **kwargs)(self._wrap_handler(handler))
+            return handler
+        return decorator
+
+    def __getattr__(self, name):
+        attr = getattr(self.async_bot, name)
+        if not inspect.iscoroutinefunction(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def call_on_loop(*args, **kwargs):
+            # Called from a storage thread: run the API call on the loop and wait for it
+            return asyncio.run_coroutine_threadsafe(attr(*args, **kwargs), self.loop).result()
+        return call_on_loop
+
+
+def create_async_app(config: backend.Config, loop: asyncio.AbstractEventLoop,
+                     executor: ThreadPoolExecutor) -> Optional[SyncBridge]:
+    """Async counterpart of ``backend.create_app``; returns the bridge wrapping the AsyncTeleBot."""
+    backend.init_storage(config)
+    if not config.token:
+        return None
+    try:
+        from telebot.async_telebot import AsyncTeleBot
+    except ImportError:
+        backend.log("AsyncTeleBot requires pyTelegramBotAPI with aiohttp; async runtime disabled")
+        return None
+    if config.api_url:
+        from telebot import asyncio_helper
+        asyncio_helper.API_URL = backend.api_url_template(config.api_url)
+    bridge = SyncBridge(AsyncTeleBot(config.token), loop, executor)
+    backend.bot = bridge
+    # Replies are then sent from the outbox threads instead of blocking a storage thread
+    backend.outbox = backend.attach_outbox(bridge, config)
+    backend.metrics = backend.attach_metrics(bridge, config)
+    backend.exporter = backend.create_exporter(config)
+    backend.importer = backend.create_importer(config)
+    backend.register_handlers(bridge, config.admin_ids)
+    return bridge
+
+
+async def serve(config: backend.Config, storage_workers: int = 0):
+    """Poll Telegram on the running loop until cancelled."""
+    workers = storage_workers or int(os.getenv("MARKS_STORAGE_WORKERS", 4))
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="storage")
+    loop = asyncio.get_running_loop()
+    bridge = create_async_app(config, loop, executor)
+    if bridge is None:
+        executor.shutdown()
+        raise RuntimeError("Failed to initialize async bot. Check your token and dependencies.")
+    try:
+        await bridge.async_bot.infinity_polling()
+    finally:
+        # Exports and queued replies wait on this loop, so drain them off it
+        await loop.run_in_executor(None, backend.stop_workers)
+        await bridge.async_bot.close_session()
+        executor.shutdown(wait=True)
+
+
+def run(config: backend.Config, storage_workers: int = 0):
+    asyncio.run(serve(config, storage_workers))
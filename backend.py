@@ -1,615 +1,1810 @@
-"""Backend utilities for marks project."""
-
-import os
-from dotenv import load_dotenv
-import sqlite3 as sql
-import uuid
-import random as rnd
-from datetime import datetime, date
-from typing import List, Optional
-
-try:
-    import telebot as tb
-    from telebot import types
-except ImportError:
-    tb = None
-    types = None
-
-
-# Load environment variables from .env file if present
-load_dotenv()
-
-# Filenames definitions
-DBASE = "db.db"
-LOGFILE = "logs.txt"
-
-def log(text: str):
-    try:
-        with open(LOGFILE, "a", encoding="utf-8") as f:
-            f.write(f"[{datetime.now()}] {text}\n")
-    except Exception as e:
-        print("Error writing logs: ", e)
-
-# Bot init (read token from environment for safety)
-_TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
-if tb is not None and _TELEGRAM_TOKEN:
-    bot = tb.TeleBot(token=_TELEGRAM_TOKEN)
-else:
-    bot = None
-
-def init_database():
-    """Initialize database tables if they don't exist."""
-    conn = sql.connect(DBASE)
-    cursor = conn.cursor()
-
-    # Users table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id TEXT PRIMARY KEY,
-            telegram_id INTEGER UNIQUE,
-            name TEXT
-        )
-    ''')
-
-    # Subjects table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS subjects (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            name TEXT,
-            FOREIGN KEY (user_id) REFERENCES users (telegram_id)
-        )
-    ''')
-
-    # Schedule table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS schedule (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            weekday INTEGER,
-            lesson_number INTEGER,
-            subject_id INTEGER,
-            FOREIGN KEY (user_id) REFERENCES users (telegram_id),
-            FOREIGN KEY (subject_id) REFERENCES subjects (id)
-        )
-    ''')
-
-    # Terms table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS terms (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            name TEXT,
-            start_date DATE,
-            end_date DATE,
-            FOREIGN KEY (user_id) REFERENCES users (telegram_id)
-        )
-    ''')
-
-    # Grades table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS grades (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            subject_id INTEGER,
-            value INTEGER,
-            grade_type TEXT,
-            date DATE,
-            term_id INTEGER,
-            confirmed INTEGER DEFAULT 0,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (telegram_id),
-            FOREIGN KEY (subject_id) REFERENCES subjects (id),
-            FOREIGN KEY (term_id) REFERENCES terms (id)
-        )
-    ''')
-
-    conn.commit()
-    conn.close()
-
-# Initialize database on import
-init_database()
-
-# CONFIRMATION CODE SENDING FUNC BEGIN
-def send_code(chat_id: Optional[int]):
-    if chat_id is None:
-        log("Chat ID cannot be None.")
-        return None
-    code = rnd.randint(100000, 999999)
-    text = f"Your confirmation code for #ThDev Marks is {code}."
-    if bot:
-        bot.send_message(chat_id=chat_id, text=text)
-    else:
-        log(f"[send_code] Would send to {chat_id}: {text}")
-    return code
-# CONFIRMATION CODE SENDING FUNC END
-
-class User(object):
-    def __init__(self, tg_id: Optional[int], name: str = "", id_: str = ""):
-
-        self.id_ = id_ or str(uuid.uuid4())  # Ensure id_ is generated if None
-        self.tgID = tg_id
-        self.name = name
-
-    def sign_up(self):
-        if not self.id_:
-            self.id_ = str(uuid.uuid4())
-        conn = sql.connect(DBASE)
-        cursor = conn.cursor()
-        try:
-            cursor.execute(
-                "INSERT INTO users (id, telegram_id, name) VALUES (?, ?, ?);",
-                (self.id_, self.tgID, self.name)
-            )
-            conn.commit()
-            log(f"User {self.name} ({self.tgID}) signed up")
-        except sql.IntegrityError:
-            log(f"User {self.tgID} already exists")
-        finally:
-            conn.close()
-
-    @staticmethod
-    def get_user_by_telegram_id(tg_id: int) -> Optional['User']:
-        conn = sql.connect(DBASE)
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, telegram_id, name FROM users WHERE telegram_id = ?", (tg_id,))
-        row = cursor.fetchone()
-        conn.close()
-        if row:
-            return User(tg_id=row[1], name=row[2], id_=row[0])
-        return None
-
-class Subject:
-    def __init__(self, id_: Optional[int] = None, user_id: Optional[int] = None, name: str = ""):
-        self.id = id_
-        self.user_id = user_id
-        self.name = name
-
-    def save(self):
-        if self.user_id is None:
-            log("User ID cannot be None when saving a subject.")
-            return
-        conn = sql.connect(DBASE)
-        cursor = conn.cursor()
-        if self.id:
-            cursor.execute(
-                "UPDATE subjects SET name = ? WHERE id = ? AND user_id = ?",
-                (self.name, self.id, self.user_id)
-            )
-        else:
-            cursor.execute(
-                "INSERT INTO subjects (user_id, name) VALUES (?, ?)",
-                (self.user_id, self.name)
-            )
-            self.id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-
-    @staticmethod
-    def get_subjects_by_user(user_id: int) -> List['Subject']:
-        conn = sql.connect(DBASE)
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, user_id, name FROM subjects WHERE user_id = ?", (user_id,))
-        rows = cursor.fetchall()
-        conn.close()
-        return [Subject(id_=row[0], user_id=row[1], name=row[2]) for row in rows]
-
-    
-    @staticmethod
-    def get_subject_by_id(subject_id: int, user_id: int) -> Optional['Subject']:
-        conn = sql.connect(DBASE)
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, user_id, name FROM subjects WHERE id = ? AND user_id = ?", (subject_id, user_id))
-        row = cursor.fetchone()
-        conn.close()
-        if row:
-            return Subject(id_=row[0], user_id=row[1], name=row[2])
-        return None
-
-class Grade:
-    def __init__(self, id_: Optional[int] = None, user_id: Optional[int] = None, subject_id: Optional[int] = None,
-                 value: Optional[int] = None, grade_type: str = "", date_: Optional[date] = None,
-                 term_id: Optional[int] = None, confirmed: bool = False):
-        self.id = id_
-        self.user_id = user_id
-        self.subject_id = subject_id
-        self.value = value
-        self.grade_type = grade_type
-        self.date = date_
-        self.term_id = term_id
-        self.confirmed = confirmed
-
-    def save(self):
-        conn = sql.connect(DBASE)
-        cursor = conn.cursor()
-        if self.id:
-            cursor.execute("""
-                UPDATE grades SET subject_id = ?, value = ?, grade_type = ?,
-                date = ?, term_id = ?, confirmed = ? WHERE id = ? AND user_id = ?
-            """, (self.subject_id, self.value, self.grade_type, self.date,
-                  self.term_id, self.confirmed, self.id, self.user_id))
-        else:
-            cursor.execute("""
-                INSERT INTO grades (user_id, subject_id, value, grade_type, date, term_id, confirmed)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            """, (self.user_id, self.subject_id, self.value, self.grade_type,
-                  self.date, self.term_id, self.confirmed))
-            self.id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-
-    @staticmethod
-    def get_grades_by_user(user_id: int, subject_id: Optional[int] = None, term_id: Optional[int] = None) -> List['Grade']:
-        conn = sql.connect(DBASE)
-        cursor = conn.cursor()
-        query = "SELECT id, user_id, subject_id, value, grade_type, date, term_id, confirmed FROM grades WHERE user_id = ?"
-        params = [user_id]
-
-        if subject_id:
-            query += " AND subject_id = ?"
-            params.append(subject_id)
-        if term_id:
-            query += " AND term_id = ?"
-            params.append(term_id)
-
-        query += " ORDER BY date DESC"
-        cursor.execute(query, params)
-        rows = cursor.fetchall()
-        conn.close()
-        return [Grade(id_=row[0], user_id=row[1], subject_id=row[2], value=row[3],
-                     grade_type=row[4], date_=row[5], term_id=row[6], confirmed=row[7]) for row in rows]
-
-class Term:
-    def __init__(self, id_: Optional[int] = None, user_id: Optional[int] = None, name: str = "",
-                 start_date: Optional[date] = None, end_date: Optional[date] = None):
-        self.id = id_
-        self.user_id = user_id
-        self.name = name
-        self.start_date = start_date
-        self.end_date = end_date
-
-    def save(self):
-        conn = sql.connect(DBASE)
-        cursor = conn.cursor()
-        if self.id:
-            cursor.execute(
-                "UPDATE terms SET name = ?, start_date = ?, end_date = ? WHERE id = ? AND user_id = ?",
-                (self.name, self.start_date, self.end_date, self.id, self.user_id)
-            )
-        else:
-            cursor.execute(
-                "INSERT INTO terms (user_id, name, start_date, end_date) VALUES (?, ?, ?, ?)",
-                (self.user_id, self.name, self.start_date, self.end_date)
-            )
-            self.id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-
-    @staticmethod
-    def get_terms_by_user(user_id: int) -> List['Term']:
-        conn = sql.connect(DBASE)
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, user_id, name, start_date, end_date FROM terms WHERE user_id = ? ORDER BY start_date DESC", (user_id,))
-        rows = cursor.fetchall()
-        conn.close()
-        return [Term(id_=row[0], user_id=row[1], name=row[2], start_date=row[3], end_date=row[4]) for row in rows]
-
-    @staticmethod
-    def get_current_term(user_id: int) -> Optional['Term']:
-        today = date.today()
-        conn = sql.connect(DBASE)
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT id, user_id, name, start_date, end_date FROM terms WHERE user_id = ? AND start_date <= ? AND end_date >= ?",
-            (user_id, today, today)
-        )
-        row = cursor.fetchone()
-        conn.close()
-        if row:
-            return Term(id_=row[0], user_id=row[1], name=row[2], start_date=row[3], end_date=row[4])
-        return None
-
-
-# Bot handlers
-from typing import Dict, Any
-user_states: Dict[int, Dict[str, Any]] = {}  # Store user states for conversation flow
-
-if bot:
-
-    from telebot.types import Message, CallbackQuery
-
-    # type: ignore is used to suppress type checker errors for dynamic decorators
-    @bot.message_handler(commands=['start'])  # type: ignore[attr-defined]
-    def handle_start(message: Message) -> None:
-        if not hasattr(message, 'chat') or not hasattr(message.chat, 'id'):
-            return
-        user = User.get_user_by_telegram_id(message.chat.id)
-        first_name = getattr(getattr(message, 'from_user', None), 'first_name', None)
-        if not user:
-            user = User(tg_id=message.chat.id, name=first_name or "Unknown")
-            user.sign_up()
-            if bot:
-                bot.reply_to(message, f"Welcome to Marks E-Daybook, {user.name}!\n\nUse /help to see available commands.")
-        else:
-            if bot:
-                bot.reply_to(message, f"Welcome back, {user.name}!\n\nUse /help to see available commands.")
-
-    @bot.message_handler(commands=['help'])  # type: ignore[attr-defined]
-    def handle_help(message: Message) -> None:
-        help_text = """<b>📚 Marks E-Daybook Commands:</b>
-
-<b>📝 Subject Management:</b>
-/add_subject - Add a new subject
-/list_subjects - List all your subjects
-
-<b>📊 Grade Management:</b>
-/add_grade - Add a new grade
-/view_grades - View your grades
-/average - Calculate average grades
-
-<b>📅 Terms:</b>
-/add_term - Add a new academic term
-/list_terms - List all terms
-
-<b>❓ Other:</b>
-/help - Show this help message
-/cancel - Cancel current operation
-"""
-        if bot and hasattr(message, 'chat') and hasattr(message.chat, 'id'):
-            bot.send_message(message.chat.id, help_text, parse_mode='HTML')
-
-    @bot.message_handler(commands=['add_subject'])  # type: ignore[attr-defined]
-    def handle_add_subject(message: Message) -> None:
-        if not hasattr(message, 'chat') or not hasattr(message.chat, 'id'):
-            return
-        user_states[message.chat.id] = {'state': 'waiting_subject_name'}
-        if bot:
-            bot.reply_to(message, "Please enter the name of the subject:")
-
-    @bot.message_handler(commands=['list_subjects'])  # type: ignore[attr-defined]
-    def handle_list_subjects(message: Message) -> None:
-        if not hasattr(message, 'chat') or not hasattr(message.chat, 'id'):
-            return
-        subjects = Subject.get_subjects_by_user(message.chat.id)
-        if not subjects:
-            if bot:
-                bot.reply_to(message, "You don't have any subjects yet. Use /add_subject to add one.")
-            return
-
-        text = "📚 Your Subjects:\n\n"
-        for i, subject in enumerate(subjects, 1):
-            text += f"{i}. {subject.name}\n"
-        if bot:
-            bot.send_message(message.chat.id, text)
-
-    @bot.message_handler(commands=['add_term'])  # type: ignore[attr-defined]
-    def handle_add_term(message: Message) -> None:
-        if not hasattr(message, 'chat') or not hasattr(message.chat, 'id'):
-            return
-        user_states[message.chat.id] = {'state': 'waiting_term_name'}
-        if bot:
-            bot.reply_to(message, "Please enter the name of the term (e.g., 'Fall 2023'):")
-
-    @bot.message_handler(commands=['list_terms'])  # type: ignore[attr-defined]
-    def handle_list_terms(message: Message) -> None:
-        if not hasattr(message, 'chat') or not hasattr(message.chat, 'id'):
-            return
-        terms = Term.get_terms_by_user(message.chat.id)
-        if not terms:
-            if bot:
-                bot.reply_to(message, "You don't have any terms yet. Use /add_term to add one.")
-            return
-
-        text = "📅 Your Terms:\n\n"
-        for term in terms:
-            text += f"• {term.name}: {term.start_date} - {term.end_date}\n"
-        if bot:
-            bot.send_message(message.chat.id, text)
-
-    @bot.message_handler(commands=['add_grade'])  # type: ignore[attr-defined]
-    def handle_add_grade(message: Message) -> None:
-        if not hasattr(message, 'chat') or not hasattr(message.chat, 'id'):
-            return
-        subjects = Subject.get_subjects_by_user(message.chat.id)
-        if not subjects:
-            if bot:
-                bot.reply_to(message, "You need to add subjects first. Use /add_subject.")
-            return
-        if types is None:
-            return
-        markup = types.InlineKeyboardMarkup()
-        for subject in subjects:
-            markup.add(types.InlineKeyboardButton(subject.name, callback_data=f"grade_subject_{subject.id}"))
-        if bot:
-            bot.send_message(message.chat.id, "Select a subject for the grade:", reply_markup=markup)
-
-    @bot.callback_query_handler(func=lambda call: hasattr(call, 'data') and isinstance(call.data, str) and call.data.startswith('grade_subject_'))  # type: ignore[attr-defined]
-    def handle_grade_subject_selection(call: CallbackQuery) -> None:
-        if not hasattr(call, 'data') or not hasattr(call, 'message') or not hasattr(call.message, 'chat') or not hasattr(call.message.chat, 'id'):
-            return
-        subject_id = int(call.data.split('_')[2])
-        user_states[call.message.chat.id] = {'state': 'waiting_grade_value', 'subject_id': subject_id}
-        if bot:
-            bot.edit_message_text("Enter the grade value (1-12):", call.message.chat.id, call.message.message_id)
-
-    @bot.message_handler(commands=['view_grades'])  # type: ignore[attr-defined]
-    def handle_view_grades(message: Message) -> None:
-        if not hasattr(message, 'chat') or not hasattr(message.chat, 'id'):
-            return
-        subjects = Subject.get_subjects_by_user(message.chat.id)
-        if not subjects:
-            if bot:
-                bot.reply_to(message, "You don't have any subjects yet.")
-            return
-        if types is None:
-            return
-        markup = types.InlineKeyboardMarkup()
-        for subject in subjects:
-            markup.add(types.InlineKeyboardButton(subject.name, callback_data=f"view_grades_{subject.id}"))
-        markup.add(types.InlineKeyboardButton("All Subjects", callback_data="view_grades_all"))
-        if bot:
-            bot.send_message(message.chat.id, "Select a subject to view grades:", reply_markup=markup)
-
-    @bot.callback_query_handler(func=lambda call: hasattr(call, 'data') and isinstance(call.data, str) and call.data.startswith('view_grades_'))  # type: ignore[attr-defined]
-    def handle_view_grades_selection(call: CallbackQuery) -> None:
-        if not hasattr(call, 'data') or not hasattr(call, 'message') or not hasattr(call.message, 'chat') or not hasattr(call.message.chat, 'id'):
-            return
-        if call.data == 'view_grades_all':
-            grades = Grade.get_grades_by_user(call.message.chat.id)
-            subject_name = "All Subjects"
-        else:
-            subject_id = int(call.data.split('_')[2])
-            grades = Grade.get_grades_by_user(call.message.chat.id, subject_id=subject_id)
-            subject = Subject.get_subject_by_id(subject_id, call.message.chat.id)
-            subject_name = subject.name if subject else "Unknown"
-
-        if not grades:
-            if bot:
-                bot.edit_message_text(f"No grades found for {subject_name}.", call.message.chat.id, call.message.message_id)
-            return
-
-        text = f"📊 Grades for {subject_name}:\n\n"
-        for grade in grades[:20]:  # Limit to 20 most recent
-            if grade.subject_id is not None:
-                subject = Subject.get_subject_by_id(grade.subject_id, call.message.chat.id)
-                subject_name = subject.name if subject else "Unknown"
-            else:
-                subject_name = "Unknown"
-            text += f"• {subject_name}: {grade.value} ({grade.grade_type}) - {grade.date}\n"
-
-        if len(grades) > 20:
-            text += f"\n... and {len(grades) - 20} more grades"
-
-        if bot:
-            bot.edit_message_text(text, call.message.chat.id, call.message.message_id)
-
-    @bot.message_handler(commands=['average'])  # type: ignore[attr-defined]
-    def handle_average(message: Message) -> None:
-        if not hasattr(message, 'chat') or not hasattr(message.chat, 'id'):
-            return
-        subjects = Subject.get_subjects_by_user(message.chat.id)
-        if not subjects:
-            if bot:
-                bot.reply_to(message, "You don't have any subjects yet.")
-            return
-
-        text = "📈 Average Grades:\n\n"
-        for subject in subjects:
-            grades = Grade.get_grades_by_user(message.chat.id, subject_id=subject.id)
-            if grades:
-                values = [grade.value for grade in grades if grade.value is not None]
-                if values:
-                    avg = sum(values) / len(values)
-                    text += f"• {subject.name}: {avg:.2f} (from {len(values)} grades)\n"
-                else:
-                    text += f"• {subject.name}: No grades yet\n"
-            else:
-                text += f"• {subject.name}: No grades yet\n"
-
-        if bot:
-            bot.send_message(message.chat.id, text)
-
-    @bot.message_handler(commands=['cancel'])  # type: ignore[attr-defined]
-    def handle_cancel(message: Message) -> None:
-        if not hasattr(message, 'chat') or not hasattr(message.chat, 'id'):
-            return
-        if message.chat.id in user_states:
-            del user_states[message.chat.id]
-        if bot:
-            bot.reply_to(message, "Operation cancelled.")
-
-    @bot.message_handler(func=lambda message: hasattr(message, 'chat') and hasattr(message.chat, 'id') and message.chat.id in user_states)  # type: ignore[attr-defined]
-    def handle_user_input(message: Message) -> None:
-        if not hasattr(message, 'chat') or not hasattr(message.chat, 'id'):
-            return
-        state = user_states[message.chat.id]['state']
-
-        if state == 'waiting_subject_name':
-            name = getattr(message, 'text', None)
-            if not name:
-                return
-            subject = Subject(user_id=message.chat.id, name=name.strip())
-            subject.save()
-            del user_states[message.chat.id]
-            if bot:
-                bot.reply_to(message, f"Subject '{subject.name}' added successfully!")
-
-        elif state == 'waiting_term_name':
-            term_name = getattr(message, 'text', None)
-            if not term_name:
-                return
-            user_states[message.chat.id]['term_name'] = term_name.strip()
-            user_states[message.chat.id]['state'] = 'waiting_term_start'
-            if bot:
-                bot.reply_to(message, "Enter start date (YYYY-MM-DD):")
-
-        elif state == 'waiting_term_start':
-            text = getattr(message, 'text', None)
-            if not text:
-                return
-            try:
-                start_date = date.fromisoformat(text.strip())
-                user_states[message.chat.id]['start_date'] = start_date
-                user_states[message.chat.id]['state'] = 'waiting_term_end'
-                if bot:
-                    bot.reply_to(message, "Enter end date (YYYY-MM-DD):")
-            except ValueError:
-                if bot:
-                    bot.reply_to(message, "Invalid date format. Please use YYYY-MM-DD:")
-
-        elif state == 'waiting_term_end':
-            text = getattr(message, 'text', None)
-            if not text:
-                return
-            try:
-                end_date = date.fromisoformat(text.strip())
-                term = Term(
-                    user_id=message.chat.id,
-                    name=user_states[message.chat.id]['term_name'],
-                    start_date=user_states[message.chat.id]['start_date'],
-                    end_date=end_date
-                )
-                term.save()
-                del user_states[message.chat.id]
-                if bot:
-                    bot.reply_to(message, f"Term '{term.name}' added successfully!")
-            except ValueError:
-                if bot:
-                    bot.reply_to(message, "Invalid date format. Please use YYYY-MM-DD:")
-
-        elif state == 'waiting_grade_value':
-            text = getattr(message, 'text', None)
-            if not text:
-                return
-            try:
-                value = int(text.strip())
-                if not 1 <= value <= 12:
-                    raise ValueError
-                subject_id = user_states[message.chat.id]['subject_id']
-                grade = Grade(
-                    user_id=message.chat.id,
-                    subject_id=subject_id,
-                    value=value,
-                    grade_type="regular",
-                    date_=date.today()
-                )
-                # Get current term
-                current_term = Term.get_current_term(message.chat.id)
-                if current_term:
-                    grade.term_id = current_term.id
-                grade.save()
-                del user_states[message.chat.id]
-                subject = Subject.get_subject_by_id(subject_id, message.chat.id)
-                if bot:
-                    bot.reply_to(message, f"Grade {value} added for {subject.name if subject else 'subject'}!")
-            except ValueError:
-                if bot:
-                    bot.reply_to(message, "Please enter a valid grade (1-12):")
-
-# Main bot polling
-if __name__ == "__main__":
-    if bot:
-        log("Bot started")
-        bot.polling(none_stop=True)
-    else:
+"""Backend utilities for marks project."""
+
+import atexit
+import bisect
+import os
+import sqlite3 as sql
+import threading
+import time
+import uuid
+import random as rnd
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, date
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+from logwriter import LogWriter
+from state_store import MemoryStateStore, SqliteStateStore, StateStore
+
+# Importing this module has no side effects: nothing touches the database,
+# the log file or Telegram until create_app() (or init_storage()) is called.
+
+# Filenames definitions
+DBASE = "db.db"
+LOGFILE = "logs.txt"
+
+log_writer = LogWriter(LOGFILE)
+atexit.register(log_writer.close)
+
+def log(text: str):
+    log_writer.write(f"[{datetime.now()}] {text}\n")
+
+# Set by create_app(); None until the bot has been built
+bot = None
+# Set by create_app() when updates are sharded by chat (Config.dispatch_shards)
+dispatcher = None
+# Set by create_app() when replies go through the rate-limited send queue (Config.outbox_workers)
+outbox = None
+# Set by create_app(): per-handler latency and SQL histograms (metrics.HandlerMetrics)
+metrics = None
+# Set by create_app(): builds /export documents off the handler threads (export.Exporter)
+exporter = None
+# Set by create_app(): imports uploaded grade files off the handler threads (importer.Importer)
+importer = None
+
+# DATABASE CONNECTION MANAGER BEGIN
+class StorageProfile(object):
+    """SQLite PRAGMA settings applied to every connection the bot opens.
+
+    The defaults favour concurrent handlers: WAL lets readers proceed while
+    a grade is being written, and ``busy_timeout`` makes writers wait for the
+    lock instead of failing with "database is locked".
+    """
+
+    JOURNAL_MODES = ("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF")
+    SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL", "EXTRA")
+    TEMP_STORES = ("DEFAULT", "FILE", "MEMORY")
+
+    def __init__(self, journal_mode: str = "WAL", synchronous: str = "NORMAL",
+                 mmap_size: int = 256 * 1024 * 1024, cache_size: int = -16000,
+                 temp_store: str = "MEMORY", busy_timeout: int = 5000):
+        self.journal_mode = self._choice(journal_mode, self.JOURNAL_MODES, "journal_mode")
+        self.synchronous = self._choice(synchronous, self.SYNCHRONOUS_MODES, "synchronous")
+        self.mmap_size = int(mmap_size)
+        self.cache_size = int(cache_size)  # negative values are KiB, positive are pages
+        self.temp_store = self._choice(temp_store, self.TEMP_STORES, "temp_store")
+        self.busy_timeout = int(busy_timeout)  # milliseconds
+
+    @staticmethod
+    def _choice(value: str, allowed: tuple, name: str) -> str:
+        value = str(value).upper()
+        if value not in allowed:
+            raise ValueError(f"Invalid {name} {value!r}, expected one of {', '.join(allowed)}")
+        return value
+
+    @classmethod
+    def from_env(cls) -> 'StorageProfile':
+        """Build a profile from ``MARKS_DB_*`` environment variables."""
+        default = cls()
+        return cls(
+            journal_mode=os.getenv("MARKS_DB_JOURNAL_MODE", default.journal_mode),
+            synchronous=os.getenv("MARKS_DB_SYNCHRONOUS", default.synchronous),
+            mmap_size=int(os.getenv("MARKS_DB_MMAP_SIZE", default.mmap_size)),
+            cache_size=int(os.getenv("MARKS_DB_CACHE_SIZE", default.cache_size)),
+            temp_store=os.getenv("MARKS_DB_TEMP_STORE", default.temp_store),
+            busy_timeout=int(os.getenv("MARKS_DB_BUSY_TIMEOUT", default.busy_timeout)),
+        )
+
+    def apply(self, conn: sql.Connection, read_only: bool = False):
+        # busy_timeout first so switching the journal mode can wait for other writers
+        conn.execute(f"PRAGMA busy_timeout = {self.busy_timeout}")
+        if read_only:
+            # The journal mode is the writers' to set; this connection must never write
+            conn.execute("PRAGMA query_only = 1")
+        else:
+            conn.execute(f"PRAGMA journal_mode = {self.journal_mode}")
+            conn.execute(f"PRAGMA synchronous = {self.synchronous}")
+        conn.execute(f"PRAGMA mmap_size = {self.mmap_size}")
+        conn.execute(f"PRAGMA cache_size = {self.cache_size}")
+        conn.execute(f"PRAGMA temp_store = {self.temp_store}")
+
+class Database(object):
+    """Hands out one reusable SQLite connection per thread.
+
+    Connections are opened lazily on first use and kept for the lifetime of
+    the thread, so the sqlite3 statement cache is reused across calls.
+    Writes go through ``transaction()``; reads can use ``fetchone()`` and
+    ``fetchall()`` directly (the connection runs in autocommit mode).
+
+    Model code reaches it through ``shard(user_id)`` and admin code through
+    ``fan_out()``, so ``sharding.ShardedDatabase`` can stand in for it.
+    Reporting queries go through ``reader()`` instead.
+    """
+
+    def __init__(self, path: str, profile: Optional[StorageProfile] = None, cached_statements: int = 256,
+                 id_base: int = 0):
+        self.path = path
+        self.profile = profile or StorageProfile()
+        self.cached_statements = cached_statements
+        # Lowest AUTOINCREMENT id handed out here; shards use disjoint ranges, see reserve_id_range()
+        self.id_base = id_base
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections: Dict[int, sql.Connection] = {}
+        self._reader: Optional[ReadOnlyDatabase] = None
+        # Optional object with statement(text) and rows(count) methods, see set_observer()
+        self.observer = None
+
+    def _connect(self) -> sql.Connection:
+        conn = sql.connect(
+            self.path,
+            timeout=self.profile.busy_timeout / 1000.0,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+        )
+        self.profile.apply(conn)
+        if self.observer is not None:
+            conn.set_trace_callback(self.observer.statement)
+        return conn
+
+    def set_observer(self, observer):
+        """Report every SQL statement and the number of rows each fetch returns to ``observer``."""
+        self.observer = observer
+        with self._lock:
+            connections = list(self._connections.values())
+            reader = self._reader
+        for conn in connections:
+            conn.set_trace_callback(observer.statement if observer is not None else None)
+        if reader is not None:
+            reader.set_observer(observer)
+
+    def connection(self) -> sql.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            self._local.depth = 0
+            with self._lock:
+                self._connections[threading.get_ident()] = conn
+        return conn
+
+    @contextmanager
+    def transaction(self) -> Iterator[sql.Cursor]:
+        """Run the block in a write transaction, committing on success.
+
+        Nested calls join the outermost transaction.
+        """
+        conn = self.connection()
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield conn.cursor()
+            finally:
+                self._local.depth -= 1
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        self._local.depth = 1
+        try:
+            yield conn.cursor()
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+        finally:
+            self._local.depth = 0
+
+    def fetchone(self, query: str, params=()) -> Optional[tuple]:
+        row = self.connection().execute(query, params).fetchone()
+        if self.observer is not None:
+            self.observer.rows(row is not None)
+        return row
+
+    def fetchall(self, query: str, params=()) -> List[tuple]:
+        rows = self.connection().execute(query, params).fetchall()
+        if self.observer is not None:
+            self.observer.rows(len(rows))
+        return rows
+
+    def iterate(self, query: str, params=(), batch: int = 500) -> Iterator[tuple]:
+        """Yield rows from an open cursor ``batch`` at a time, so large results are never held in memory."""
+        cursor = self.connection().execute(query, params)
+        try:
+            while True:
+                rows = cursor.fetchmany(batch)
+                if not rows:
+                    return
+                if self.observer is not None:
+                    self.observer.rows(len(rows))
+                yield from rows
+        finally:
+            cursor.close()
+
+    def reader(self) -> 'Database':
+        """Read-only connections to this file for reporting queries, see ``ReadOnlyDatabase``."""
+        if self.path == ":memory:":
+            return self  # another connection would see another database
+        with self._lock:
+            if self._reader is None:
+                self._reader = ReadOnlyDatabase(self.path, self.profile, self.cached_statements, self.id_base)
+                self._reader.observer = self.observer
+            return self._reader
+
+    @contextmanager
+    def snapshot(self) -> Iterator['Database']:
+        """No-op, for the ``:memory:`` database ``reader()`` returns; see ``ReadOnlyDatabase.snapshot``."""
+        yield self
+
+    def shard(self, user_id: Optional[int]) -> 'Database':
+        """The database holding ``user_id``'s rows: this one."""
+        return self
+
+    @property
+    def shards(self) -> List['Database']:
+        return [self]
+
+    def fan_out(self, fn: Callable[['Database'], Any]) -> List[Any]:
+        """``[fn(shard)]`` for every shard; here just this database."""
+        return [fn(self)]
+
+    def close(self):
+        """Close every connection handed out so far."""
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+            reader, self._reader = self._reader, None
+        if reader is not None:
+            reader.close()
+        for conn in connections:
+            try:
+                conn.close()
+            except sql.Error:
+                pass
+        self._local = threading.local()
+
+class ReadOnlyDatabase(Database):
+    """Per-thread read-only connections for reporting queries (listings, averages, exports).
+
+    They open the file through a ``mode=ro`` URI with ``query_only`` set, and
+    never share a connection or statement cache with ``Grade.save`` and the
+    other writers. In WAL mode a read never blocks a writer or makes it wait.
+    ``snapshot()`` runs several reads as one consistent view of the database.
+    Rows committed meanwhile are not seen, and writes carry on as usual.
+    A long snapshot does hold back checkpoints, so the WAL grows until it ends.
+    """
+
+    def _connect(self) -> sql.Connection:
+        conn = sql.connect(
+            f"{Path(self.path).absolute().as_uri()}?mode=ro",
+            uri=True,
+            timeout=self.profile.busy_timeout / 1000.0,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+        )
+        self.profile.apply(conn, read_only=True)
+        if self.observer is not None:
+            conn.set_trace_callback(self.observer.statement)
+        return conn
+
+    def reader(self) -> 'ReadOnlyDatabase':
+        return self
+
+    def transaction(self):
+        raise sql.OperationalError("ReadOnlyDatabase cannot write; use the Database it came from")
+
+    @contextmanager
+    def snapshot(self) -> Iterator['ReadOnlyDatabase']:
+        """Serve every read in the block from one snapshot, taken at its first read.
+
+        Nested calls share the outermost snapshot.
+        """
+        conn = self.connection()
+        if self._local.depth:
+            yield self
+            return
+        conn.execute("BEGIN")
+        self._local.depth = 1
+        try:
+            yield self
+        finally:
+            self._local.depth = 0
+            conn.execute("COMMIT")
+
+# Opens no connection until first use; init_storage() swaps in the configured one
+db = Database(DBASE)
+# DATABASE CONNECTION MANAGER END
+
+# CACHES BEGIN
+class LRUCache(object):
+    """Thread-safe LRU cache with a per-entry TTL and hit/miss counters.
+
+    At most ``maxsize`` keys are kept; entries older than ``ttl`` seconds are
+    reloaded. ``ttl <= 0`` disables expiry and ``maxsize <= 0`` disables caching.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data: 'OrderedDict[Any, Tuple[float, Any]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._epoch = 0  # bumped by every invalidation
+
+    def get(self, key, loader: Callable[[], Any]):
+        """Return the cached value for ``key``, calling ``loader()`` on a miss."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and (self.ttl <= 0 or now - entry[0] < self.ttl):
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            epoch = self._epoch
+        value = loader()
+        with self._lock:
+            # Don't cache a value that may predate an invalidation made while it was loading
+            if self.maxsize > 0 and epoch == self._epoch:
+                self._data[key] = (now, value)
+                self._data.move_to_end(key)
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+                    self.evictions += 1
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._epoch += 1
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"size": len(self._data), "maxsize": self.maxsize, "ttl": self.ttl,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+# Per-user tuple of (id, name) subject rows, see Subject.cached_for_user()
+subject_cache = LRUCache()
+# Per-user TermIndex, see Term.index_for_user()
+term_cache = LRUCache()
+# CACHES END
+
+def init_database():
+    """Bring the schema of every shard up to date (in parallel when sharded)."""
+    db.fan_out(_prepare_database)
+
+def _prepare_database(database: 'Database'):
+    migrate(database)
+    if database.id_base:
+        reserve_id_range(database)
+
+# SCHEMA MIGRATIONS BEGIN
+def _create_tables(cursor: sql.Cursor):
+    # Users table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id TEXT PRIMARY KEY,
+            telegram_id INTEGER UNIQUE,
+            name TEXT
+        )
+    ''')
+
+    # Subjects table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS subjects (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            name TEXT,
+            FOREIGN KEY (user_id) REFERENCES users (telegram_id)
+        )
+    ''')
+
+    # Schedule table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schedule (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            weekday INTEGER,
+            lesson_number INTEGER,
+            subject_id INTEGER,
+            FOREIGN KEY (user_id) REFERENCES users (telegram_id),
+            FOREIGN KEY (subject_id) REFERENCES subjects (id)
+        )
+    ''')
+
+    # Terms table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS terms (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            name TEXT,
+            start_date DATE,
+            end_date DATE,
+            FOREIGN KEY (user_id) REFERENCES users (telegram_id)
+        )
+    ''')
+
+    # Grades table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS grades (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            subject_id INTEGER,
+            value INTEGER,
+            grade_type TEXT,
+            date DATE,
+            term_id INTEGER,
+            confirmed INTEGER DEFAULT 0,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (telegram_id),
+            FOREIGN KEY (subject_id) REFERENCES subjects (id),
+            FOREIGN KEY (term_id) REFERENCES terms (id)
+        )
+    ''')
+
+def _create_indexes(cursor: sql.Cursor):
+    # Grade listings filter on user (+ subject or term) and sort by date
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_grades_user_date ON grades (user_id, date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_grades_user_subject_date ON grades (user_id, subject_id, date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_grades_user_term_date ON grades (user_id, term_id, date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_subjects_user ON subjects (user_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_terms_user_dates ON terms (user_id, start_date, end_date)")
+
+# Grades without a subject or term are counted under id 0
+_GRADE_STATS_EXPECTED = """
+    SELECT user_id, IFNULL(subject_id, 0) AS subject_id, IFNULL(term_id, 0) AS term_id,
+           COUNT(value) AS count, SUM(value) AS sum, SUM(value * value) AS sum_sq,
+           MIN(value) AS min, MAX(value) AS max
+    FROM grades WHERE value IS NOT NULL
+    GROUP BY user_id, IFNULL(subject_id, 0), IFNULL(term_id, 0)
+"""
+
+# Remove OLD's value from its aggregate; min/max are only recomputed from
+# grades when the removed value was the current extreme.
+_GRADE_STATS_REMOVE_OLD = """
+    UPDATE grade_stats SET
+        count = count - 1,
+        sum = sum - OLD.value,
+        sum_sq = sum_sq - OLD.value * OLD.value,
+        min = CASE WHEN OLD.value > min THEN min ELSE (
+            SELECT MIN(value) FROM grades WHERE user_id = OLD.user_id
+            AND subject_id IS OLD.subject_id AND term_id IS OLD.term_id) END,
+        max = CASE WHEN OLD.value < max THEN max ELSE (
+            SELECT MAX(value) FROM grades WHERE user_id = OLD.user_id
+            AND subject_id IS OLD.subject_id AND term_id IS OLD.term_id) END
+    WHERE user_id = OLD.user_id AND subject_id = IFNULL(OLD.subject_id, 0) AND term_id = IFNULL(OLD.term_id, 0)
+        AND OLD.value IS NOT NULL;
+    DELETE FROM grade_stats
+    WHERE user_id = OLD.user_id AND subject_id = IFNULL(OLD.subject_id, 0) AND term_id = IFNULL(OLD.term_id, 0)
+        AND count <= 0;
+"""
+
+_GRADE_STATS_ADD_NEW = """
+    INSERT INTO grade_stats (user_id, subject_id, term_id, count, sum, sum_sq, min, max)
+    SELECT NEW.user_id, IFNULL(NEW.subject_id, 0), IFNULL(NEW.term_id, 0),
+           1, NEW.value, NEW.value * NEW.value, NEW.value, NEW.value
+    WHERE NEW.value IS NOT NULL
+    ON CONFLICT (user_id, subject_id, term_id) DO UPDATE SET
+        count = count + 1,
+        sum = sum + excluded.sum,
+        sum_sq = sum_sq + excluded.sum_sq,
+        min = MIN(min, excluded.min),
+        max = MAX(max, excluded.max);
+"""
+
+def _create_grade_stats(cursor: sql.Cursor):
+    # Per user/subject/term aggregates of grade values, kept in sync by triggers
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS grade_stats (
+            user_id INTEGER NOT NULL,
+            subject_id INTEGER NOT NULL,
+            term_id INTEGER NOT NULL DEFAULT 0,
+            count INTEGER NOT NULL,
+            sum INTEGER NOT NULL,
+            sum_sq INTEGER NOT NULL,
+            min INTEGER,
+            max INTEGER,
+            PRIMARY KEY (user_id, subject_id, term_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS trg_grade_stats_insert AFTER INSERT ON grades "
+                   f"BEGIN {_GRADE_STATS_ADD_NEW} END")
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS trg_grade_stats_delete AFTER DELETE ON grades "
+                   f"BEGIN {_GRADE_STATS_REMOVE_OLD} END")
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS trg_grade_stats_update "
+                   f"AFTER UPDATE OF user_id, subject_id, term_id, value ON grades "
+                   f"BEGIN {_GRADE_STATS_REMOVE_OLD} {_GRADE_STATS_ADD_NEW} END")
+    _fill_grade_stats(cursor)
+
+def _fill_grade_stats(cursor: sql.Cursor) -> int:
+    cursor.execute("DELETE FROM grade_stats")
+    cursor.execute("INSERT INTO grade_stats (user_id, subject_id, term_id, count, sum, sum_sq, min, max) "
+                   + _GRADE_STATS_EXPECTED)
+    return cursor.rowcount
+
+def _create_conversation_states(cursor: sql.Cursor):
+    # Serialized conversation sessions for state_store.SqliteStateStore
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_states (
+            chat_id INTEGER PRIMARY KEY,
+            payload BLOB NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversation_states_expires ON conversation_states (expires_at)")
+
+def _index_grades_by_sort_date(cursor: sql.Cursor):
+    # /view_grades pages by (COALESCE(date, ''), id) so that undated grades are listed too
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_grades_user_sort_date ON grades (user_id, COALESCE(date, ''))")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_grades_user_subject_sort_date "
+                   "ON grades (user_id, subject_id, COALESCE(date, ''))")
+
+# Migration N (1-based) upgrades the schema from version N-1 to N.
+# Append new steps to the end; never edit or reorder released ones.
+MIGRATIONS = [
+    _create_tables,
+    _create_indexes,
+    _create_grade_stats,
+    _create_conversation_states,
+    _index_grades_by_sort_date,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def get_schema_version(database: Optional['Database'] = None) -> int:
+    return (database or db).fetchone("PRAGMA user_version")[0]
+
+def migrate(database: Optional['Database'] = None) -> int:
+    """Apply pending migrations to ``database`` (default ``db``) and return the resulting schema version.
+
+    When ``PRAGMA user_version`` already matches ``SCHEMA_VERSION`` no DDL is run.
+    """
+    database = database or db
+    if get_schema_version(database) >= SCHEMA_VERSION:
+        return SCHEMA_VERSION
+    with database.transaction() as cursor:
+        # Re-read under the write lock in case another process migrated first
+        version = cursor.execute("PRAGMA user_version").fetchone()[0]
+        for target in range(version + 1, SCHEMA_VERSION + 1):
+            MIGRATIONS[target - 1](cursor)
+            cursor.execute(f"PRAGMA user_version = {target}")
+            log(f"Database migrated to schema version {target}")
+    return SCHEMA_VERSION
+
+# Tables whose AUTOINCREMENT ids must stay unique across shards
+ID_TABLES = ("subjects", "schedule", "terms", "grades")
+
+def reserve_id_range(database: 'Database'):
+    """Make new ids in ``database`` start at ``database.id_base``.
+
+    Each shard allocates from its own range, so a user's rows keep their ids
+    (and old inline buttons keep working) when rebalancing moves them.
+    """
+    with database.transaction() as cursor:
+        for table in ID_TABLES:
+            cursor.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = ? AND seq < ?",
+                           (database.id_base, table, database.id_base))
+            cursor.execute("INSERT INTO sqlite_sequence (name, seq) SELECT ?, ? "
+                           "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = ?)",
+                           (table, database.id_base, table))
+
+class GradeStatsDrift(NamedTuple):
+    user_id: int
+    subject_id: int
+    term_id: int
+    expected: Optional[tuple]  # (count, sum, sum_sq, min, max) recomputed from grades
+    actual: Optional[tuple]  # the same columns as stored in grade_stats
+
+def verify_grade_stats() -> List[GradeStatsDrift]:
+    """Recompute every aggregate from ``grades`` and report rows that differ from ``grade_stats``."""
+    return [drift for drifts in db.fan_out(_verify_grade_stats) for drift in drifts]
+
+def _verify_grade_stats(database: 'Database') -> List[GradeStatsDrift]:
+    rows = database.fetchall(f"""
+        WITH expected AS ({_GRADE_STATS_EXPECTED})
+        SELECT e.user_id, e.subject_id, e.term_id, e.count, e.sum, e.sum_sq, e.min, e.max,
+               s.count, s.sum, s.sum_sq, s.min, s.max
+        FROM expected e LEFT JOIN grade_stats s
+            ON s.user_id = e.user_id AND s.subject_id = e.subject_id AND s.term_id = e.term_id
+        WHERE s.count IS NOT e.count OR s.sum IS NOT e.sum OR s.sum_sq IS NOT e.sum_sq
+            OR s.min IS NOT e.min OR s.max IS NOT e.max
+        UNION ALL
+        SELECT s.user_id, s.subject_id, s.term_id, NULL, NULL, NULL, NULL, NULL,
+               s.count, s.sum, s.sum_sq, s.min, s.max
+        FROM grade_stats s LEFT JOIN expected e
+            ON s.user_id = e.user_id AND s.subject_id = e.subject_id AND s.term_id = e.term_id
+        WHERE e.user_id IS NULL
+    """)
+    return [GradeStatsDrift(row[0], row[1], row[2],
+                            None if row[3] is None else tuple(row[3:8]),
+                            None if row[8] is None else tuple(row[8:13])) for row in rows]
+
+def rebuild_grade_stats() -> int:
+    """Recompute ``grade_stats`` from ``grades``; returns the number of aggregate rows."""
+    count = sum(db.fan_out(_rebuild_grade_stats))
+    log(f"Rebuilt grade_stats ({count} rows)")
+    return count
+
+def _rebuild_grade_stats(database: 'Database') -> int:
+    with database.transaction() as cursor:
+        return _fill_grade_stats(cursor)
+# SCHEMA MIGRATIONS END
+
+class Config(object):
+    """Runtime settings consumed by create_app() and init_storage()."""
+
+    def __init__(self, token: Optional[str] = None, api_url: Optional[str] = None, database: str = DBASE,
+                 logfile: str = LOGFILE,
+                 storage: Optional[StorageProfile] = None, subject_cache_size: int = 10000,
+                 subject_cache_ttl: float = 300.0, term_cache_size: int = 10000, term_cache_ttl: float = 300.0,
+                 dispatch_shards: int = 0, dispatch_queue: int = 0,
+                 webhook_host: str = "127.0.0.1", webhook_port: int = 8443, webhook_path: str = "/webhook",
+                 webhook_url: Optional[str] = None, webhook_secret: Optional[str] = None,
+                 webhook_max_in_flight: int = 64, state_backend: str = "memory", state_ttl: float = 3600.0,
+                 state_max_sessions: int = 100000, outbox_workers: int = 4, outbox_global_rate: float = 30.0,
+                 outbox_chat_rate: float = 1.0, outbox_group_rate: float = 20.0 / 60.0, outbox_queue: int = 0,
+                 metrics_host: str = "127.0.0.1", metrics_port: int = 0, admin_ids: Iterable[int] = (),
+                 export_workers: int = 2, import_workers: int = 1, shard_map: Optional[str] = None,
+                 worker_processes: int = 0, worker_queue: int = 1000, runtime: str = "polling"):
+        self.token = token
+        self.api_url = api_url  # Bot API server, e.g. a local stand-in for load tests; None = api.telegram.org
+        self.database = database
+        self.logfile = logfile
+        self.storage = storage or StorageProfile()
+        self.subject_cache_size = subject_cache_size  # users whose subject lists are kept
+        self.subject_cache_ttl = subject_cache_ttl  # seconds
+        self.term_cache_size = term_cache_size
+        self.term_cache_ttl = term_cache_ttl
+        # 0 keeps telebot's own worker pool; N > 0 shards updates by chat over N ordered workers
+        self.dispatch_shards = dispatch_shards
+        self.dispatch_queue = dispatch_queue  # per-shard queue bound, 0 = unbounded
+        # Webhook mode: local listener, public URL registered with Telegram (optional) and shared secret
+        self.webhook_host = webhook_host
+        self.webhook_port = webhook_port
+        self.webhook_path = webhook_path
+        self.webhook_url = webhook_url
+        self.webhook_secret = webhook_secret
+        self.webhook_max_in_flight = webhook_max_in_flight
+        # Conversation state store: "memory" or "sqlite"; sessions expire ttl seconds after the last step
+        self.state_backend = state_backend
+        self.state_ttl = state_ttl
+        self.state_max_sessions = state_max_sessions
+        # Outbound Bot API calls: N sender threads (0 = send inline from the handler) and
+        # messages/second allowed overall, per private chat and per group
+        self.outbox_workers = outbox_workers
+        self.outbox_global_rate = outbox_global_rate
+        self.outbox_chat_rate = outbox_chat_rate
+        self.outbox_group_rate = outbox_group_rate
+        self.outbox_queue = outbox_queue  # pending call bound, 0 = unbounded
+        # Prometheus /metrics listener (0 = off) and Telegram user ids allowed to run /stats
+        self.metrics_host = metrics_host
+        self.metrics_port = metrics_port
+        self.admin_ids = frozenset(admin_ids)
+        self.export_workers = export_workers  # threads building /export files
+        self.import_workers = import_workers  # threads importing /import uploads
+        # JSON shard map (see sharding.py) spreading users over several database files; replaces ``database``
+        self.shard_map = shard_map
+        # Workers mode: handler processes (0 = one per CPU) and updates queued per process
+        self.worker_processes = worker_processes
+        self.worker_queue = worker_queue
+        self.runtime = runtime  # Marks.py's default --mode
+
+    @property
+    def storage_path(self) -> str:
+        """The file that identifies the configured storage: the shard map or the database."""
+        return self.shard_map or self.database
+
+    @classmethod
+    def from_env(cls, dotenv: bool = True) -> 'Config':
+        """Read settings from the environment, loading ``.env`` first if python-dotenv is installed."""
+        if dotenv:
+            try:
+                from dotenv import load_dotenv
+                load_dotenv()
+            except ImportError:
+                pass
+        return cls(
+            # Bot token is read from the environment for safety
+            token=os.getenv("TELEGRAM_TOKEN"),
+            api_url=os.getenv("TELEGRAM_API_URL") or None,
+            database=os.getenv("MARKS_DB_PATH", DBASE),
+            logfile=os.getenv("MARKS_LOG_FILE", LOGFILE),
+            storage=StorageProfile.from_env(),
+            subject_cache_size=int(os.getenv("MARKS_SUBJECT_CACHE_SIZE", 10000)),
+            subject_cache_ttl=float(os.getenv("MARKS_SUBJECT_CACHE_TTL", 300)),
+            term_cache_size=int(os.getenv("MARKS_TERM_CACHE_SIZE", 10000)),
+            term_cache_ttl=float(os.getenv("MARKS_TERM_CACHE_TTL", 300)),
+            dispatch_shards=int(os.getenv("MARKS_DISPATCH_SHARDS", 0)),
+            dispatch_queue=int(os.getenv("MARKS_DISPATCH_QUEUE", 0)),
+            webhook_host=os.getenv("MARKS_WEBHOOK_HOST", "127.0.0.1"),
+            webhook_port=int(os.getenv("MARKS_WEBHOOK_PORT", 8443)),
+            webhook_path=os.getenv("MARKS_WEBHOOK_PATH", "/webhook"),
+            webhook_url=os.getenv("MARKS_WEBHOOK_URL") or None,
+            webhook_secret=os.getenv("MARKS_WEBHOOK_SECRET") or None,
+            webhook_max_in_flight=int(os.getenv("MARKS_WEBHOOK_MAX_IN_FLIGHT", 64)),
+            state_backend=os.getenv("MARKS_STATE_BACKEND", "memory"),
+            state_ttl=float(os.getenv("MARKS_STATE_TTL", 3600)),
+            state_max_sessions=int(os.getenv("MARKS_STATE_MAX_SESSIONS", 100000)),
+            outbox_workers=int(os.getenv("MARKS_OUTBOX_WORKERS", 4)),
+            outbox_global_rate=float(os.getenv("MARKS_OUTBOX_GLOBAL_RATE", 30)),
+            outbox_chat_rate=float(os.getenv("MARKS_OUTBOX_CHAT_RATE", 1)),
+            outbox_group_rate=float(os.getenv("MARKS_OUTBOX_GROUP_RATE", 20 / 60)),
+            outbox_queue=int(os.getenv("MARKS_OUTBOX_QUEUE", 0)),
+            metrics_host=os.getenv("MARKS_METRICS_HOST", "127.0.0.1"),
+            metrics_port=int(os.getenv("MARKS_METRICS_PORT", 0)),
+            admin_ids=[int(part) for part in os.getenv("MARKS_ADMIN_IDS", "").split(",") if part.strip()],
+            export_workers=int(os.getenv("MARKS_EXPORT_WORKERS", 2)),
+            import_workers=int(os.getenv("MARKS_IMPORT_WORKERS", 1)),
+            shard_map=os.getenv("MARKS_SHARD_MAP") or None,
+            worker_processes=int(os.getenv("MARKS_WORKER_PROCESSES", 0)),
+            worker_queue=int(os.getenv("MARKS_WORKER_QUEUE", 1000)),
+            runtime=os.getenv("MARKS_RUNTIME", "polling"),
+        )
+
+_storage_lock = threading.Lock()
+_storage_ready: Optional[str] = None  # database path init_storage() last prepared
+
+def configure_storage(config: Config):
+    """Point ``db`` and ``log_writer`` at the configured files without running any DDL."""
+    global db, log_writer, subject_cache, term_cache, user_states
+    if db.path != config.storage_path or db.profile is not config.storage:
+        db.close()
+        db = open_database(config)
+        subject_cache.clear()
+        term_cache.clear()
+    if (subject_cache.maxsize, subject_cache.ttl) != (config.subject_cache_size, config.subject_cache_ttl):
+        subject_cache = LRUCache(config.subject_cache_size, config.subject_cache_ttl)
+    if (term_cache.maxsize, term_cache.ttl) != (config.term_cache_size, config.term_cache_ttl):
+        term_cache = LRUCache(config.term_cache_size, config.term_cache_ttl)
+    if log_writer.path != config.logfile:
+        log_writer.close()
+        log_writer = LogWriter(config.logfile)
+        atexit.register(log_writer.close)
+    user_states.stop()
+    if config.state_backend == "sqlite":
+        user_states = SqliteStateStore(db, config.state_ttl)
+    elif config.state_backend == "memory":
+        user_states = MemoryStateStore(config.state_ttl, config.state_max_sessions)
+    else:
+        raise ValueError(f"Unknown state backend {config.state_backend!r}, expected memory or sqlite")
+
+def init_storage(config: Config):
+    """Configure storage and apply migrations, once per database path."""
+    global _storage_ready
+    with _storage_lock:
+        if _storage_ready == config.storage_path and db.path == config.storage_path:
+            return
+        configure_storage(config)
+        init_database()
+        user_states.start_sweeper(log)
+        _storage_ready = config.storage_path
+
+def open_database(config: Config) -> Database:
+    """``config.database``, or the shards listed in ``config.shard_map`` when one is set."""
+    if config.shard_map:
+        import sharding
+        return sharding.ShardedDatabase(sharding.ShardMap.load(config.shard_map), config.storage)
+    return Database(config.database, config.storage)
+
+# CONFIRMATION CODE SENDING FUNC BEGIN
+def send_code(chat_id: Optional[int]):
+    if chat_id is None:
+        log("Chat ID cannot be None.")
+        return None
+    code = rnd.randint(100000, 999999)
+    text = f"Your confirmation code for #ThDev Marks is {code}."
+    if bot:
+        bot.send_message(chat_id=chat_id, text=text)
+    else:
+        log(f"[send_code] Would send to {chat_id}: {text}")
+    return code
+# CONFIRMATION CODE SENDING FUNC END
+
+class User(object):
+    __slots__ = ('id_', 'tgID', 'name')
+
+    def __init__(self, tg_id: Optional[int], name: str = "", id_: str = ""):
+
+        self.id_ = id_ or str(uuid.uuid4())  # Ensure id_ is generated if None
+        self.tgID = tg_id
+        self.name = name
+
+    def sign_up(self):
+        if not self.id_:
+            self.id_ = str(uuid.uuid4())
+        try:
+            with db.shard(self.tgID).transaction() as cursor:
+                cursor.execute(
+                    "INSERT INTO users (id, telegram_id, name) VALUES (?, ?, ?);",
+                    (self.id_, self.tgID, self.name)
+                )
+            log(f"User {self.name} ({self.tgID}) signed up")
+        except sql.IntegrityError:
+            log(f"User {self.tgID} already exists")
+
+    @staticmethod
+    def get_user_by_telegram_id(tg_id: int) -> Optional['User']:
+        row = db.shard(tg_id).fetchone("SELECT id, telegram_id, name FROM users WHERE telegram_id = ?", (tg_id,))
+        if row:
+            return User(tg_id=row[1], name=row[2], id_=row[0])
+        return None
+
+class SubjectRecord(NamedTuple):
+    id: int
+    name: str
+
+class Subject:
+    __slots__ = ('id', 'user_id', 'name')
+
+    def __init__(self, id_: Optional[int] = None, user_id: Optional[int] = None, name: str = ""):
+        self.id = id_
+        self.user_id = user_id
+        self.name = name
+
+    def save(self):
+        if self.user_id is None:
+            log("User ID cannot be None when saving a subject.")
+            return
+        with db.shard(self.user_id).transaction() as cursor:
+            if self.id:
+                cursor.execute(
+                    "UPDATE subjects SET name = ? WHERE id = ? AND user_id = ?",
+                    (self.name, self.id, self.user_id)
+                )
+            else:
+                cursor.execute(
+                    "INSERT INTO subjects (user_id, name) VALUES (?, ?)",
+                    (self.user_id, self.name)
+                )
+                self.id = cursor.lastrowid
+        subject_cache.invalidate(self.user_id)
+
+    @staticmethod
+    def cached_for_user(user_id: int) -> Tuple[Tuple[SubjectRecord, ...], Dict[int, str]]:
+        """The user's ``(id, name)`` rows and id -> name map, served from ``subject_cache``.
+
+        The returned objects are shared between callers and must not be modified.
+        """
+        def load():
+            rows = tuple(map(SubjectRecord._make,
+                             db.shard(user_id).fetchall("SELECT id, name FROM subjects WHERE user_id = ?", (user_id,))))
+            return rows, dict(rows)
+        return subject_cache.get(user_id, load)
+
+    @staticmethod
+    def get_subject_records(user_id: int) -> Tuple[SubjectRecord, ...]:
+        """Read-only ``get_subjects_by_user``: the cached rows themselves, nothing is copied."""
+        return Subject.cached_for_user(user_id)[0]
+
+    @staticmethod
+    def get_subjects_by_user(user_id: int) -> List['Subject']:
+        rows, _ = Subject.cached_for_user(user_id)
+        return [Subject(id_=row[0], user_id=user_id, name=row[1]) for row in rows]
+
+    
+    @staticmethod
+    def get_subject_by_id(subject_id: int, user_id: int) -> Optional['Subject']:
+        _, names = Subject.cached_for_user(user_id)
+        if subject_id in names:
+            return Subject(id_=subject_id, user_id=user_id, name=names[subject_id])
+        return None
+
+    @staticmethod
+    def get_names_by_user(user_id: int) -> Dict[int, str]:
+        _, names = Subject.cached_for_user(user_id)
+        return dict(names)
+
+    @staticmethod
+    def resolve_names(user_id: int, names: Iterable[str]) -> Tuple[Dict[str, int], int]:
+        """Subject ids for ``names`` matched ignoring case, creating the subjects that do not exist yet.
+
+        Returns ``{name.casefold(): id}`` and the number of subjects created.
+        Runs in (or joins) one transaction.
+        """
+        wanted = {name.strip().casefold(): name.strip() for name in names}
+        with db.shard(user_id).transaction() as cursor:
+            ids: Dict[str, int] = {}
+            for subject_id, name in cursor.execute("SELECT id, name FROM subjects WHERE user_id = ? ORDER BY id",
+                                                   (user_id,)):
+                ids.setdefault(name.casefold(), subject_id)
+            missing = [name for key, name in wanted.items() if key not in ids]
+            for name in missing:
+                cursor.execute("INSERT INTO subjects (user_id, name) VALUES (?, ?)", (user_id, name))
+                ids[name.casefold()] = cursor.lastrowid
+        if missing:
+            subject_cache.invalidate(user_id)
+        return {key: ids[key] for key in wanted}, len(missing)
+
+class SubjectNames(object):
+    """Request-local subject id -> name map.
+
+    Names seen in joined grade rows are remembered; anything else is loaded
+    for the whole user with one query on the first miss.
+    """
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self._names: Dict[int, str] = {}
+        self._loaded = False
+
+    def remember(self, rows: List['GradeRow']):
+        for row in rows:
+            if row.subject_id is not None and row.subject_name is not None:
+                self._names[row.subject_id] = row.subject_name
+
+    def get(self, subject_id: Optional[int], default: str = "Unknown") -> str:
+        if subject_id is None:
+            return default
+        if subject_id not in self._names and not self._loaded:
+            self._names.update(Subject.get_names_by_user(self.user_id))
+            self._loaded = True
+        return self._names.get(subject_id, default)
+
+class GradeRow(NamedTuple):
+    id: int
+    subject_id: Optional[int]
+    subject_name: Optional[str]
+    value: Optional[int]
+    grade_type: str
+    date: Optional[str]
+    term_id: Optional[int]
+    confirmed: bool
+
+class SubjectAverage(NamedTuple):
+    subject_id: int
+    subject_name: str
+    count: int
+    avg: Optional[float]
+    min: Optional[int]
+    max: Optional[int]
+    variance: Optional[float]  # population variance
+
+class GradeRecord(NamedTuple):
+    id: int
+    user_id: int
+    subject_id: Optional[int]
+    value: Optional[int]
+    grade_type: str
+    date: Optional[str]
+    term_id: Optional[int]
+    confirmed: bool
+
+# Columns Grade.get_grade_columns() may return
+GRADE_COLUMNS = GradeRecord._fields
+
+class Grade:
+    __slots__ = GRADE_COLUMNS
+
+    def __init__(self, id_: Optional[int] = None, user_id: Optional[int] = None, subject_id: Optional[int] = None,
+                 value: Optional[int] = None, grade_type: str = "", date_: Optional[date] = None,
+                 term_id: Optional[int] = None, confirmed: bool = False):
+        self.id = id_
+        self.user_id = user_id
+        self.subject_id = subject_id
+        self.value = value
+        self.grade_type = grade_type
+        self.date = date_
+        self.term_id = term_id
+        self.confirmed = confirmed
+
+    def save(self):
+        with db.shard(self.user_id).transaction() as cursor:
+            if self.id:
+                cursor.execute("""
+                    UPDATE grades SET subject_id = ?, value = ?, grade_type = ?,
+                    date = ?, term_id = ?, confirmed = ? WHERE id = ? AND user_id = ?
+                """, (self.subject_id, self.value, self.grade_type, self.date,
+                      self.term_id, self.confirmed, self.id, self.user_id))
+            else:
+                cursor.execute("""
+                    INSERT INTO grades (user_id, subject_id, value, grade_type, date, term_id, confirmed)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, (self.user_id, self.subject_id, self.value, self.grade_type,
+                      self.date, self.term_id, self.confirmed))
+                self.id = cursor.lastrowid
+
+    @staticmethod
+    def insert_many(user_id: int, rows: Iterable[tuple]) -> int:
+        """Insert ``(subject_id, value, grade_type, date, term_id, confirmed)`` rows in one transaction.
+
+        Returns the number of grades inserted.
+        """
+        with db.shard(user_id).transaction() as cursor:
+            cursor.executemany("""
+                INSERT INTO grades (user_id, subject_id, value, grade_type, date, term_id, confirmed)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, ((user_id,) + tuple(row) for row in rows))
+            return cursor.rowcount
+
+    @staticmethod
+    def _select(columns: Iterable[str], user_id: int, subject_id: Optional[int],
+                term_id: Optional[int]) -> List[tuple]:
+        query = f"SELECT {', '.join(columns)} FROM grades WHERE user_id = ?"
+        params = [user_id]
+
+        if subject_id:
+            query += " AND subject_id = ?"
+            params.append(subject_id)
+        if term_id:
+            query += " AND term_id = ?"
+            params.append(term_id)
+
+        query += " ORDER BY date DESC"
+        return db.shard(user_id).reader().fetchall(query, params)
+
+    @staticmethod
+    def get_grades_by_user(user_id: int, subject_id: Optional[int] = None, term_id: Optional[int] = None) -> List['Grade']:
+        rows = Grade._select(GRADE_COLUMNS, user_id, subject_id, term_id)
+        return [Grade(*row) for row in rows]
+
+    @staticmethod
+    def get_grade_records(user_id: int, subject_id: Optional[int] = None,
+                          term_id: Optional[int] = None) -> List[GradeRecord]:
+        """Read-only ``get_grades_by_user``: named tuples instead of model objects."""
+        return list(map(GradeRecord._make, Grade._select(GRADE_COLUMNS, user_id, subject_id, term_id)))
+
+    @staticmethod
+    def get_grade_columns(user_id: int, columns: Iterable[str] = ('value',), subject_id: Optional[int] = None,
+                          term_id: Optional[int] = None) -> Dict[str, Tuple]:
+        """The requested columns of the user's grades as one tuple per column, newest first.
+
+        For callers that only need a field or two, e.g. ``get_grade_columns(uid, ('value',))['value']``.
+        """
+        columns = tuple(columns)
+        unknown = set(columns) - set(GRADE_COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown grade column(s): {', '.join(sorted(unknown))}")
+        rows = Grade._select(columns, user_id, subject_id, term_id)
+        arrays = tuple(zip(*rows)) if rows else ((),) * len(columns)
+        return dict(zip(columns, arrays))
+
+    @staticmethod
+    def get_grade_rows(user_id: int, subject_id: Optional[int] = None, term_id: Optional[int] = None) -> List[GradeRow]:
+        """Like ``get_grades_by_user`` but read-only rows carrying the subject name (one joined query)."""
+        query = """
+            SELECT g.id, g.subject_id, s.name, g.value, g.grade_type, g.date, g.term_id, g.confirmed
+            FROM grades g
+            LEFT JOIN subjects s ON s.id = g.subject_id AND s.user_id = g.user_id
+            WHERE g.user_id = ?
+        """
+        params = [user_id]
+        if subject_id:
+            query += " AND g.subject_id = ?"
+            params.append(subject_id)
+        if term_id:
+            query += " AND g.term_id = ?"
+            params.append(term_id)
+        query += " ORDER BY g.date DESC"
+        return [GradeRow(*row) for row in db.shard(user_id).reader().fetchall(query, params)]
+
+    @staticmethod
+    def iter_export_rows(user_id: int, batch: int = 500) -> Iterator[tuple]:
+        """All of the user's grades, oldest first, as (date, subject, value, type, term, confirmed) rows.
+
+        Rows are streamed from the cursor; see ``export.py``.
+        """
+        return db.shard(user_id).reader().iterate("""
+            SELECT g.date, s.name, g.value, g.grade_type, t.name, g.confirmed
+            FROM grades g
+            LEFT JOIN subjects s ON s.id = g.subject_id AND s.user_id = g.user_id
+            LEFT JOIN terms t ON t.id = g.term_id AND t.user_id = g.user_id
+            WHERE g.user_id = ?
+            ORDER BY g.date, g.id
+        """, (user_id,), batch)
+
+    @staticmethod
+    def get_grade_page(user_id: int, subject_id: Optional[int] = None,
+                       before: Optional[Tuple[str, int]] = None, after: Optional[Tuple[str, int]] = None,
+                       limit: int = 20) -> Tuple[List[GradeRow], bool]:
+        """One page of grade rows, newest first, using a ``(date, id)`` keyset cursor.
+
+        Grades without a date come last, as if dated ``''``; their cursors use ``''``.
+        ``before`` pages towards older grades and ``after`` towards newer ones.
+        Returns the rows and whether more rows exist beyond them in that direction.
+        """
+        query = """
+            SELECT g.id, g.subject_id, s.name, g.value, g.grade_type, g.date, g.term_id, g.confirmed
+            FROM grades g
+            LEFT JOIN subjects s ON s.id = g.subject_id AND s.user_id = g.user_id
+            WHERE g.user_id = ?
+        """
+        params: List = [user_id]
+        if subject_id:
+            query += " AND g.subject_id = ?"
+            params.append(subject_id)
+        # Undated grades sort as '' (oldest) so the row-value comparisons still reach them; the single
+        # column bound lets the idx_grades_*_sort_date indexes seek to the cursor
+        if after:
+            query += (" AND COALESCE(g.date, '') >= ? AND (COALESCE(g.date, ''), g.id) > (?, ?)"
+                      " ORDER BY COALESCE(g.date, '') ASC, g.id ASC LIMIT ?")
+            params.extend([after[0], after[0], after[1], limit + 1])
+        else:
+            if before:
+                query += " AND COALESCE(g.date, '') <= ? AND (COALESCE(g.date, ''), g.id) < (?, ?)"
+                params.extend([before[0], before[0], before[1]])
+            query += " ORDER BY COALESCE(g.date, '') DESC, g.id DESC LIMIT ?"
+            params.append(limit + 1)
+        rows = [GradeRow(*row) for row in db.shard(user_id).reader().fetchall(query, params)]
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if after:
+            rows.reverse()
+        return rows, has_more
+
+    @staticmethod
+    def count_by_user(user_id: int, subject_id: Optional[int] = None,
+                      before: Optional[Tuple[str, int]] = None) -> int:
+        """Number of grades, optionally only those older than a ``(date, id)`` cursor."""
+        query = "SELECT COUNT(*) FROM grades WHERE user_id = ?"
+        params: List = [user_id]
+        if subject_id:
+            query += " AND subject_id = ?"
+            params.append(subject_id)
+        if before:
+            query += " AND COALESCE(date, '') <= ? AND (COALESCE(date, ''), id) < (?, ?)"
+            params.extend([before[0], before[0], before[1]])
+        return db.shard(user_id).reader().fetchone(query, params)[0]
+
+    @staticmethod
+    def averages_by_user(user_id: int, term_id: Optional[int] = None) -> List[SubjectAverage]:
+        """Per-subject grade count/avg/min/max/variance in a single query.
+
+        Served from the trigger-maintained ``grade_stats`` aggregates, so the cost
+        does not grow with the number of grades. Every subject of the user is
+        returned, including ones without grades (count 0, the other figures None).
+        ``term_id`` restricts the grades to one term.
+        """
+        query = """
+            SELECT s.id, s.name, SUM(gs.count), SUM(gs.sum), SUM(gs.sum_sq), MIN(gs.min), MAX(gs.max)
+            FROM subjects s
+            LEFT JOIN grade_stats gs ON gs.user_id = s.user_id AND gs.subject_id = s.id
+        """
+        params: List[int] = []
+        if term_id:
+            query += " AND gs.term_id = ?"
+            params.append(term_id)
+        query += " WHERE s.user_id = ? GROUP BY s.id ORDER BY s.id"
+        params.append(user_id)
+        averages = []
+        for subject_id, name, count, total, total_sq, low, high in db.shard(user_id).reader().fetchall(query, params):
+            if not count:
+                averages.append(SubjectAverage(subject_id, name, 0, None, None, None, None))
+                continue
+            avg = total / count
+            averages.append(SubjectAverage(subject_id, name, count, avg, low, high,
+                                           max(0.0, total_sq / count - avg * avg)))
+        return averages
+
+def _date_key(value: Union[date, str]) -> str:
+    # Dates are stored as ISO strings, which sort like the dates themselves
+    return value.isoformat() if isinstance(value, date) else str(value)
+
+class TermIndex(object):
+    """A user's terms sorted by start date, answering "which term contains D" by bisect.
+
+    ``max_ends[i]`` is the latest end date among the first ``i + 1`` terms, which
+    bounds the backwards walk when terms overlap.
+    """
+
+    def __init__(self, rows: List[tuple]):
+        # rows: (id, name, start_date, end_date)
+        self.rows = sorted((row for row in rows if row[2] is not None and row[3] is not None),
+                           key=lambda row: _date_key(row[2]))
+        self.starts = [_date_key(row[2]) for row in self.rows]
+        self.max_ends: List[str] = []
+        for row in self.rows:
+            end = _date_key(row[3])
+            self.max_ends.append(max(end, self.max_ends[-1]) if self.max_ends else end)
+
+    def find(self, day: Union[date, str]) -> Optional[tuple]:
+        """The latest-starting term that contains ``day``, or None."""
+        key = _date_key(day)
+        i = bisect.bisect_right(self.starts, key) - 1
+        while i >= 0 and self.max_ends[i] >= key:
+            if _date_key(self.rows[i][3]) >= key:
+                return self.rows[i]
+            i -= 1
+        return None
+
+    def find_many(self, days: Iterable[Union[date, str]]) -> List[Optional[tuple]]:
+        return [self.find(day) for day in days]
+
+class TermRecord(NamedTuple):
+    id: int
+    name: str
+    start_date: Optional[str]
+    end_date: Optional[str]
+
+class Term:
+    __slots__ = ('id', 'user_id', 'name', 'start_date', 'end_date')
+
+    def __init__(self, id_: Optional[int] = None, user_id: Optional[int] = None, name: str = "",
+                 start_date: Optional[date] = None, end_date: Optional[date] = None):
+        self.id = id_
+        self.user_id = user_id
+        self.name = name
+        self.start_date = start_date
+        self.end_date = end_date
+
+    def save(self):
+        with db.shard(self.user_id).transaction() as cursor:
+            if self.id:
+                cursor.execute(
+                    "UPDATE terms SET name = ?, start_date = ?, end_date = ? WHERE id = ? AND user_id = ?",
+                    (self.name, self.start_date, self.end_date, self.id, self.user_id)
+                )
+            else:
+                cursor.execute(
+                    "INSERT INTO terms (user_id, name, start_date, end_date) VALUES (?, ?, ?, ?)",
+                    (self.user_id, self.name, self.start_date, self.end_date)
+                )
+                self.id = cursor.lastrowid
+        term_cache.invalidate(self.user_id)
+
+    @staticmethod
+    def index_for_user(user_id: int) -> TermIndex:
+        """The user's TermIndex, loaded lazily and cached in ``term_cache``."""
+        def load():
+            return TermIndex(db.shard(user_id).fetchall(
+                "SELECT id, name, start_date, end_date FROM terms WHERE user_id = ? ORDER BY start_date",
+                (user_id,)))
+        return term_cache.get(user_id, load)
+
+    @staticmethod
+    def get_terms_by_user(user_id: int) -> List['Term']:
+        rows = db.shard(user_id).fetchall("SELECT id, user_id, name, start_date, end_date FROM terms WHERE user_id = ? ORDER BY start_date DESC", (user_id,))
+        return [Term(id_=row[0], user_id=row[1], name=row[2], start_date=row[3], end_date=row[4]) for row in rows]
+
+    @staticmethod
+    def get_term_records(user_id: int) -> List[TermRecord]:
+        """Read-only ``get_terms_by_user``: named tuples, newest first."""
+        return list(map(TermRecord._make, db.shard(user_id).reader().fetchall(
+            "SELECT id, name, start_date, end_date FROM terms WHERE user_id = ? ORDER BY start_date DESC", (user_id,))))
+
+    @staticmethod
+    def get_current_term(user_id: int) -> Optional['Term']:
+        return Term.find_term(user_id, date.today())
+
+    @staticmethod
+    def find_term(user_id: int, day: Union[date, str]) -> Optional['Term']:
+        row = Term.index_for_user(user_id).find(day)
+        if row:
+            return Term(id_=row[0], user_id=user_id, name=row[1], start_date=row[2], end_date=row[3])
+        return None
+
+    @staticmethod
+    def find_term_ids(user_id: int, days: Iterable[Union[date, str]]) -> List[Optional[int]]:
+        """Term id (or None) for each of ``days``, e.g. when re-tagging historical grades."""
+        return [row[0] if row else None for row in Term.index_for_user(user_id).find_many(days)]
+
+
+# Bot handlers
+# Store user states for conversation flow; replaced by configure_storage()
+user_states: StateStore = MemoryStateStore()
+
+def format_averages(averages: List[SubjectAverage]) -> str:
+    text = ""
+    for average in averages:
+        if average.count:
+            text += f"• {average.subject_name}: {average.avg:.2f} (from {average.count} grades)\n"
+        else:
+            text += f"• {average.subject_name}: No grades yet\n"
+    return text
+
+def format_stats(summary: List[Dict[str, Any]]) -> str:
+    text = "Handler stats (calls, avg/p50/p95 ms, SQL statements/rows per call):\n\n"
+    for row in summary:
+        text += (f"{row['handler']}: {row['calls']} calls, {row['errors']} errors\n"
+                 f"  {row['avg_ms']:.1f} / {row['p50_ms']:.1f} / {row['p95_ms']:.1f} ms, "
+                 f"{row['statements']:.1f} stmts, {row['rows']:.1f} rows\n")
+    if outbox is not None:
+        queue = outbox.metrics()
+        text += (f"\nOutbox: {queue['depth']} queued, {queue['sent']} sent, {queue['retried']} retried, "
+                 f"wait p95 {queue['wait_p95_ms']:.0f} ms\n")
+    if dispatcher is not None:
+        depth = sum(shard["depth"] for shard in dispatcher.metrics())
+        text += f"Dispatcher: {depth} updates queued\n"
+    return text
+
+def register_handlers(bot, admin_ids: Iterable[int] = ()) -> None:
+    """Attach every command and callback handler to ``bot``; ``admin_ids`` may use /stats."""
+    from telebot import types
+    from telebot.types import Message, CallbackQuery
+
+    # type: ignore is used to suppress type checker errors for dynamic decorators
+    @bot.message_handler(commands=['start'])  # type: ignore[attr-defined]
+    def handle_start(message: Message) -> None:
+        if not hasattr(message, 'chat') or not hasattr(message.chat, 'id'):
+            return
+        user = User.get_user_by_telegram_id(message.chat.id)
+        first_name = getattr(getattr(message, 'from_user', None), 'first_name', None)
+        if not user:
+            user = User(tg_id=message.chat.id, name=first_name or "Unknown")
+            user.sign_up()
+            if bot:
+                bot.reply_to(message, f"Welcome to Marks E-Daybook, {user.name}!\n\nUse /help to see available commands.")
+        else:
+            if bot:
+                bot.reply_to(message, f"Welcome back, {user.name}!\n\nUse /help to see available commands.")
+
+    @bot.message_handler(commands=['help'])  # type: ignore[attr-defined]
+    def handle_help(message: Message) -> None:
+        help_text = """<b>📚 Marks E-Daybook Commands:</b>
+
+<b>📝 Subject Management:</b>
+/add_subject - Add a new subject
+/list_subjects - List all your subjects
+
+<b>📊 Grade Management:</b>
+/add_grade - Add a new grade
+/view_grades - View your grades
+/average - Calculate average grades
+/average terms - Averages broken down by term
+/export - Download all grades as CSV (/export xlsx for Excel)
+/import - Add many grades at once from a CSV or JSON file
+
+<b>📅 Terms:</b>
+/add_term - Add a new academic term
+/list_terms - List all terms
+
+<b>❓ Other:</b>
+/help - Show this help message
+/cancel - Cancel current operation
+"""
+        if bot and hasattr(message, 'chat') and hasattr(message.chat, 'id'):
+            bot.send_message(message.chat.id, help_text, parse_mode='HTML')
+
+    @bot.message_handler(commands=['add_subject'])  # type: ignore[attr-defined]
+    def handle_add_subject(message: Message) -> None:
+        if not hasattr(message, 'chat') or not hasattr(message.chat, 'id'):
+            return
+        user_states[message.chat.id] = {'state': 'waiting_subject_name'}
+        if bot:
+            bot.reply_to(message, "Please enter the name of the subject:")
+
+    @bot.message_handler(commands=['list_subjects'])  # type: ignore[attr-defined]
+    def handle_list_subjects(message: Message) -> None:
+        if not hasattr(message, 'chat') or not hasattr(message.chat, 'id'):
+            return
+        subjects = Subject.get_subject_records(message.chat.id)
+        if not subjects:
+            if bot:
+                bot.reply_to(message, "You don't have any subjects yet. Use /add_subject to add one.")
+            return
+
+        text = "📚 Your Subjects:\n\n"
+        for i, subject in enumerate(subjects, 1):
+            text += f"{i}. {subject.name}\n"
+        if bot:
+            bot.send_message(message.chat.id, text)
+
+    @bot.message_handler(commands=['add_term'])  # type: ignore[attr-defined]
+    def handle_add_term(message: Message) -> None:
+        if not hasattr(message, 'chat') or not hasattr(message.chat, 'id'):
+            return
+        user_states[message.chat.id] = {'state': 'waiting_term_name'}
+        if bot:
+            bot.reply_to(message, "Please enter the name of the term (e.g., 'Fall 2023'):")
+
+    @bot.message_handler(commands=['list_terms'])  # type: ignore[attr-defined]
+    def handle_list_terms(message: Message) -> None:
+        if not hasattr(message, 'chat') or not hasattr(message.chat, 'id'):
+            return
+        terms = Term.get_term_records(message.chat.id)
+        if not terms:
+            if bot:
+                bot.reply_to(message, "You don't have any terms yet. Use /add_term to add one.")
+            return
+
+        text = "📅 Your Terms:\n\n"
+        for term in terms:
+            text += f"• {term.name}: {term.start_date} - {term.end_date}\n"
+        if bot:
+            bot.send_message(message.chat.id, text)
+
+    @bot.message_handler(commands=['add_grade'])  # type: ignore[attr-defined]
+    def handle_add_grade(message: Message) -> None:
+        if not hasattr(message, 'chat') or not hasattr(message.chat, 'id'):
+            return
+        subjects = Subject.get_subject_records(message.chat.id)
+        if not subjects:
+            if bot:
+                bot.reply_to(message, "You need to add subjects first. Use /add_subject.")
+            return
+        markup = types.InlineKeyboardMarkup()
+        for subject in subjects:
+            markup.add(types.InlineKeyboardButton(subject.name, callback_data=f"grade_subject_{subject.id}"))
+        if bot:
+            bot.send_message(message.chat.id, "Select a subject for the grade:", reply_markup=markup)
+
+    @bot.callback_query_handler(func=lambda call: hasattr(call, 'data') and isinstance(call.data, str) and call.data.startswith('grade_subject_'))  # type: ignore[attr-defined]
+    def handle_grade_subject_selection(call: CallbackQuery) -> None:
+        if not hasattr(call, 'data') or not hasattr(call, 'message') or not hasattr(call.message, 'chat') or not hasattr(call.message.chat, 'id'):
+            return
+        subject_id = int(call.data.split('_')[2])
+        user_states[call.message.chat.id] = {'state': 'waiting_grade_value', 'subject_id': subject_id}
+        if bot:
+            bot.edit_message_text("Enter the grade value (1-12):", call.message.chat.id, call.message.message_id)
+
+    @bot.message_handler(commands=['view_grades'])  # type: ignore[attr-defined]
+    def handle_view_grades(message: Message) -> None:
+        if not hasattr(message, 'chat') or not hasattr(message.chat, 'id'):
+            return
+        subjects = Subject.get_subject_records(message.chat.id)
+        if not subjects:
+            if bot:
+                bot.reply_to(message, "You don't have any subjects yet.")
+            return
+        markup = types.InlineKeyboardMarkup()
+        for subject in subjects:
+            markup.add(types.InlineKeyboardButton(subject.name, callback_data=f"view_grades_{subject.id}"))
+        markup.add(types.InlineKeyboardButton("All Subjects", callback_data="view_grades_all"))
+        if bot:
+            bot.send_message(message.chat.id, "Select a subject to view grades:", reply_markup=markup)
+
+    GRADES_PAGE_SIZE = 20
+
+    def show_grade_page(call: CallbackQuery, scope: str, before: Optional[Tuple[str, int]] = None,
+                        after: Optional[Tuple[str, int]] = None) -> None:
+        """Edit the message in place with one page of grades for ``scope`` ('all' or a subject id)."""
+        chat_id = call.message.chat.id
+        subject_id = None if scope == 'all' else int(scope)
+        # The page and the count of older grades come from one snapshot
+        with db.shard(chat_id).reader().snapshot():
+            grades, has_more = Grade.get_grade_page(chat_id, subject_id=subject_id, before=before, after=after,
+                                                    limit=GRADES_PAGE_SIZE)
+            oldest = (grades[-1].date or '', grades[-1].id) if grades else None
+            remaining = Grade.count_by_user(chat_id, subject_id=subject_id, before=oldest) if grades else 0
+        names = SubjectNames(chat_id)
+        names.remember(grades)
+        subject_name = "All Subjects" if subject_id is None else names.get(subject_id)
+
+        if not grades:
+            if bot:
+                bot.edit_message_text(f"No grades found for {subject_name}.", chat_id, call.message.message_id)
+            return
+
+        text = f"📊 Grades for {subject_name}:\n\n"
+        for grade in grades:
+            text += f"• {grade.subject_name or 'Unknown'}: {grade.value} ({grade.grade_type}) - {grade.date}\n"
+
+        if remaining:
+            text += f"\n... and {remaining} more grades"
+
+        # Coming from a newer page there is always something to go back to
+        has_newer = has_more if after else before is not None
+        markup = None
+        if has_newer or remaining:
+            newest = (grades[0].date or '', grades[0].id)
+            buttons = []
+            if has_newer:
+                buttons.append(types.InlineKeyboardButton(
+                    "⬅️ Newer", callback_data=f"grades_page_{scope}_p_{newest[0]}_{newest[1]}"))
+            if remaining:
+                buttons.append(types.InlineKeyboardButton(
+                    "Older ➡️", callback_data=f"grades_page_{scope}_n_{oldest[0]}_{oldest[1]}"))
+            markup = types.InlineKeyboardMarkup()
+            markup.row(*buttons)
+
+        if bot:
+            bot.edit_message_text(text, chat_id, call.message.message_id, reply_markup=markup)
+
+    @bot.callback_query_handler(func=lambda call: hasattr(call, 'data') and isinstance(call.data, str) and call.data.startswith('view_grades_'))  # type: ignore[attr-defined]
+    def handle_view_grades_selection(call: CallbackQuery) -> None:
+        if not hasattr(call, 'data') or not hasattr(call, 'message') or not hasattr(call.message, 'chat') or not hasattr(call.message.chat, 'id'):
+            return
+        show_grade_page(call, call.data.split('_')[2])
+
+    @bot.callback_query_handler(func=lambda call: hasattr(call, 'data') and isinstance(call.data, str) and call.data.startswith('grades_page_'))  # type: ignore[attr-defined]
+    def handle_grades_page(call: CallbackQuery) -> None:
+        if not hasattr(call, 'data') or not hasattr(call, 'message') or not hasattr(call.message, 'chat') or not hasattr(call.message.chat, 'id'):
+            return
+        # grades_page_<scope>_<n|p>_<date>_<id>
+        _, _, scope, direction, cursor_date, cursor_id = call.data.split('_')
+        cursor = (cursor_date, int(cursor_id))
+        if direction == 'p':
+            show_grade_page(call, scope, after=cursor)
+        else:
+            show_grade_page(call, scope, before=cursor)
+
+    @bot.message_handler(commands=['export'])  # type: ignore[attr-defined]
+    def handle_export(message: Message) -> None:
+        if not hasattr(message, 'chat') or not hasattr(message.chat, 'id'):
+            return
+        import export as grade_export
+        args = (getattr(message, 'text', None) or "").split()[1:]
+        fmt = args[0].lower() if args else "csv"
+        if fmt not in grade_export.FORMATS:
+            if bot:
+                bot.reply_to(message, "Usage: /export [csv|xlsx]")
+            return
+        if fmt == "xlsx" and not grade_export.xlsx_available():
+            if bot:
+                bot.reply_to(message, "XLSX export is not available on this server. Use /export csv.")
+            return
+        if exporter is None:
+            if bot:
+                bot.reply_to(message, "Export is not available right now.")
+            return
+        if not Grade.count_by_user(message.chat.id):
+            if bot:
+                bot.reply_to(message, "You don't have any grades to export yet.")
+            return
+        if exporter.submit(bot, message.chat.id, message.chat.id, fmt):
+            reply = "Preparing your export, the file will arrive shortly."
+        else:
+            reply = "An export is already in progress."
+        if bot:
+            bot.reply_to(message, reply)
+
+    @bot.message_handler(commands=['import'])  # type: ignore[attr-defined]
+    def handle_import(message: Message) -> None:
+        if not hasattr(message, 'chat') or not hasattr(message.chat, 'id'):
+            return
+        user_states[message.chat.id] = {'state': 'waiting_import_file'}
+        if bot:
+            bot.reply_to(message, "Send a CSV or JSON file with Date, Subject and Grade columns "
+                                  "(optionally Type and Confirmed), e.g. a file from /export. /cancel to stop.")
+
+    @bot.message_handler(content_types=['document'],  # type: ignore[attr-defined]
+                         func=lambda message: hasattr(message, 'chat') and hasattr(message.chat, 'id') and (user_states.get(message.chat.id) or {}).get('state') == 'waiting_import_file')
+    def handle_import_file(message: Message) -> None:
+        if not hasattr(message, 'chat') or not hasattr(message.chat, 'id'):
+            return
+        # The session may have expired or moved on since the filter looked at it
+        session = user_states.get(message.chat.id)
+        document = getattr(message, 'document', None)
+        if session is None or session['state'] != 'waiting_import_file' or document is None:
+            return
+        import importer as grade_import
+        fmt = grade_import.detect_format(document.file_name or "")
+        if fmt is None:
+            if bot:
+                bot.reply_to(message, "Please send a .csv or .json file.")
+            return
+        if (document.file_size or 0) > grade_import.MAX_FILE_SIZE:
+            if bot:
+                bot.reply_to(message, "The file is too large, the limit is 20 MB.")
+            return
+        if importer is None:
+            if bot:
+                bot.reply_to(message, "Import is not available right now.")
+            return
+        if not importer.submit(bot, message.chat.id, message.chat.id, document.file_id, fmt):
+            if bot:
+                bot.reply_to(message, "An import is already in progress.")
+            return
+        del user_states[message.chat.id]
+        if bot:
+            bot.reply_to(message, "Importing your grades, I'll report back when done.")
+
+    @bot.message_handler(commands=['average'])  # type: ignore[attr-defined]
+    def handle_average(message: Message) -> None:
+        if not hasattr(message, 'chat') or not hasattr(message.chat, 'id'):
+            return
+        # One snapshot, so the per-term figures add up to the overall ones
+        with db.shard(message.chat.id).reader().snapshot():
+            averages = Grade.averages_by_user(message.chat.id)
+            text = "📈 Average Grades:\n\n" + format_averages(averages)
+
+            # "/average terms" adds a breakdown for every term
+            args = (getattr(message, 'text', None) or "").split()[1:]
+            if averages and args and args[0].lower() in ('term', 'terms'):
+                for term in Term.get_term_records(message.chat.id):
+                    term_averages = [a for a in Grade.averages_by_user(message.chat.id, term_id=term.id) if a.count]
+                    text += f"\n📅 {term.name} ({term.start_date} - {term.end_date}):\n"
+                    text += format_averages(term_averages) if term_averages else "• No grades yet\n"
+
+        if not averages:
+            if bot:
+                bot.reply_to(message, "You don't have any subjects yet.")
+            return
+
+        if bot:
+            bot.send_message(message.chat.id, text)
+
+    admins = frozenset(admin_ids)
+
+    @bot.message_handler(commands=['stats'])  # type: ignore[attr-defined]
+    def handle_stats(message: Message) -> None:
+        user = getattr(message, 'from_user', None)
+        if user is None or user.id not in admins:
+            return
+        if metrics is None:
+            if bot:
+                bot.reply_to(message, "Metrics are not enabled.")
+            return
+        summary = metrics.summary()
+        if bot:
+            bot.reply_to(message, format_stats(summary) if summary else "No handler calls recorded yet.")
+
+    @bot.message_handler(commands=['cancel'])  # type: ignore[attr-defined]
+    def handle_cancel(message: Message) -> None:
+        if not hasattr(message, 'chat') or not hasattr(message.chat, 'id'):
+            return
+        del user_states[message.chat.id]
+        if bot:
+            bot.reply_to(message, "Operation cancelled.")
+
+    @bot.message_handler(func=lambda message: hasattr(message, 'chat') and hasattr(message.chat, 'id') and message.chat.id in user_states)  # type: ignore[attr-defined]
+    def handle_user_input(message: Message) -> None:
+        if not hasattr(message, 'chat') or not hasattr(message.chat, 'id'):
+            return
+        session = user_states.get(message.chat.id)
+        if session is None:
+            return
+        state = session['state']
+
+        if state == 'waiting_subject_name':
+            name = getattr(message, 'text', None)
+            if not name:
+                return
+            subject = Subject(user_id=message.chat.id, name=name.strip())
+            subject.save()
+            del user_states[message.chat.id]
+            if bot:
+                bot.reply_to(message, f"Subject '{subject.name}' added successfully!")
+
+        elif state == 'waiting_term_name':
+            term_name = getattr(message, 'text', None)
+            if not term_name:
+                return
+            session['term_name'] = term_name.strip()
+            session['state'] = 'waiting_term_start'
+            user_states[message.chat.id] = session
+            if bot:
+                bot.reply_to(message, "Enter start date (YYYY-MM-DD):")
+
+        elif state == 'waiting_term_start':
+            text = getattr(message, 'text', None)
+            if not text:
+                return
+            try:
+                start_date = date.fromisoformat(text.strip())
+                session['start_date'] = start_date
+                session['state'] = 'waiting_term_end'
+                user_states[message.chat.id] = session
+                if bot:
+                    bot.reply_to(message, "Enter end date (YYYY-MM-DD):")
+            except ValueError:
+                if bot:
+                    bot.reply_to(message, "Invalid date format. Please use YYYY-MM-DD:")
+
+        elif state == 'waiting_term_end':
+            text = getattr(message, 'text', None)
+            if not text:
+                return
+            try:
+                end_date = date.fromisoformat(text.strip())
+                term = Term(
+                    user_id=message.chat.id,
+                    name=session['term_name'],
+                    start_date=session['start_date'],
+                    end_date=end_date
+                )
+                term.save()
+                del user_states[message.chat.id]
+                if bot:
+                    bot.reply_to(message, f"Term '{term.name}' added successfully!")
+            except ValueError:
+                if bot:
+                    bot.reply_to(message, "Invalid date format. Please use YYYY-MM-DD:")
+
+        elif state == 'waiting_grade_value':
+            text = getattr(message, 'text', None)
+            if not text:
+                return
+            try:
+                value = int(text.strip())
+                if not 1 <= value <= 12:
+                    raise ValueError
+                subject_id = session['subject_id']
+                grade = Grade(
+                    user_id=message.chat.id,
+                    subject_id=subject_id,
+                    value=value,
+                    grade_type="regular",
+                    date_=date.today()
+                )
+                # Get current term
+                current_term = Term.get_current_term(message.chat.id)
+                if current_term:
+                    grade.term_id = current_term.id
+                grade.save()
+                del user_states[message.chat.id]
+                subject = Subject.get_subject_by_id(subject_id, message.chat.id)
+                if bot:
+                    bot.reply_to(message, f"Grade {value} added for {subject.name if subject else 'subject'}!")
+            except ValueError:
+                if bot:
+                    bot.reply_to(message, "Please enter a valid grade (1-12):")
+
+        elif state == 'waiting_import_file':
+            if bot:
+                bot.reply_to(message, "Send the grades as a CSV or JSON file, or /cancel.")
+
+def create_app(config: Optional[Config] = None, threaded: bool = True):
+    """Build the bot: read configuration, prepare storage once and register handlers.
+
+    telebot is imported here rather than at module level. Returns the TeleBot,
+    or None when pyTelegramBotAPI is not installed or no token is configured.
+    With ``threaded=False`` updates are handled on the thread that calls
+    ``process_new_updates``, in order, and ``dispatch_shards`` is ignored.
+    """
+    global bot, dispatcher, outbox, metrics, exporter, importer
+    config = config or Config.from_env()
+    init_storage(config)
+    if not config.token:
+        return None
+    try:
+        import telebot
+    except ImportError:
+        log("pyTelegramBotAPI is not installed; bot disabled")
+        return None
+    if config.api_url:
+        telebot.apihelper.API_URL = api_url_template(config.api_url)
+    if not threaded:
+        bot = telebot.TeleBot(token=config.token, threaded=False)
+    elif config.dispatch_shards > 0:
+        import dispatcher as chat_dispatcher
+        bot = telebot.TeleBot(token=config.token, threaded=False)
+        dispatcher = chat_dispatcher.attach(bot, config.dispatch_shards, config.dispatch_queue)
+    else:
+        bot = telebot.TeleBot(token=config.token)
+    outbox = attach_outbox(bot, config)
+    metrics = attach_metrics(bot, config)
+    exporter = create_exporter(config)
+    importer = create_importer(config)
+    register_handlers(bot, config.admin_ids)
+    return bot
+
+def create_exporter(config: Config):
+    import export
+    return export.Exporter(config.export_workers)
+
+def create_importer(config: Config):
+    import importer as grade_import
+    return grade_import.Importer(config.import_workers)
+
+def stop_workers():
+    """Drain the background workers create_app() started: updates first, then exports and imports, then replies."""
+    if dispatcher:
+        dispatcher.stop()
+    if exporter:
+        exporter.stop()
+    if importer:
+        importer.stop()
+    if outbox:
+        outbox.stop()
+
+def api_url_template(base: str) -> str:
+    """telebot's ``API_URL`` format string for a Bot API base URL such as ``http://127.0.0.1:8081``."""
+    return base if "{0}" in base else base.rstrip("/") + "/bot{0}/{1}"
+
+def attach_metrics(bot, config: Config):
+    """Instrument handlers registered on ``bot`` from now on; serves /metrics if a port is configured."""
+    import metrics as handler_metrics
+    instrumented = handler_metrics.instrument(bot, db)
+    if config.metrics_port:
+        handler_metrics.serve(instrumented, config.metrics_host, config.metrics_port)
+    return instrumented
+
+def attach_outbox(bot, config: Config):
+    """Route the bot's replies through a rate-limited send queue; None when disabled."""
+    if config.outbox_workers <= 0:
+        return None
+    import outbox as outbound
+    return outbound.attach(bot, config.outbox_workers, global_rate=config.outbox_global_rate,
+                           chat_rate=config.outbox_chat_rate, group_rate=config.outbox_group_rate,
+                           max_queue=config.outbox_queue)
+
+# Main bot polling
+if __name__ == "__main__":
+    bot = create_app()
+    if bot:
+        log("Bot started")
+        try:
+            bot.polling(none_stop=True)
+        finally:
+            stop_workers()
+            log_writer.close()
+    else:
         print("Bot token not found. Set TELEGRAM_TOKEN environment variable.")
\ No newline at end of file
@@ -0,0 +1,6 @@
+"""Micro-benchmarks for the Marks storage layer.
+
+Run a scenario from the repository root, e.g.::
+
+    python -m benchmarks.connections
+"""
@@ -0,0 +1,75 @@
+"""Bulk import throughput: ``importer.import_grades`` against one ``Grade.save`` per grade.
+
+Generates ``--rows`` CSV rows over ``--subjects`` subjects in memory, imports
+them into a fresh database with a few ``--chunk`` sizes, and times the
+one-transaction-per-grade path the /add_grade flow uses on a slice of them.
+
+    python -m benchmarks.bulk_import [--rows 100000] [--subjects 10] [--save-rows 5000]
+"""
+
+import argparse
+import csv
+import io
+import random
+import time
+from datetime import date, timedelta
+
+from benchmarks.common import backend, temp_database
+import importer
+
+USER_ID = 1
+
+
+def make_csv(rows: int, subjects: int, seed: int = 0) -> bytes:
+    rng = random.Random(seed)
+    names = [f"Subject {i}" for i in range(subjects)]
+    text = io.StringIO()
+    writer = csv.writer(text)
+    writer.writerow(["Date", "Subject", "Grade", "Type", "Term", "Confirmed"])
+    start = date(2024, 1, 1)
+    for _ in range(rows):
+        writer.writerow([(start + timedelta(days=rng.randrange(365))).isoformat(), rng.choice(names),
+                         rng.randint(1, 12), "regular", "", rng.choice(("yes", "no"))])
+    return text.getvalue().encode("utf-8")
+
+
+def _terms():
+    for month in range(1, 13, 3):
+        backend.Term(user_id=USER_ID, name=f"Q{month // 3 + 1}", start_date=date(2024, month, 1),
+                     end_date=date(2024, month + 2, 28)).save()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--subjects", type=int, default=10)
+    parser.add_argument("--save-rows", type=int, default=5000, help="grades inserted one Grade.save at a time")
+    args = parser.parse_args()
+
+    data = make_csv(args.rows, args.subjects)
+    print(f"{args.rows} rows, {len(data) / 1e6:.1f} MB of CSV")
+    for chunk in (500, 5000, 50000):
+        with temp_database():
+            _terms()
+            start = time.perf_counter()
+            result = importer.import_grades(USER_ID, importer.read_csv(io.BytesIO(data)), chunk=chunk)
+            elapsed = time.perf_counter() - start
+        print(f"import_grades(chunk={chunk:<6}) {result.imported:>8} grades in {elapsed:6.2f}s "
+              f"{result.imported / elapsed:10.0f} grades/s")
+
+    with temp_database():
+        _terms()
+        rows = [importer.parse_row(fields) for _, (_, fields) in
+                zip(range(args.save_rows), importer.read_csv(io.BytesIO(data)))]
+        start = time.perf_counter()
+        for subject, day, value, grade_type, confirmed in rows:
+            subject_ids, _ = backend.Subject.resolve_names(USER_ID, (subject,))
+            backend.Grade(user_id=USER_ID, subject_id=subject_ids[subject.casefold()], value=value,
+                          grade_type=grade_type, date_=day, confirmed=confirmed,
+                          term_id=backend.Term.find_term_ids(USER_ID, (day,))[0]).save()
+        elapsed = time.perf_counter() - start
+    print(f"Grade.save per row           {len(rows):>8} grades in {elapsed:6.2f}s {len(rows) / elapsed:10.0f} grades/s")
+
+
+if __name__ == "__main__":
+    main()
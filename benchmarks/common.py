@@ -0,0 +1,84 @@
+"""Shared helpers for the benchmark scripts."""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import backend
+
+
+@contextmanager
+def temp_database(profile: Optional[backend.StorageProfile] = None, shards: int = 1) -> Iterator[str]:
+    """Point the model layer at a fresh database in a temporary directory.
+
+    With ``shards`` > 1 it is a ``sharding.ShardedDatabase`` over that many
+    files with the buckets spread evenly, and the yielded path is the shard map.
+    """
+    tmpdir = tempfile.mkdtemp(prefix="marks-bench-")
+    path = os.path.join(tmpdir, "bench.db")
+    previous = backend.db, backend.log_writer
+    profile = profile or previous[0].profile
+    if shards > 1:
+        import sharding
+        shard_map = sharding.ShardMap([os.path.join(tmpdir, f"bench-{i}.db") for i in range(shards)],
+                                      [bucket % shards for bucket in range(sharding.BUCKETS)],
+                                      os.path.join(tmpdir, "shards.json"))
+        shard_map.save()
+        path = shard_map.path
+        backend.db = sharding.ShardedDatabase(shard_map, profile)
+    else:
+        backend.db = backend.Database(path, profile)
+    backend.log_writer = backend.LogWriter(os.path.join(tmpdir, "logs.txt"))
+    backend.subject_cache.clear()
+    backend.term_cache.clear()
+    try:
+        backend.init_database()
+        yield path
+    finally:
+        backend.db.close()
+        backend.log_writer.close()
+        backend.db, backend.log_writer = previous
+        backend.subject_cache.clear()
+        backend.term_cache.clear()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def time_calls(fn: Callable[[], object], n: int) -> List[float]:
+    """Call ``fn`` ``n`` times and return per-call latencies in seconds."""
+    samples = []
+    for _ in range(n):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def percentile(sorted_samples: List[float], pct: float) -> float:
+    if not sorted_samples:
+        return 0.0
+    index = min(len(sorted_samples) - 1, int(round(pct / 100.0 * (len(sorted_samples) - 1))))
+    return sorted_samples[index]
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    ordered = sorted(samples)
+    total = sum(ordered)
+    return {
+        "n": len(ordered),
+        "mean_us": total / len(ordered) * 1e6 if ordered else 0.0,
+        "p50_us": percentile(ordered, 50) * 1e6,
+        "p95_us": percentile(ordered, 95) * 1e6,
+        "p99_us": percentile(ordered, 99) * 1e6,
+        "ops_per_s": len(ordered) / total if total else 0.0,
+    }
+
+
+def print_row(label: str, stats: Dict[str, float]):
+    print(f"{label:<40} mean {stats['mean_us']:9.1f}us  p50 {stats['p50_us']:9.1f}us  "
+          f"p95 {stats['p95_us']:9.1f}us  p99 {stats['p99_us']:9.1f}us  {stats['ops_per_s']:10.0f} ops/s")
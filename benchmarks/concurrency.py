@@ -0,0 +1,100 @@
+"""Read/write throughput of the model layer under a handler thread pool.
+
+Each worker mimics a bot handler: mostly grade listings (``/view_grades``)
+with a share of ``Grade.save`` writes. The run is repeated for several pool
+sizes and for the legacy rollback-journal profile vs the tuned WAL profile,
+then for the tuned profile sharded over ``--shards`` database files.
+
+    python -m benchmarks.concurrency [--threads 1,2,4,8,16] [--seconds 2] [--shards 4]
+"""
+
+import argparse
+import random
+import sqlite3 as sql
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+from benchmarks.common import backend, temp_database
+
+PROFILES = {
+    # What a plain sqlite3.connect() gave us before the storage profile
+    "legacy": backend.StorageProfile(journal_mode="DELETE", synchronous="FULL", mmap_size=0,
+                                     cache_size=-2000, temp_store="DEFAULT", busy_timeout=5000),
+    "tuned": backend.StorageProfile(),
+}
+
+
+def _seed(users: int, subjects: int, grades: int):
+    start = date(2020, 9, 1)
+    for user_id in range(1, users + 1):
+        backend.User(tg_id=user_id, name=f"user{user_id}").sign_up()
+        subject_ids = []
+        for i in range(subjects):
+            subject = backend.Subject(user_id=user_id, name=f"Subject {i}")
+            subject.save()
+            subject_ids.append(subject.id)
+        with backend.db.shard(user_id).transaction() as cursor:
+            cursor.executemany(
+                "INSERT INTO grades (user_id, subject_id, value, grade_type, date) VALUES (?, ?, ?, 'regular', ?)",
+                [(user_id, subject_ids[i % subjects], 1 + i % 12, start + timedelta(days=i % 700))
+                 for i in range(grades)],
+            )
+
+
+def _run(threads: int, seconds: float, users: int, write_ratio: float):
+    stop = time.perf_counter() + seconds
+    counts = {"reads": 0, "writes": 0, "locked": 0}
+    lock = threading.Lock()
+
+    def worker(seed: int):
+        rng = random.Random(seed)
+        reads = writes = locked = 0
+        while time.perf_counter() < stop:
+            user_id = rng.randint(1, users)
+            try:
+                if rng.random() < write_ratio:
+                    subject_id = backend.Subject.get_subjects_by_user(user_id)[0].id
+                    backend.Grade(user_id=user_id, subject_id=subject_id, value=rng.randint(1, 12),
+                                  grade_type="regular", date_=date.today()).save()
+                    writes += 1
+                else:
+                    backend.Grade.get_grades_by_user(user_id)[:20]
+                    reads += 1
+            except sql.OperationalError:
+                locked += 1
+        with lock:
+            counts["reads"] += reads
+            counts["writes"] += writes
+            counts["locked"] += locked
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(worker, range(threads)))
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", default="1,2,4,8,16")
+    parser.add_argument("--seconds", type=float, default=2.0)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--grades", type=int, default=500, help="grades per user")
+    parser.add_argument("--write-ratio", type=float, default=0.2)
+    parser.add_argument("--shards", default="4", help="shard counts to run the tuned profile with (0 = skip)")
+    args = parser.parse_args()
+
+    runs = [(name, profile, 1) for name, profile in PROFILES.items()]
+    runs += [(f"{count} shards", PROFILES["tuned"], count) for count in map(int, args.shards.split(",")) if count > 1]
+    print(f"{'profile':<10}{'threads':>8}{'reads/s':>12}{'writes/s':>12}{'locked':>8}")
+    for name, profile, shards in runs:
+        with temp_database(profile, shards):
+            _seed(args.users, 10, args.grades)
+            for threads in [int(n) for n in args.threads.split(",")]:
+                counts = _run(threads, args.seconds, args.users, args.write_ratio)
+                print(f"{name:<10}{threads:>8}{counts['reads'] / args.seconds:>12.0f}"
+                      f"{counts['writes'] / args.seconds:>12.0f}{counts['locked']:>8}")
+
+
+if __name__ == "__main__":
+    main()
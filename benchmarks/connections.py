@@ -0,0 +1,75 @@
+"""Per-call latency of model reads/writes: connect-per-call vs pooled.
+
+The "before" rows replay the old pattern (``sql.connect`` + query + close on
+every call); the "after" rows go through the model methods, which reuse the
+thread's connection and its statement cache.
+
+    python -m benchmarks.connections [--calls N]
+"""
+
+import argparse
+import sqlite3 as sql
+from datetime import date
+
+from benchmarks.common import backend, print_row, summarize, temp_database, time_calls
+
+
+def _connect_per_call(path: str, query: str, params: tuple, write: bool = False):
+    conn = sql.connect(path)
+    cursor = conn.cursor()
+    cursor.execute(query, params)
+    if write:
+        conn.commit()
+    else:
+        cursor.fetchall()
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=2000)
+    args = parser.parse_args()
+
+    user_id = 1000
+    with temp_database() as path:
+        backend.User(tg_id=user_id, name="bench").sign_up()
+        for i in range(15):
+            backend.Subject(user_id=user_id, name=f"Subject {i}").save()
+        backend.Term(user_id=user_id, name="Term", start_date=date(2000, 1, 1),
+                     end_date=date(2100, 1, 1)).save()
+        subject_id = backend.Subject.get_subjects_by_user(user_id)[0].id
+
+        scenarios = [
+            ("get_user_by_telegram_id",
+             "SELECT id, telegram_id, name FROM users WHERE telegram_id = ?", (user_id,),
+             lambda: backend.User.get_user_by_telegram_id(user_id)),
+            ("get_subjects_by_user",
+             "SELECT id, user_id, name FROM subjects WHERE user_id = ?", (user_id,),
+             lambda: backend.Subject.get_subjects_by_user(user_id)),
+            ("get_subject_by_id",
+             "SELECT id, user_id, name FROM subjects WHERE id = ? AND user_id = ?", (subject_id, user_id),
+             lambda: backend.Subject.get_subject_by_id(subject_id, user_id)),
+            ("get_current_term",
+             "SELECT id, user_id, name, start_date, end_date FROM terms WHERE user_id = ? "
+             "AND start_date <= ? AND end_date >= ?", (user_id, date.today(), date.today()),
+             lambda: backend.Term.get_current_term(user_id)),
+        ]
+        for name, query, params, pooled in scenarios:
+            before = time_calls(lambda: _connect_per_call(path, query, params), args.calls)
+            after = time_calls(pooled, args.calls)
+            print_row(f"{name} (before)", summarize(before))
+            print_row(f"{name} (after)", summarize(after))
+
+        insert = ("INSERT INTO grades (user_id, subject_id, value, grade_type, date, term_id, confirmed) "
+                  "VALUES (?, ?, ?, ?, ?, ?, ?)")
+        params = (user_id, subject_id, 10, "regular", date.today(), None, False)
+        before = time_calls(lambda: _connect_per_call(path, insert, params, write=True), args.calls)
+        after = time_calls(lambda: backend.Grade(user_id=user_id, subject_id=subject_id, value=10,
+                                                 grade_type="regular", date_=date.today()).save(),
+                           args.calls)
+        print_row("Grade.save (before)", summarize(before))
+        print_row("Grade.save (after)", summarize(after))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Deterministic synthetic dataset for the model layer.
+
+``generate(spec)`` fills the current ``backend.db`` with ``users`` users, each
+with ``subjects`` subjects, ``terms`` consecutive terms and ``grades`` grades per
+subject spread over those terms. The same spec (including ``seed``) always
+produces the same rows. The last term is open-ended, so
+``Term.get_current_term`` finds it whatever day the benchmark runs on.
+
+To write a standalone database file::
+
+    python -m benchmarks.datagen out.db [--users N] [--subjects M] [--grades K] [--terms T]
+"""
+
+import argparse
+import os
+import random
+from datetime import date, timedelta
+from typing import List, NamedTuple
+
+from benchmarks.common import backend
+
+FIRST_TELEGRAM_ID = 10_000_000
+FIRST_TERM_START = date(2020, 9, 1)
+TERM_DAYS = 120
+OPEN_END = date(2100, 12, 31)
+GRADE_TYPES = ("regular", "regular", "regular", "test", "exam")
+
+
+class DatasetSpec(NamedTuple):
+    users: int = 200
+    subjects: int = 10
+    grades: int = 30  # per user and subject
+    terms: int = 4
+    seed: int = 1
+
+
+class Dataset(NamedTuple):
+    spec: DatasetSpec
+    user_ids: List[int]  # telegram ids
+    subject_ids: List[List[int]]  # per user, in user_ids order
+    term_ids: List[List[int]]
+
+
+def _term_bounds(spec: DatasetSpec) -> List[tuple]:
+    bounds = []
+    for t in range(spec.terms):
+        start = FIRST_TERM_START + timedelta(days=t * TERM_DAYS)
+        end = OPEN_END if t == spec.terms - 1 else start + timedelta(days=TERM_DAYS - 1)
+        bounds.append((start, end))
+    return bounds
+
+
+def generate(spec: DatasetSpec = DatasetSpec()) -> Dataset:
+    """Insert the dataset into ``backend.db``, one transaction per user on the user's shard."""
+    rng = random.Random(spec.seed)
+    bounds = _term_bounds(spec)
+    # Grades fall inside the closed terms plus one term's worth of the open one
+    span_days = max(1, spec.terms) * TERM_DAYS
+    user_ids, subject_ids, term_ids = [], [], []
+    for u in range(spec.users):
+        tg_id = FIRST_TELEGRAM_ID + u
+        with backend.db.shard(tg_id).transaction() as cursor:
+            cursor.execute("INSERT INTO users (id, telegram_id, name) VALUES (?, ?, ?)",
+                           (f"bench-{tg_id}", tg_id, f"User {u}"))
+            subjects = []
+            for s in range(spec.subjects):
+                cursor.execute("INSERT INTO subjects (user_id, name) VALUES (?, ?)", (tg_id, f"Subject {s}"))
+                subjects.append(cursor.lastrowid)
+            terms = []
+            for t, (start, end) in enumerate(bounds):
+                cursor.execute("INSERT INTO terms (user_id, name, start_date, end_date) VALUES (?, ?, ?, ?)",
+                               (tg_id, f"Term {t + 1}", start, end))
+                terms.append(cursor.lastrowid)
+            rows = []
+            for subject_id in subjects:
+                for _ in range(spec.grades):
+                    offset = rng.randrange(span_days)
+                    day = FIRST_TERM_START + timedelta(days=offset)
+                    term_id = terms[min(offset // TERM_DAYS, len(terms) - 1)] if terms else None
+                    rows.append((tg_id, subject_id, rng.randint(1, 12), rng.choice(GRADE_TYPES),
+                                 day, term_id, rng.random() < 0.5))
+            cursor.executemany(
+                "INSERT INTO grades (user_id, subject_id, value, grade_type, date, term_id, confirmed) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        user_ids.append(tg_id)
+        subject_ids.append(subjects)
+        term_ids.append(terms)
+    backend.subject_cache.clear()
+    backend.term_cache.clear()
+    return Dataset(spec, user_ids, subject_ids, term_ids)
+
+
+def main():
+    defaults = DatasetSpec()
+    parser = argparse.ArgumentParser(description="Write a synthetic Marks database")
+    parser.add_argument("path")
+    parser.add_argument("--users", type=int, default=defaults.users)
+    parser.add_argument("--subjects", type=int, default=defaults.subjects)
+    parser.add_argument("--grades", type=int, default=defaults.grades)
+    parser.add_argument("--terms", type=int, default=defaults.terms)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    args = parser.parse_args()
+    if os.path.exists(args.path):
+        parser.error(f"{args.path} already exists")
+
+    spec = DatasetSpec(args.users, args.subjects, args.grades, args.terms, args.seed)
+    previous = backend.db
+    backend.db = backend.Database(args.path, previous.profile)
+    try:
+        backend.init_database()
+        generate(spec)
+    finally:
+        backend.db.close()
+        backend.db = previous
+    print(f"Wrote {args.path}: {spec.users} users, {spec.users * spec.subjects * spec.grades} grades")
+
+
+if __name__ == "__main__":
+    main()
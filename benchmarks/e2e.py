@@ -0,0 +1,227 @@
+"""End-to-end load test: scripted conversations from many chats against a fake Bot API.
+
+Starts ``benchmarks.fakeapi`` and, unless ``--external`` is given, the bot
+itself (polling, with its handlers, outbox and a temporary database) pointed
+at it. Each simulated chat runs the same conversation::
+
+    /start -> /add_subject -> <name> -> /add_grade -> [subject button] -> <value>
+           -> /view_grades -> [subject button]
+
+A step is sent as soon as the bot has answered the previous one, and its
+latency is measured from queuing the update to the bot's sendMessage /
+editMessageText call reaching the fake API. ``--concurrency`` chats are in
+flight at once.
+
+    python -m benchmarks.e2e [--chats 2000] [--concurrency 200] [--shards 8] [--processes 4]
+
+``--processes N`` runs the bot as ``--mode workers`` does instead: a
+supervisor polling for N worker processes, each handling its chats in order.
+
+With ``--external`` only the fake API runs (on ``--port``); start the bot
+separately with ``TELEGRAM_API_URL=http://127.0.0.1:<port>``.
+"""
+
+import argparse
+import itertools
+import os
+import shutil
+import tempfile
+import threading
+import time
+from typing import Dict, Generator, List, Optional, Tuple
+
+from benchmarks.common import backend, print_row, summarize
+from benchmarks.fakeapi import FakeBotAPI
+
+FIRST_CHAT_ID = 500_000_000
+Reply = Tuple[str, dict, dict]  # (method, params, result) as seen by the fake API
+Script = Generator[Tuple[str, dict], Reply, None]
+
+_message_ids = itertools.count(1)
+_callback_ids = itertools.count(1)
+
+
+def _user(chat_id: int) -> dict:
+    return {"id": chat_id, "is_bot": False, "first_name": f"Load {chat_id}"}
+
+
+def message_update(chat_id: int, text: str) -> dict:
+    message = {"message_id": next(_message_ids), "from": _user(chat_id),
+               "chat": {"id": chat_id, "type": "private"}, "date": int(time.time()), "text": text}
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"message": message}
+
+
+def callback_update(chat_id: int, message: dict, data: str) -> dict:
+    return {"callback_query": {"id": str(next(_callback_ids)), "from": _user(chat_id), "message": message,
+                               "chat_instance": str(chat_id), "data": data}}
+
+
+def _first_button(reply: Reply) -> Tuple[dict, str]:
+    _, params, result = reply
+    return result, params["reply_markup"]["inline_keyboard"][0][0]["callback_data"]
+
+
+def conversation(chat_id: int) -> Script:
+    """Yields (step, update) and receives the bot's reply to each."""
+    yield "start", message_update(chat_id, "/start")
+    yield "add_subject", message_update(chat_id, "/add_subject")
+    yield "subject name", message_update(chat_id, "Mathematics")
+    reply = yield "add_grade", message_update(chat_id, "/add_grade")
+    yield "grade subject (callback)", callback_update(chat_id, *_first_button(reply))
+    yield "grade value", message_update(chat_id, "10")
+    reply = yield "view_grades", message_update(chat_id, "/view_grades")
+    yield "view grades (callback)", callback_update(chat_id, *_first_button(reply))
+
+
+class Replayer(object):
+    """Drives ``chats`` conversations through ``api``, ``concurrency`` at a time."""
+
+    def __init__(self, api: FakeBotAPI, chats: int, concurrency: int, timeout: float = 10.0):
+        self.api = api
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.latencies: Dict[str, List[float]] = {}
+        self.completed = 0
+        self.failed = 0
+        self.unsolicited = 0
+        self._chats = iter(range(FIRST_CHAT_ID, FIRST_CHAT_ID + chats))
+        self._total = chats
+        self._pending: Dict[int, Tuple[str, float, Script]] = {}
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        api.on_call = self.on_reply
+
+    def _advance(self, chat_id: int, script: Script, reply: Optional[Reply]):
+        # Called with self._lock held
+        try:
+            step, update = script.send(reply) if reply is not None else next(script)
+        except StopIteration:
+            self.completed += 1
+            self._start_next()
+            return
+        except (KeyError, IndexError, TypeError):
+            self.failed += 1  # the reply did not carry the expected keyboard
+            self._start_next()
+            return
+        self._pending[chat_id] = (step, time.perf_counter(), script)
+        self.api.push_update(update)
+
+    def _start_next(self):
+        chat_id = next(self._chats, None)
+        if chat_id is not None:
+            self._advance(chat_id, conversation(chat_id), None)
+        elif self.completed + self.failed >= self._total:
+            self._done.set()
+
+    def on_reply(self, method: str, params: dict, result):
+        received = time.perf_counter()
+        chat_id = int(params.get("chat_id") or 0)
+        with self._lock:
+            entry = self._pending.pop(chat_id, None)
+            if entry is None:
+                self.unsolicited += 1
+                return
+            step, sent, script = entry
+            self.latencies.setdefault(step, []).append(received - sent)
+            self._advance(chat_id, script, (method, params, result))
+
+    def run(self) -> float:
+        """Run every conversation; returns the wall time in seconds."""
+        start = time.perf_counter()
+        with self._lock:
+            for _ in range(min(self.concurrency, self._total)):
+                self._start_next()
+        while not self._done.wait(0.1):
+            now = time.perf_counter()
+            with self._lock:
+                for chat_id, (step, sent, _) in list(self._pending.items()):
+                    if now - sent > self.timeout:
+                        del self._pending[chat_id]
+                        self.failed += 1
+                        self._start_next()
+        return time.perf_counter() - start
+
+
+def _bot_config(api: FakeBotAPI, tmpdir: str, args) -> backend.Config:
+    return backend.Config(
+        token="123456:fake", api_url=api.url,
+        database=os.path.join(tmpdir, "e2e.db"), logfile=os.path.join(tmpdir, "logs.txt"),
+        dispatch_shards=args.shards, outbox_workers=args.outbox_workers,
+        outbox_global_rate=args.global_rate, outbox_chat_rate=args.chat_rate, outbox_group_rate=args.chat_rate,
+    )
+
+
+def _start_bot(api: FakeBotAPI, tmpdir: str, args):
+    bot = backend.create_app(_bot_config(api, tmpdir, args))
+    threading.Thread(target=bot.polling, name="polling", daemon=True,
+                     kwargs={"non_stop": True, "interval": 0, "timeout": 5, "long_polling_timeout": 1}).start()
+    return bot
+
+
+def _start_supervisor(api: FakeBotAPI, tmpdir: str, args):
+    import supervisor
+
+    runner = supervisor.Supervisor(_bot_config(api, tmpdir, args), workers=args.processes, poll_timeout=1)
+    thread = threading.Thread(target=runner.run, name="supervisor", daemon=True)
+    thread.start()
+    return runner, thread
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chats", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--timeout", type=float, default=10.0, help="seconds to wait for each reply")
+    parser.add_argument("--shards", type=int, default=8, help="MARKS_DISPATCH_SHARDS for the bot (0 = telebot pool)")
+    parser.add_argument("--outbox-workers", type=int, default=8)
+    parser.add_argument("--global-rate", type=float, default=0.0, help="outbox messages/s overall (0 = unlimited)")
+    parser.add_argument("--chat-rate", type=float, default=0.0, help="outbox messages/s per chat (0 = unlimited)")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="fraction of replies refused with 429")
+    parser.add_argument("--processes", type=int, default=0,
+                        help="run the bot as a supervisor with this many worker processes (--mode workers)")
+    parser.add_argument("--external", action="store_true", help="do not start the bot in this process")
+    parser.add_argument("--port", type=int, default=0)
+    args = parser.parse_args()
+
+    api = FakeBotAPI(port=args.port, flood_rate=args.flood_rate).start()
+    replayer = Replayer(api, args.chats, args.concurrency, args.timeout)
+    tmpdir = tempfile.mkdtemp(prefix="marks-e2e-")
+    bot = runner = None
+    try:
+        if args.external:
+            print(f"Fake Bot API on {api.url}; start the bot with TELEGRAM_API_URL={api.url}")
+        elif args.processes:
+            runner, thread = _start_supervisor(api, tmpdir, args)
+        else:
+            bot = _start_bot(api, tmpdir, args)
+        elapsed = replayer.run()
+    finally:
+        if bot is not None:
+            bot.stop_polling()
+            backend.stop_workers()
+        if runner is not None:
+            print(f"workers: {runner.metrics()}")
+            runner.stop()
+            thread.join()
+        api.shutdown()
+
+    print(f"{replayer.completed} conversations completed, {replayer.failed} failed "
+          f"in {elapsed:.2f}s ({replayer.completed / elapsed:.1f} conversations/s)")
+    steps = sum(len(samples) for samples in replayer.latencies.values())
+    print(f"{steps} updates answered ({steps / elapsed:.0f}/s), {replayer.unsolicited} unsolicited replies, "
+          f"API calls: {dict(sorted(api.calls.items()))}")
+    for step, samples in replayer.latencies.items():
+        print_row(step, summarize(samples))
+    print_row("all steps", summarize([s for samples in replayer.latencies.values() for s in samples]))
+    if backend.outbox:
+        print(f"outbox: {backend.outbox.metrics()}")
+    if bot is not None or runner is not None:
+        backend.db.close()
+        backend.log_writer.close()
+    shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
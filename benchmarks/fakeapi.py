@@ -0,0 +1,167 @@
+"""A local stand-in for the Telegram Bot API, for end-to-end load tests.
+
+Serves ``/bot<token>/<method>`` like api.telegram.org for the methods the bot
+uses: getMe, getUpdates (long polling), sendMessage, editMessageText and
+answerCallbackQuery. Other methods answer ``{"ok": true, "result": true}``.
+Point the bot at it with ``TELEGRAM_API_URL=http://127.0.0.1:8081``.
+
+Tests inject updates with ``push_update()`` and observe the bot's calls
+through the ``on_call`` hook, which receives ``(method, params, result)``
+for every sendMessage / editMessageText. With ``flood_rate`` > 0 that fraction
+of those calls is refused with 429 and ``retry_after``, to exercise the
+outbound queue's backoff.
+"""
+
+import itertools
+import json
+import random
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Deque, Dict, List, Optional
+from urllib.parse import parse_qsl, urlsplit
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Marks", "username": "marks_bot"}
+REPLY_METHODS = ("sendMessage", "editMessageText")
+
+
+class FakeBotAPI(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, flood_rate: float = 0.0, retry_after: int = 1,
+                 on_call: Optional[Callable[[str, Dict[str, Any], dict], None]] = None):
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.on_call = on_call
+        self.calls: Dict[str, int] = {}
+        self._updates: Deque[dict] = deque()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._cond = threading.Condition()
+        self._rng = random.Random(0)
+        super().__init__((host, port), FakeBotAPIHandler)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> 'FakeBotAPI':
+        threading.Thread(target=self.serve_forever, name="fakeapi", daemon=True).start()
+        return self
+
+    def next_message_id(self) -> int:
+        return next(self._message_ids)
+
+    def push_update(self, update: dict) -> int:
+        """Queue an update (without ``update_id``) for getUpdates; returns its id."""
+        with self._cond:
+            update_id = next(self._update_ids)
+            self._updates.append(dict(update, update_id=update_id))
+            self._cond.notify_all()
+        return update_id
+
+    def get_updates(self, offset: int, limit: int, timeout: float) -> List[dict]:
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                # Updates below offset are confirmed and can be forgotten
+                while self._updates and self._updates[0]["update_id"] < offset:
+                    self._updates.popleft()
+                if self._updates:
+                    return list(itertools.islice(self._updates, limit))
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                self._cond.wait(remaining)
+
+    def flooded(self) -> bool:
+        with self._cond:
+            return self.flood_rate > 0 and self._rng.random() < self.flood_rate
+
+    def record(self, method: str):
+        with self._cond:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+
+def _message(api: FakeBotAPI, params: Dict[str, Any], message_id: Optional[int] = None) -> dict:
+    chat_id = int(params["chat_id"])
+    message = {
+        "message_id": message_id or api.next_message_id(),
+        "from": BOT_USER,
+        "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"},
+        "date": int(time.time()),
+        "text": params.get("text", ""),
+    }
+    if params.get("reply_markup"):
+        message["reply_markup"] = params["reply_markup"]
+    return message
+
+
+class FakeBotAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # headers and body are separate writes on a keep-alive socket
+    server: FakeBotAPI
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def _params(self) -> Dict[str, Any]:
+        parts = urlsplit(self.path)
+        params: Dict[str, Any] = dict(parse_qsl(parts.query))
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        content_type = self.headers.get("Content-Type", "")
+        if body and content_type.startswith("application/json"):
+            params.update(json.loads(body))
+        elif body and content_type.startswith("application/x-www-form-urlencoded"):
+            params.update(parse_qsl(body.decode("utf-8")))
+        # Multipart uploads (sendDocument) are accepted without being parsed
+        if isinstance(params.get("reply_markup"), str):
+            params["reply_markup"] = json.loads(params["reply_markup"])
+        return params
+
+    def _handle(self):
+        api = self.server
+        segments = urlsplit(self.path).path.strip("/").split("/")
+        if len(segments) != 2 or not segments[0].startswith("bot"):
+            self._send(404, {"ok": False, "error_code": 404, "description": "Not Found"})
+            return
+        method = segments[1]
+        params = self._params()
+        api.record(method)
+        if method in REPLY_METHODS and api.flooded():
+            self._send(429, {"ok": False, "error_code": 429,
+                             "description": f"Too Many Requests: retry after {api.retry_after}",
+                             "parameters": {"retry_after": api.retry_after}})
+            return
+
+        if method == "getMe":
+            result: Any = BOT_USER
+        elif method == "getUpdates":
+            result = api.get_updates(int(params.get("offset") or 0), int(params.get("limit") or 100),
+                                     float(params.get("timeout") or 0))
+        elif method == "sendMessage":
+            result = _message(api, params)
+        elif method == "editMessageText":
+            result = _message(api, params, int(params["message_id"])) if "chat_id" in params else True
+        else:
+            result = True
+        if method in REPLY_METHODS and api.on_call is not None:
+            api.on_call(method, params, result)
+        self._send(200, {"ok": True, "result": result})
+
+    def _send(self, status: int, payload: dict):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,54 @@
+"""Cold-start budget for importing the model layer.
+
+Imports ``backend`` in a fresh interpreter under ``python -X importtime``
+from an empty working directory. It fails (exit status 1) if the cumulative
+import time exceeds the budget, or if the import created any file, which
+would mean it touched the database or the log.
+
+    python -m benchmarks.importtime [--budget-ms 50] [--runs 5]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(module: str) -> float:
+    """Cumulative import time of ``module`` in milliseconds, from a fresh interpreter."""
+    with tempfile.TemporaryDirectory(prefix="marks-import-") as cwd:
+        env = dict(os.environ, PYTHONPATH=REPO, PYTHONDONTWRITEBYTECODE="1")
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                                cwd=cwd, env=env, capture_output=True, text=True, check=True)
+        leftovers = os.listdir(cwd)
+        if leftovers:
+            raise SystemExit(f"importing {module} created files: {', '.join(sorted(leftovers))}")
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        parts = [part.strip() for part in line.split("|")]
+        if len(parts) == 3 and parts[2] == module:
+            return int(parts[1]) / 1000.0
+    raise SystemExit(f"no importtime entry for {module}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--module", default="backend")
+    parser.add_argument("--budget-ms", type=float, default=50.0)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    timings = sorted(measure(args.module) for _ in range(args.runs))
+    best, median = timings[0], timings[len(timings) // 2]
+    print(f"import {args.module}: best {best:.1f}ms, median {median:.1f}ms (budget {args.budget_ms:.0f}ms)")
+    # Compare the best run so a noisy neighbour doesn't fail the check
+    if best > args.budget_ms:
+        print("over budget")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
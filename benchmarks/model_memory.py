@@ -0,0 +1,97 @@
+"""Memory and time to materialize a large grade history in each read shape.
+
+Compares, for one user with a long history:
+
+- dict-backed objects (how ``Grade`` was built before it used ``__slots__``),
+- ``Grade.get_grades_by_user`` (slotted model objects),
+- ``Grade.get_grade_records`` (named tuples),
+- ``Grade.get_grade_columns`` (one tuple per requested column).
+
+Memory is what the returned list keeps alive, measured with tracemalloc;
+peak includes the temporary row tuples sqlite3 hands back.
+
+    python -m benchmarks.model_memory [--grades 100000]
+"""
+
+import argparse
+import random
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+from benchmarks.common import backend, temp_database
+
+
+class DictGrade(object):
+    """The pre-``__slots__`` Grade: every instance carries a ``__dict__``."""
+
+    def __init__(self, id_=None, user_id=None, subject_id=None, value=None, grade_type="", date_=None,
+                 term_id=None, confirmed=False):
+        self.id = id_
+        self.user_id = user_id
+        self.subject_id = subject_id
+        self.value = value
+        self.grade_type = grade_type
+        self.date = date_
+        self.term_id = term_id
+        self.confirmed = confirmed
+
+
+def _dict_grades(user_id: int):
+    rows = backend.Grade._select(backend.GRADE_COLUMNS, user_id, None, None)
+    return [DictGrade(id_=row[0], user_id=row[1], subject_id=row[2], value=row[3],
+                      grade_type=row[4], date_=row[5], term_id=row[6], confirmed=row[7]) for row in rows]
+
+
+def _measure(load):
+    load()  # warm the statement cache and page cache
+    start = time.perf_counter()
+    load()
+    elapsed = time.perf_counter() - start  # timed without tracemalloc's overhead
+    tracemalloc.start()
+    result = load()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return elapsed, current, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--grades", type=int, default=100000)
+    parser.add_argument("--subjects", type=int, default=12)
+    args = parser.parse_args()
+
+    user_id = 1000
+    rng = random.Random(1)
+    with temp_database():
+        backend.User(tg_id=user_id, name="bench").sign_up()
+        subject_ids = []
+        for i in range(args.subjects):
+            subject = backend.Subject(user_id=user_id, name=f"Subject {i}")
+            subject.save()
+            subject_ids.append(subject.id)
+        with backend.db.shard(user_id).transaction() as cursor:
+            cursor.executemany(
+                "INSERT INTO grades (user_id, subject_id, value, grade_type, date, term_id, confirmed) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                ((user_id, rng.choice(subject_ids), rng.randint(1, 12), "regular",
+                  date(2015, 9, 1) + timedelta(days=rng.randrange(3650)), None, False)
+                 for _ in range(args.grades)))
+
+        shapes = [
+            ("dict-backed objects (before)", lambda: _dict_grades(user_id)),
+            ("Grade.get_grades_by_user (__slots__)", lambda: backend.Grade.get_grades_by_user(user_id)),
+            ("Grade.get_grade_records", lambda: backend.Grade.get_grade_records(user_id)),
+            ("Grade.get_grade_columns(value, date)",
+             lambda: backend.Grade.get_grade_columns(user_id, ("value", "date"))),
+        ]
+        print(f"{args.grades} grades")
+        for label, load in shapes:
+            elapsed, current, peak = _measure(load)
+            print(f"{label:<40} {elapsed * 1000:8.1f} ms  {current / args.grades:7.1f} B/grade retained  "
+                  f"peak {peak / 1024 / 1024:7.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""Latency of every model method against a synthetic dataset, with baseline comparison.
+
+Builds a temporary database from ``benchmarks.datagen`` and times each model
+method over users picked by a seeded RNG, so runs with the same arguments
+issue the same calls. "(cold)" rows clear the per-user caches before every
+call; the others are served from them where the model caches at all. Write
+scenarios run last so reads see only the generated data.
+
+    python -m benchmarks.models [--users N] [--subjects M] [--grades K] [--terms T]
+                                [--calls C] [--save results.json] [--baseline results.json]
+
+With ``--baseline`` each scenario's p50/p95 is compared against the saved run
+and the exit status is 1 if any of them is slower by more than ``--tolerance``.
+"""
+
+import argparse
+import json
+import platform
+import random
+import sqlite3 as sql
+import sys
+from datetime import date, timedelta
+from typing import Callable, List, Tuple
+
+from benchmarks.common import backend, print_row, summarize, temp_database, time_calls
+from benchmarks.datagen import FIRST_TERM_START, TERM_DAYS, Dataset, DatasetSpec, generate
+
+COMPARED = ("p50_us", "p95_us")
+
+
+def _clear_caches():
+    backend.subject_cache.clear()
+    backend.term_cache.clear()
+
+
+def _scenarios(data: Dataset, rng: random.Random) -> List[Tuple[str, Callable[[], object]]]:
+    """(label, call) pairs; each call picks its own user so consecutive calls spread across users."""
+    n = len(data.user_ids)
+
+    def pick():
+        i = rng.randrange(n)
+        subjects = data.subject_ids[i]
+        terms = data.term_ids[i]
+        return (data.user_ids[i], subjects[rng.randrange(len(subjects))] if subjects else None,
+                terms[rng.randrange(len(terms))] if terms else None)
+
+    def day():
+        return FIRST_TERM_START + timedelta(days=rng.randrange(data.spec.terms * TERM_DAYS or 1))
+
+    def cold(fn):
+        def call():
+            _clear_caches()
+            return fn()
+        return call
+
+    def read(fn):
+        return lambda: fn(*pick())
+
+    new_users = iter(range(1, 1 << 62))
+
+    reads = [
+        ("User.get_user_by_telegram_id", read(lambda u, s, t: backend.User.get_user_by_telegram_id(u))),
+        ("Subject.get_subjects_by_user", read(lambda u, s, t: backend.Subject.get_subjects_by_user(u))),
+        ("Subject.get_subjects_by_user (cold)",
+         cold(read(lambda u, s, t: backend.Subject.get_subjects_by_user(u)))),
+        ("Subject.get_subject_records", read(lambda u, s, t: backend.Subject.get_subject_records(u))),
+        ("Subject.get_subject_by_id", read(lambda u, s, t: backend.Subject.get_subject_by_id(s, u))),
+        ("Subject.get_names_by_user", read(lambda u, s, t: backend.Subject.get_names_by_user(u))),
+        ("Grade.get_grades_by_user", read(lambda u, s, t: backend.Grade.get_grades_by_user(u))),
+        ("Grade.get_grades_by_user(subject)",
+         read(lambda u, s, t: backend.Grade.get_grades_by_user(u, subject_id=s))),
+        ("Grade.get_grades_by_user(term)", read(lambda u, s, t: backend.Grade.get_grades_by_user(u, term_id=t))),
+        ("Grade.get_grade_records", read(lambda u, s, t: backend.Grade.get_grade_records(u))),
+        ("Grade.get_grade_columns(value)",
+         read(lambda u, s, t: backend.Grade.get_grade_columns(u, ("value",)))),
+        ("Grade.get_grade_rows", read(lambda u, s, t: backend.Grade.get_grade_rows(u))),
+        ("Grade.get_grade_rows(subject)", read(lambda u, s, t: backend.Grade.get_grade_rows(u, subject_id=s))),
+        ("Grade.iter_export_rows", read(lambda u, s, t: list(backend.Grade.iter_export_rows(u)))),
+        ("Grade.get_grade_page", read(lambda u, s, t: backend.Grade.get_grade_page(u))),
+        ("Grade.get_grade_page(subject)", read(lambda u, s, t: backend.Grade.get_grade_page(u, subject_id=s))),
+        ("Grade.count_by_user", read(lambda u, s, t: backend.Grade.count_by_user(u))),
+        ("Grade.averages_by_user", read(lambda u, s, t: backend.Grade.averages_by_user(u))),
+        ("Grade.averages_by_user(term)", read(lambda u, s, t: backend.Grade.averages_by_user(u, term_id=t))),
+        ("Term.get_terms_by_user", read(lambda u, s, t: backend.Term.get_terms_by_user(u))),
+        ("Term.get_term_records", read(lambda u, s, t: backend.Term.get_term_records(u))),
+        ("Term.get_current_term", read(lambda u, s, t: backend.Term.get_current_term(u))),
+        ("Term.get_current_term (cold)", cold(read(lambda u, s, t: backend.Term.get_current_term(u)))),
+        ("Term.find_term", read(lambda u, s, t: backend.Term.find_term(u, day()))),
+        ("Term.find_term_ids(50 days)",
+         read(lambda u, s, t: backend.Term.find_term_ids(u, [day() for _ in range(50)]))),
+    ]
+    writes = [
+        ("Grade.save", read(lambda u, s, t: backend.Grade(user_id=u, subject_id=s, value=rng.randint(1, 12),
+                                                          grade_type="regular", date_=day(), term_id=t).save())),
+        ("Subject.save", read(lambda u, s, t: backend.Subject(user_id=u, name="Extra").save())),
+        ("Term.save", read(lambda u, s, t: backend.Term(user_id=u, name="Extra", start_date=date(2030, 1, 1),
+                                                        end_date=date(2030, 2, 1)).save())),
+        ("User.sign_up", lambda: backend.User(tg_id=next(new_users), name="New").sign_up()),
+    ]
+    return reads + writes
+
+
+def _compare(results: dict, baseline: dict, tolerance: float) -> int:
+    """Print the change against ``baseline`` and return the number of regressions."""
+    regressions = 0
+    if baseline.get("spec") != results["spec"]:
+        print("warning: baseline was recorded with a different dataset spec")
+    print(f"\n{'scenario':<40} {'metric':<7} {'baseline':>10} {'now':>10} {'change':>8}")
+    for label, stats in results["results"].items():
+        old = baseline.get("results", {}).get(label)
+        if old is None:
+            print(f"{label:<40} (new)")
+            continue
+        for metric in COMPARED:
+            before, now = old[metric], stats[metric]
+            change = (now - before) / before if before else 0.0
+            flag = ""
+            if change > tolerance:
+                flag = "  REGRESSION"
+                regressions += 1
+            print(f"{label:<40} {metric[:-3]:<7} {before:9.1f}us {now:9.1f}us {change:+7.0%}{flag}")
+    return regressions
+
+
+def main():
+    defaults = DatasetSpec()
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=defaults.users)
+    parser.add_argument("--subjects", type=int, default=defaults.subjects)
+    parser.add_argument("--grades", type=int, default=defaults.grades, help="grades per user and subject")
+    parser.add_argument("--terms", type=int, default=defaults.terms)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    parser.add_argument("--calls", type=int, default=1000)
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--save", metavar="PATH", help="write results as JSON")
+    parser.add_argument("--baseline", metavar="PATH", help="compare against a saved JSON run")
+    parser.add_argument("--tolerance", type=float, default=0.20, help="allowed slowdown (default 0.20 = 20%%)")
+    args = parser.parse_args()
+
+    spec = DatasetSpec(args.users, args.subjects, args.grades, args.terms, args.seed)
+    results = {
+        "spec": spec._asdict(),
+        "calls": args.calls,
+        "python": platform.python_version(),
+        "sqlite": sql.sqlite_version,
+        "results": {},
+    }
+    with temp_database():
+        data = generate(spec)
+        print(f"dataset: {spec.users} users x {spec.subjects} subjects x {spec.grades} grades "
+              f"x {spec.terms} terms ({spec.users * spec.subjects * spec.grades} grades)")
+        rng = random.Random(spec.seed)
+        for label, call in _scenarios(data, rng):
+            time_calls(call, args.warmup)
+            stats = summarize(time_calls(call, args.calls))
+            results["results"][label] = stats
+            print_row(label, stats)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"\nSaved results to {args.save}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = _compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n{regressions} metric(s) slower than baseline by more than {args.tolerance:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
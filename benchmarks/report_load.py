@@ -0,0 +1,93 @@
+"""Interactive write latency while reports run against the same database.
+
+One writer thread saves a grade every ``--interval`` seconds, the way
+/add_grade does, and records how long each ``Grade.save`` takes. Meanwhile
+``--reporters`` threads run reports over one user with ``--grades`` grades
+on the read-only connections (``Database.reader()``): either a full
+``iter_export_rows`` pass plus ``averages_by_user`` in autocommit, or the same
+work inside one ``snapshot()``. Each run is repeated for the legacy
+rollback-journal profile, where a reader's shared lock holds up every commit,
+and for the tuned WAL profile, where it should not.
+
+    python -m benchmarks.report_load [--grades 200000] [--reporters 2] [--seconds 3]
+"""
+
+import argparse
+import threading
+import time
+from datetime import date, timedelta
+
+from benchmarks.common import backend, print_row, summarize, temp_database
+from benchmarks.concurrency import PROFILES
+
+REPORT_USER = 1
+WRITE_USER = 2
+
+
+def _seed(grades: int):
+    start = date(2020, 9, 1)
+    for user_id in (REPORT_USER, WRITE_USER):
+        backend.User(tg_id=user_id, name=f"user{user_id}").sign_up()
+        backend.Subject(user_id=user_id, name="Subject").save()
+    subject_id = backend.Subject.get_subject_records(REPORT_USER)[0].id
+    backend.Grade.insert_many(REPORT_USER, ((subject_id, 1 + i % 12, "regular", start + timedelta(days=i % 700),
+                                             None, False) for i in range(grades)))
+
+
+def _report(snapshot: bool) -> int:
+    def work():
+        rows = sum(1 for _ in backend.Grade.iter_export_rows(REPORT_USER))
+        backend.Grade.averages_by_user(REPORT_USER)
+        return rows
+    if not snapshot:
+        return work()
+    with backend.db.shard(REPORT_USER).reader().snapshot():
+        return work()
+
+
+def _run(reporters: int, snapshot: bool, seconds: float, interval: float):
+    stop = time.perf_counter() + seconds
+    reports = []
+    subject_id = backend.Subject.get_subject_records(WRITE_USER)[0].id
+
+    def reporter():
+        while time.perf_counter() < stop:
+            _report(snapshot)
+            reports.append(1)
+
+    threads = [threading.Thread(target=reporter) for _ in range(reporters)]
+    for thread in threads:
+        thread.start()
+    latencies = []
+    while time.perf_counter() < stop:
+        started = time.perf_counter()
+        backend.Grade(user_id=WRITE_USER, subject_id=subject_id, value=10, grade_type="regular",
+                      date_=date.today()).save()
+        latencies.append(time.perf_counter() - started)
+        time.sleep(interval)
+    for thread in threads:
+        thread.join()
+    return latencies, len(reports)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--grades", type=int, default=200_000, help="grades of the user being reported on")
+    parser.add_argument("--reporters", type=int, default=2, help="threads running reports")
+    parser.add_argument("--seconds", type=float, default=3.0, help="duration of each run")
+    parser.add_argument("--interval", type=float, default=0.005, help="pause between writes")
+    args = parser.parse_args()
+
+    for name, profile in PROFILES.items():
+        with temp_database(profile):
+            _seed(args.grades)
+            for label, reporters, snapshot in (("idle", 0, False), ("reports", args.reporters, False),
+                                               ("reports in snapshots", args.reporters, True)):
+                latencies, reports = _run(reporters, snapshot, args.seconds, args.interval)
+                print_row(f"{name:<6} {label}", summarize(latencies))
+                if reporters:
+                    print(f"{'':<7}{reports} reports of {args.grades} grades in {args.seconds:.0f}s")
+
+
+if __name__ == "__main__":
+    main()
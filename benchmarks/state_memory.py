@@ -0,0 +1,92 @@
+"""Memory per conversation session and expiry sweep cost of the state stores.
+
+Compares the old process-global dict of dicts with MemoryStateStore (compact
+serialized payloads) and SqliteStateStore (bytes on disk), then times expiry
+sweeps, reporting the longest single batch since that is how long a handler
+could wait on the store's lock or write transaction.
+
+    python -m benchmarks.state_memory [--sessions 100000]
+"""
+
+import argparse
+import os
+import time
+import tracemalloc
+from datetime import date
+
+from benchmarks.common import backend, temp_database
+from state_store import MemoryStateStore, SqliteStateStore
+
+
+def _session(i: int) -> dict:
+    kind = i % 3
+    if kind == 0:
+        return {'state': 'waiting_grade_value', 'subject_id': i}
+    if kind == 1:
+        return {'state': 'waiting_term_end', 'term_name': f"Term {i % 8}", 'start_date': date(2024, 9, 1)}
+    return {'state': 'waiting_subject_name'}
+
+
+def _traced(fill) -> int:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    keep = fill()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del keep
+    return after - before
+
+
+def _time_sweep(store, batch: int):
+    longest = 0.0
+    start = time.perf_counter()
+    while True:
+        t = time.perf_counter()
+        removed = store.sweep(batch)
+        longest = max(longest, time.perf_counter() - t)
+        if removed < batch:
+            break
+    return time.perf_counter() - start, longest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=100000)
+    parser.add_argument("--batch", type=int, default=500)
+    args = parser.parse_args()
+    n = args.sessions
+
+    def fill_dict():
+        states = {}
+        for i in range(n):
+            states[i] = _session(i)
+        return states
+
+    def fill_memory():
+        store = MemoryStateStore(ttl=0.0, max_sessions=n)
+        for i in range(n):
+            store[i] = _session(i)
+        return store
+
+    print(f"dict of dicts:      {_traced(fill_dict) / n:8.1f} bytes/session")
+    print(f"MemoryStateStore:   {_traced(fill_memory) / n:8.1f} bytes/session")
+
+    store = fill_memory()  # ttl=0: everything is already expired
+    total, longest = _time_sweep(store, args.batch)
+    print(f"memory sweep:       {total * 1000:8.1f} ms total, longest batch {longest * 1000:.2f} ms")
+
+    with temp_database() as path:
+        backend.init_database()
+        store = SqliteStateStore(backend.db, ttl=0.0)
+        base = os.path.getsize(path)
+        with backend.db.transaction():
+            for i in range(n):
+                store[i] = _session(i)
+        backend.db.connection().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        print(f"SqliteStateStore:   {(os.path.getsize(path) - base) / n:8.1f} bytes/session on disk")
+        total, longest = _time_sweep(store, args.batch)
+        print(f"sqlite sweep:       {total * 1000:8.1f} ms total, longest batch {longest * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""Per-chat ordered, cross-chat parallel dispatch of Telegram updates."""
+
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import backend
+
+_STOP = object()
+
+
+MESSAGE_KINDS = ("message", "edited_message", "channel_post", "edited_channel_post")
+EVENT_KINDS = ("inline_query", "chosen_inline_result", "shipping_query", "pre_checkout_query",
+               "my_chat_member", "chat_member", "chat_join_request")
+
+
+def chat_id_of(update) -> Optional[int]:
+    """The chat an update belongs to, or None for updates without one."""
+    for name in MESSAGE_KINDS:
+        message = getattr(update, name, None)
+        if message is not None:
+            return message.chat.id
+    call = getattr(update, "callback_query", None)
+    if call is not None:
+        if call.message is not None:
+            return call.message.chat.id
+        return call.from_user.id
+    for name in EVENT_KINDS:
+        event = getattr(update, name, None)
+        if event is not None:
+            chat = getattr(event, "chat", None)
+            return chat.id if chat is not None else event.from_user.id
+    return None
+
+
+def chat_id_of_json(update: Dict[str, Any]) -> Optional[int]:
+    """``chat_id_of`` for an update still in its JSON form, as returned by getUpdates."""
+    for name in MESSAGE_KINDS:
+        message = update.get(name)
+        if message is not None:
+            return message["chat"]["id"]
+    call = update.get("callback_query")
+    if call is not None:
+        if call.get("message") is not None:
+            return call["message"]["chat"]["id"]
+        return call["from"]["id"]
+    for name in EVENT_KINDS:
+        event = update.get(name)
+        if event is not None:
+            chat = event.get("chat")
+            return chat["id"] if chat is not None else event["from"]["id"]
+    return None
+
+
+class ShardStats(object):
+    """Counters for one shard; wait time is measured from submit() to the start of handling."""
+
+    def __init__(self):
+        self.processed = 0
+        self.errors = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.handle_total = 0.0
+
+
+class ChatDispatcher(object):
+    """Runs ``handle(update)`` on N worker threads, sharded by chat id.
+
+    All updates of one chat land on the same shard queue and are handled
+    strictly in arrival order; different chats proceed in parallel. With
+    ``max_queue`` > 0, ``submit()`` blocks while the target shard is full,
+    pushing back on whoever is feeding updates.
+    """
+
+    def __init__(self, handle: Callable[[Any], None], shards: int = 4, max_queue: int = 0):
+        self.handle = handle
+        self.shards = max(1, shards)
+        self._queues: List["queue.Queue"] = [queue.Queue(maxsize=max_queue) for _ in range(self.shards)]
+        self._stats = [ShardStats() for _ in range(self.shards)]
+        self._lock = threading.Lock()
+        self._threads = [threading.Thread(target=self._run, args=(i,), name=f"dispatch-{i}", daemon=True)
+                         for i in range(self.shards)]
+        for thread in self._threads:
+            thread.start()
+
+    def shard_for(self, chat_id: Optional[int]) -> int:
+        return 0 if chat_id is None else chat_id % self.shards
+
+    def submit(self, update):
+        self._queues[self.shard_for(chat_id_of(update))].put((time.monotonic(), update))
+
+    def submit_all(self, updates: List[Any]):
+        for update in updates:
+            self.submit(update)
+
+    def _run(self, shard: int):
+        shard_queue = self._queues[shard]
+        stats = self._stats[shard]
+        while True:
+            item = shard_queue.get()
+            if item is _STOP:
+                return
+            enqueued, update = item
+            started = time.monotonic()
+            try:
+                self.handle(update)
+                failed = False
+            except Exception as e:
+                backend.log(f"Dispatcher shard {shard}: handler failed: {e!r}")
+                failed = True
+            finished = time.monotonic()
+            wait = started - enqueued
+            with self._lock:
+                stats.processed += 1
+                stats.errors += failed
+                stats.wait_total += wait
+                stats.wait_max = max(stats.wait_max, wait)
+                stats.handle_total += finished - started
+
+    def metrics(self) -> List[Dict[str, float]]:
+        """Per-shard queue depth, throughput and wait/handle times (milliseconds)."""
+        result = []
+        with self._lock:
+            for shard, stats in enumerate(self._stats):
+                processed = stats.processed or 1
+                result.append({
+                    "shard": shard,
+                    "depth": self._queues[shard].qsize(),
+                    "processed": stats.processed,
+                    "errors": stats.errors,
+                    "wait_avg_ms": stats.wait_total / processed * 1000.0,
+                    "wait_max_ms": stats.wait_max * 1000.0,
+                    "handle_avg_ms": stats.handle_total / processed * 1000.0,
+                })
+        return result
+
+    def stop(self, timeout: float = 10.0):
+        """Let the shards finish their queued updates, then stop the workers."""
+        for shard_queue in self._queues:
+            shard_queue.put(_STOP)
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+
+
+def attach(bot, shards: int, max_queue: int = 0) -> ChatDispatcher:
+    """Route ``bot.process_new_updates`` through a ChatDispatcher.
+
+    ``bot`` should be built with ``threaded=False`` so each update is handled
+    on the shard thread that dequeued it, in order.
+    """
+    process = bot.process_new_updates
+    dispatcher = ChatDispatcher(lambda update: process([update]), shards=shards, max_queue=max_queue)
+
+    def submit_all(updates):
+        # telebot advances the getUpdates offset inside process_new_updates; without this the
+        # poller would fetch updates again while they still wait in a shard queue
+        for update in updates:
+            if update.update_id > bot.last_update_id:
+                bot.last_update_id = update.update_id
+        dispatcher.submit_all(updates)
+
+    bot.process_new_updates = submit_all
+    return dispatcher
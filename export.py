@@ -0,0 +1,108 @@
+"""Grade export (/export) to CSV or XLSX documents.
+
+Rows come from ``Grade.iter_export_rows``, which streams them off an open
+cursor on a read-only connection (see ``backend.ReadOnlyDatabase``), so a
+long export never holds up writes. They are written straight into a
+temporary file, so memory use does not grow with the length of the history.
+The file is built and uploaded on a small pool of export threads. The
+handler only queues the job and returns.
+
+XLSX needs the optional ``openpyxl`` package (``pip install openpyxl``),
+used in write-only mode so rows are not kept in memory either.
+"""
+
+import csv
+import io
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from typing import IO, Iterable, Set
+
+import backend
+
+FORMATS = ("csv", "xlsx")
+HEADER = ("Date", "Subject", "Grade", "Type", "Term", "Confirmed")
+
+
+def _cells(rows: Iterable[tuple]) -> Iterable[tuple]:
+    for day, subject, value, grade_type, term, confirmed in rows:
+        yield day, subject or "", value, grade_type or "", term or "", "yes" if confirmed else "no"
+
+
+def write_csv(rows: Iterable[tuple], out: IO[bytes]) -> int:
+    """Write the export as CSV into the binary file ``out``; returns the number of grades."""
+    # utf-8-sig so spreadsheet apps detect the encoding of non-ASCII subject names
+    text = io.TextIOWrapper(out, encoding="utf-8-sig", newline="")
+    writer = csv.writer(text)
+    writer.writerow(HEADER)
+    count = 0
+    for cells in _cells(rows):
+        writer.writerow(cells)
+        count += 1
+    text.flush()
+    text.detach()  # leave ``out`` open for the caller
+    return count
+
+
+def write_xlsx(rows: Iterable[tuple], out: IO[bytes]) -> int:
+    """Write the export as an XLSX workbook into ``out``; requires openpyxl."""
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Grades")
+    sheet.append(HEADER)
+    count = 0
+    for cells in _cells(rows):
+        sheet.append(cells)
+        count += 1
+    workbook.save(out)
+    return count
+
+
+def xlsx_available() -> bool:
+    try:
+        import openpyxl  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+WRITERS = {"csv": write_csv, "xlsx": write_xlsx}
+
+
+class Exporter(object):
+    """Builds and sends exports on ``workers`` background threads, one job per chat at a time."""
+
+    def __init__(self, workers: int = 2):
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="export")
+        self._lock = threading.Lock()
+        self._running: Set[int] = set()
+
+    def submit(self, bot, chat_id: int, user_id: int, fmt: str = "csv") -> bool:
+        """Queue an export; returns False if one is already running for ``chat_id``."""
+        with self._lock:
+            if chat_id in self._running:
+                return False
+            self._running.add(chat_id)
+        self._executor.submit(self._run, bot, chat_id, user_id, fmt)
+        return True
+
+    def _run(self, bot, chat_id: int, user_id: int, fmt: str):
+        try:
+            with tempfile.TemporaryFile() as out:
+                count = WRITERS[fmt](backend.Grade.iter_export_rows(user_id), out)
+                out.seek(0)
+                bot.send_document(chat_id, out, visible_file_name=f"grades-{date.today()}.{fmt}",
+                                  caption=f"{count} grades")
+            backend.log(f"Exported {count} grades for {user_id} as {fmt}")
+        except Exception as e:
+            backend.log(f"Export for {user_id} failed: {e!r}")
+            bot.send_message(chat_id, "Export failed, please try again later.")
+        finally:
+            with self._lock:
+                self._running.discard(chat_id)
+
+    def stop(self):
+        """Finish the queued exports."""
+        self._executor.shutdown(wait=True)
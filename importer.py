@@ -0,0 +1,211 @@
+"""Bulk grade import (/import and ``manage.py import``) from CSV or JSON.
+
+CSV files use the columns ``/export`` writes (Date, Subject, Grade, Type,
+Confirmed; Term is ignored), matched by header name in any order and case.
+JSON files hold a list of objects with the same keys, or ``{"grades": [...]}``.
+Only Date, Subject and Grade are required.
+
+Rows are validated one by one. A malformed row is reported with its line
+(CSV) or position (JSON) and skipped, and the rest of the file still goes in.
+Valid rows are inserted ``chunk`` at a time, each chunk in one transaction:
+the chunk's subjects are resolved by name (missing ones are created), term
+ids are assigned by date from the user's ``TermIndex``, and the grades go in
+with a single ``executemany``. A file that stops being readable partway
+(bad encoding, broken CSV quoting) keeps the rows read before that point;
+the result says where reading stopped, so a retry can start from there.
+"""
+
+import csv
+import io
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from typing import IO, Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+import backend
+
+FORMATS = ("csv", "json")
+# Telegram does not let bots download larger files
+MAX_FILE_SIZE = 20 * 1024 * 1024
+MAX_REPORTED_ERRORS = 10
+
+_COLUMNS = {"date": "date", "subject": "subject", "grade": "value", "value": "value",
+            "type": "grade_type", "grade_type": "grade_type", "confirmed": "confirmed"}
+_TRUE = ("1", "yes", "y", "true")
+_FALSE = ("", "0", "no", "n", "false")
+
+
+class RowError(NamedTuple):
+    line: int
+    message: str
+
+
+class ImportResult(NamedTuple):
+    imported: int
+    subjects_created: int
+    errors: List[RowError]  # the first ``max_errors`` of them
+    error_count: int
+    unreadable: Optional[RowError] = None  # the last row read before the file became unreadable, and why
+
+
+def detect_format(filename: str) -> Optional[str]:
+    extension = filename.rsplit(".", 1)[-1].lower() if "." in filename else ""
+    return extension if extension in FORMATS else None
+
+
+def read_csv(data: IO[bytes]) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    """(line number, fields) for every row of a CSV file, keyed by the lower-cased header."""
+    # utf-8-sig also reads the BOM /export writes
+    text = io.TextIOWrapper(data, encoding="utf-8-sig", newline="")
+    try:
+        reader = csv.reader(text)
+        header = [name.strip().lower() for name in next(reader, [])]
+        for row in reader:
+            if any(cell.strip() for cell in row):
+                yield reader.line_num, dict(zip(header, row))
+    finally:
+        text.detach()  # leave ``data`` open for the caller
+
+
+def read_json(data: IO[bytes]) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    """(position, fields) for every object in a JSON list (or ``{"grades": [...]}``)."""
+    document = json.load(data)
+    if isinstance(document, dict):
+        document = document.get("grades")
+    if not isinstance(document, list):
+        raise ValueError('expected a JSON list of grades or {"grades": [...]}')
+    for position, item in enumerate(document, 1):
+        yield position, ({str(key).lower(): value for key, value in item.items()}
+                         if isinstance(item, dict) else {})
+
+
+READERS = {"csv": read_csv, "json": read_json}
+
+
+def parse_row(fields: Dict[str, Any]) -> Tuple[str, str, int, str, bool]:
+    """Validate one row into ``(subject, date, value, grade_type, confirmed)``; raises ValueError."""
+    values = {}
+    for name, value in fields.items():
+        if name in _COLUMNS:
+            values[_COLUMNS[name]] = value
+    subject = str(values.get("subject") or "").strip()
+    if not subject:
+        raise ValueError("missing subject")
+    try:
+        day = date.fromisoformat(str(values.get("date") or "").strip()).isoformat()
+    except ValueError:
+        raise ValueError(f"invalid date {values.get('date')!r}, expected YYYY-MM-DD") from None
+    raw = values.get("value")
+    try:
+        value = int(str(raw).strip())
+    except ValueError:
+        value = None
+    if value is None or not 1 <= value <= 12:
+        raise ValueError(f"invalid grade {raw!r}, expected 1-12")
+    grade_type = str(values.get("grade_type") or "").strip() or "regular"
+    confirmed = str(values.get("confirmed", "")).strip().lower()
+    if confirmed not in _TRUE and confirmed not in _FALSE:
+        raise ValueError(f"invalid confirmed flag {values.get('confirmed')!r}, expected yes or no")
+    return subject, day, value, grade_type, confirmed in _TRUE
+
+
+def _insert_chunk(user_id: int, rows: List[Tuple[str, str, int, str, bool]]) -> Tuple[int, int]:
+    with backend.db.shard(user_id).transaction():
+        subject_ids, created = backend.Subject.resolve_names(user_id, {row[0] for row in rows})
+        term_ids = backend.Term.find_term_ids(user_id, [row[1] for row in rows])
+        imported = backend.Grade.insert_many(user_id, (
+            (subject_ids[subject.casefold()], value, grade_type, day, term_id, confirmed)
+            for (subject, day, value, grade_type, confirmed), term_id in zip(rows, term_ids)))
+    # Readers may have cached the subjects between resolve_names() and the commit
+    backend.subject_cache.invalidate(user_id)
+    return imported, created
+
+
+def import_grades(user_id: int, records: Iterable[Tuple[int, Dict[str, Any]]], chunk: int = 5000,
+                  max_errors: int = 100) -> ImportResult:
+    """Insert the valid rows of ``records`` (from ``read_csv``/``read_json``) as the user's grades."""
+    imported = created = error_count = 0
+    errors: List[RowError] = []
+    rows: List[Tuple[str, str, int, str, bool]] = []
+    unreadable = None
+    records, line = iter(records), 0
+    while True:
+        try:
+            line, fields = next(records)
+        except StopIteration:
+            break
+        except (ValueError, UnicodeDecodeError, csv.Error) as e:
+            # The rows before this point are kept: earlier chunks are already committed
+            unreadable = RowError(line, str(e))
+            break
+        try:
+            rows.append(parse_row(fields))
+        except ValueError as e:
+            error_count += 1
+            if len(errors) < max_errors:
+                errors.append(RowError(line, str(e)))
+            continue
+        if len(rows) >= chunk:
+            counts = _insert_chunk(user_id, rows)
+            imported, created = imported + counts[0], created + counts[1]
+            rows = []
+    if rows:
+        counts = _insert_chunk(user_id, rows)
+        imported, created = imported + counts[0], created + counts[1]
+    backend.log(f"Imported {imported} grades for {user_id} ({error_count} rows rejected"
+                f"{f', unreadable after {line}' if unreadable else ''})")
+    return ImportResult(imported, created, errors, error_count, unreadable)
+
+
+def format_result(result: ImportResult, label: str = "Line") -> str:
+    if result.unreadable and not result.imported and not result.error_count:
+        return f"Could not read the file: {result.unreadable.message}"
+    text = f"Imported {result.imported} grades"
+    if result.subjects_created:
+        text += f" ({result.subjects_created} new subjects)"
+    text += "."
+    if result.error_count:
+        text += f"\n{result.error_count} rows were skipped:"
+        for error in result.errors[:MAX_REPORTED_ERRORS]:
+            text += f"\n{label} {error.line}: {error.message}"
+        if result.error_count > MAX_REPORTED_ERRORS:
+            text += f"\n... and {result.error_count - MAX_REPORTED_ERRORS} more"
+    if result.unreadable:
+        text += (f"\nThe file could not be read past {label.lower()} {result.unreadable.line}: "
+                 f"{result.unreadable.message}\nEverything up to there was saved; import only the rest again.")
+    return text
+
+
+class Importer(object):
+    """Downloads and imports uploaded files on ``workers`` background threads, one job per chat at a time."""
+
+    def __init__(self, workers: int = 1):
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="import")
+        self._lock = threading.Lock()
+        self._running: Set[int] = set()
+
+    def submit(self, bot, chat_id: int, user_id: int, file_id: str, fmt: str) -> bool:
+        """Queue an import; returns False if one is already running for ``chat_id``."""
+        with self._lock:
+            if chat_id in self._running:
+                return False
+            self._running.add(chat_id)
+        self._executor.submit(self._run, bot, chat_id, user_id, file_id, fmt)
+        return True
+
+    def _run(self, bot, chat_id: int, user_id: int, file_id: str, fmt: str):
+        try:
+            data = bot.download_file(bot.get_file(file_id).file_path)
+            result = import_grades(user_id, READERS[fmt](io.BytesIO(data)))
+            bot.send_message(chat_id, format_result(result, "Line" if fmt == "csv" else "Item"))
+        except Exception as e:
+            backend.log(f"Import for {user_id} failed: {e!r}")
+            bot.send_message(chat_id, "Import failed, please try again later.")
+        finally:
+            with self._lock:
+                self._running.discard(chat_id)
+
+    def stop(self):
+        """Finish the queued imports."""
+        self._executor.shutdown(wait=True)
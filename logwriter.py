@@ -0,0 +1,123 @@
+"""Background, batched writer for the bot's log file."""
+
+import gzip
+import os
+import queue
+import shutil
+import threading
+import time
+from typing import List, Optional
+
+_STOP = object()
+
+
+class LogWriter(object):
+    """Appends log lines from a background thread.
+
+    ``write()`` only enqueues, so handlers never wait on disk I/O. The writer
+    thread buffers lines and flushes them when ``max_batch`` lines are pending
+    or the oldest pending line is ``flush_interval`` seconds old. Once the file
+    would grow past ``max_bytes`` it is rotated to ``<path>.1.gz`` (keeping
+    ``backups`` compressed generations).
+    """
+
+    def __init__(self, path: str, max_batch: int = 256, flush_interval: float = 1.0,
+                 max_bytes: int = 5 * 1024 * 1024, backups: int = 5):
+        self.path = path
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._queue: "queue.Queue" = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+        self._file = None
+
+    def write(self, line: str):
+        # Under close()'s lock: a line is either queued before _STOP or written after the final flush
+        with self._lock:
+            if self._closed:
+                self._write_batch([line])  # late messages after shutdown go straight to disk
+                return
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+                self._thread.start()
+            self._queue.put(line)
+
+    def flush(self, timeout: float = 5.0):
+        """Block until everything enqueued so far is on disk."""
+        if self._thread is None or self._closed:
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(timeout)
+
+    def close(self, timeout: float = 5.0):
+        """Flush pending lines and stop the writer thread."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            if self._thread is not None:
+                self._queue.put(_STOP)
+                self._thread.join(timeout)
+            self._close_file()
+
+    def _run(self):
+        buffer: List[str] = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is _STOP or isinstance(item, threading.Event):
+                self._write_batch(buffer)
+                buffer, deadline = [], None
+                if item is _STOP:
+                    return
+                item.set()
+                continue
+            if item is not None:
+                buffer.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+            if len(buffer) >= self.max_batch or (deadline is not None and time.monotonic() >= deadline):
+                self._write_batch(buffer)
+                buffer, deadline = [], None
+
+    def _write_batch(self, lines: List[str]):
+        if not lines:
+            return
+        data = "".join(lines)
+        try:
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8")
+            if self.max_bytes and self._file.tell() and self._file.tell() + len(data) > self.max_bytes:
+                self._rotate()
+            self._file.write(data)
+            self._file.flush()
+        except Exception as e:
+            print("Error writing logs: ", e)
+
+    def _rotate(self):
+        self._close_file()
+        for n in range(self.backups - 1, 0, -1):
+            src = f"{self.path}.{n}.gz"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{n + 1}.gz")
+        if self.backups > 0:
+            with open(self.path, "rb") as src, gzip.open(f"{self.path}.1.gz", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+        os.remove(self.path)
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def _close_file(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            except Exception:
+                pass
+            self._file = None
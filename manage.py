@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+Marks E-Daybook - maintenance commands
+
+    python manage.py migrate        Apply pending schema migrations to the configured database
+    python manage.py check-plans    Verify every model query is served by an index
+    python manage.py stats verify   Recompute grade_stats from grades and report drift
+    python manage.py stats rebuild  Recompute grade_stats from grades and store it
+    python manage.py import --user TELEGRAM_ID FILE
+                                    Bulk-import grades from a CSV or JSON file
+    python manage.py shards init N  Create (or grow) the MARKS_SHARD_MAP shard map with N database files
+    python manage.py shards status  Buckets, users and grades per shard
+    python manage.py shards rebalance
+                                    Move users until the shards hold equal shares (stop the bot first)
+"""
+
+import argparse
+import csv
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import date
+
+# Add current directory to path for imports
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import backend
+
+
+def cmd_migrate(args) -> int:
+    backend.configure_storage(backend.Config.from_env())
+    before = min(backend.db.fan_out(backend.get_schema_version))
+    backend.init_database()
+    after = min(backend.db.fan_out(backend.get_schema_version))
+    print(f"Schema version: {before} -> {after}")
+    return 0
+
+
+def _model_queries(user_id: int, subject_id: int, term_id: int):
+    """Every read the model layer issues, as (label, call) pairs."""
+    return [
+        ("User.get_user_by_telegram_id", lambda: backend.User.get_user_by_telegram_id(user_id)),
+        ("Subject.get_subjects_by_user", lambda: backend.Subject.get_subjects_by_user(user_id)),
+        ("Subject.get_subject_by_id", lambda: backend.Subject.get_subject_by_id(subject_id, user_id)),
+        ("Grade.get_grades_by_user", lambda: backend.Grade.get_grades_by_user(user_id)),
+        ("Grade.get_grades_by_user(subject)",
+         lambda: backend.Grade.get_grades_by_user(user_id, subject_id=subject_id)),
+        ("Grade.get_grades_by_user(term)",
+         lambda: backend.Grade.get_grades_by_user(user_id, term_id=term_id)),
+        ("Grade.get_grades_by_user(subject, term)",
+         lambda: backend.Grade.get_grades_by_user(user_id, subject_id=subject_id, term_id=term_id)),
+        ("Grade.get_grade_columns(subject)",
+         lambda: backend.Grade.get_grade_columns(user_id, ("value", "date"), subject_id=subject_id)),
+        ("Subject.get_names_by_user", lambda: backend.Subject.get_names_by_user(user_id)),
+        ("Subject.resolve_names", lambda: backend.Subject.resolve_names(user_id, ("Subject",))),
+        ("Grade.get_grade_rows", lambda: backend.Grade.get_grade_rows(user_id)),
+        ("Grade.get_grade_rows(subject)", lambda: backend.Grade.get_grade_rows(user_id, subject_id=subject_id)),
+        ("Grade.iter_export_rows", lambda: list(backend.Grade.iter_export_rows(user_id))),
+        ("Grade.get_grade_page", lambda: backend.Grade.get_grade_page(user_id)),
+        ("Grade.get_grade_page(before)",
+         lambda: backend.Grade.get_grade_page(user_id, before=("2020-01-01", 1 << 30))),
+        ("Grade.get_grade_page(subject, after)",
+         lambda: backend.Grade.get_grade_page(user_id, subject_id=subject_id, after=("2020-01-01", 1))),
+        ("Grade.count_by_user(before)", lambda: backend.Grade.count_by_user(user_id, before=("2020-01-01", 1))),
+        ("Grade.count_by_user(subject, before)",
+         lambda: backend.Grade.count_by_user(user_id, subject_id=subject_id, before=("2020-01-01", 1))),
+        ("Grade.averages_by_user", lambda: backend.Grade.averages_by_user(user_id)),
+        ("Grade.averages_by_user(term)", lambda: backend.Grade.averages_by_user(user_id, term_id=term_id)),
+        ("Term.get_terms_by_user", lambda: backend.Term.get_terms_by_user(user_id)),
+        ("Term.get_term_records", lambda: backend.Term.get_term_records(user_id)),
+        ("Term.get_current_term", lambda: backend.Term.get_current_term(user_id)),
+    ]
+
+
+def _unindexed_steps(conn, statement: str):
+    """Return the query plan steps that scan a table or sort without an index."""
+    bad = []
+    for row in conn.execute("EXPLAIN QUERY PLAN " + statement):
+        detail = row[-1]
+        if detail.startswith("SCAN ") and "INDEX" not in detail:
+            bad.append(detail)
+        elif "TEMP B-TREE" in detail:
+            bad.append(detail)
+    return bad
+
+
+def cmd_check_plans(args) -> int:
+    tmpdir = tempfile.mkdtemp(prefix="marks-plans-")
+    backend.db = backend.Database(os.path.join(tmpdir, "plans.db"), backend.db.profile)
+    backend.log_writer = backend.LogWriter(os.path.join(tmpdir, "logs.txt"))
+    failures = 0
+    try:
+        backend.init_database()
+        user_id = 1
+        backend.User(tg_id=user_id, name="plans").sign_up()
+        subject = backend.Subject(user_id=user_id, name="Subject")
+        subject.save()
+        term = backend.Term(user_id=user_id, name="Term", start_date=date(2000, 1, 1), end_date=date(2100, 1, 1))
+        term.save()
+
+        conn = backend.db.connection()
+        # Reporting reads run on the read-only connections
+        traced = (conn, backend.db.reader().connection())
+        for label, call in _model_queries(user_id, subject.id, term.id):
+            statements = []
+            # Make cached reads hit the database
+            backend.subject_cache.clear()
+            backend.term_cache.clear()
+            for traced_conn in traced:
+                traced_conn.set_trace_callback(statements.append)
+            try:
+                call()
+            finally:
+                for traced_conn in traced:
+                    traced_conn.set_trace_callback(None)
+            for statement in statements:
+                bad = _unindexed_steps(conn, statement)
+                status = "FAIL" if bad else "ok"
+                print(f"{status:<5}{label}")
+                for detail in bad:
+                    print(f"       {detail}")
+                failures += bool(bad)
+    finally:
+        backend.db.close()
+        backend.log_writer.close()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return 1 if failures else 0
+
+
+def cmd_stats(args) -> int:
+    backend.init_storage(backend.Config.from_env())
+    if args.action == "rebuild":
+        print(f"Rebuilt grade_stats: {backend.rebuild_grade_stats()} rows")
+        return 0
+    drift = backend.verify_grade_stats()
+    for row in drift:
+        print(f"user {row.user_id} subject {row.subject_id} term {row.term_id}: "
+              f"expected {row.expected}, stored {row.actual}")
+    print(f"{len(drift)} drifted rows" if drift else "grade_stats is consistent with grades")
+    return 1 if drift else 0
+
+
+def cmd_import(args) -> int:
+    import importer
+
+    fmt = args.format or importer.detect_format(args.file)
+    if fmt is None:
+        print(f"Cannot tell the format of {args.file}; pass --format csv or --format json", file=sys.stderr)
+        return 2
+    backend.init_storage(backend.Config.from_env())
+    start = time.perf_counter()
+    try:
+        with open(args.file, "rb") as data:
+            result = importer.import_grades(args.user, importer.READERS[fmt](data), chunk=args.chunk,
+                                            max_errors=args.max_errors)
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        print(f"Cannot read {args.file}: {e}", file=sys.stderr)
+        return 2
+    finally:
+        backend.log_writer.close()
+    elapsed = time.perf_counter() - start
+    label = "line" if fmt == "csv" else "item"
+    if result.unreadable and not result.imported and not result.error_count:
+        print(f"Cannot read {args.file}: {result.unreadable.message}", file=sys.stderr)
+        return 2
+    for error in result.errors:
+        print(f"{args.file}: {label} {error.line}: {error.message}", file=sys.stderr)
+    if result.error_count > len(result.errors):
+        print(f"... and {result.error_count - len(result.errors)} more", file=sys.stderr)
+    print(f"Imported {result.imported} grades for {args.user} in {elapsed:.2f}s "
+          f"({result.subjects_created} new subjects, {result.error_count} rows skipped)")
+    if result.unreadable:
+        print(f"Cannot read {args.file} past {label} {result.unreadable.line}: {result.unreadable.message}",
+              file=sys.stderr)
+        return 2
+    return 1 if result.error_count else 0
+
+
+def _shard_paths(database: str, count: int):
+    """``db.db``, ``db-1.db``, ``db-2.db``, ...: the existing database stays shard 0."""
+    stem, extension = os.path.splitext(database)
+    return [database] + [f"{stem}-{index}{extension}" for index in range(1, count)]
+
+
+def cmd_shards(args) -> int:
+    import sharding
+
+    config = backend.Config.from_env()
+    if not config.shard_map:
+        print("Set MARKS_SHARD_MAP to the shard map file (e.g. shards.json) first", file=sys.stderr)
+        return 2
+    if args.action == "init":
+        if not args.count or args.count < 1:
+            print("shards init needs the number of shards", file=sys.stderr)
+            return 2
+        if os.path.exists(config.shard_map):
+            shard_map = sharding.ShardMap.load(config.shard_map)
+            if args.count < len(shard_map.paths):
+                print(f"{config.shard_map} already has {len(shard_map.paths)} shards; "
+                      f"shards can be added but not removed", file=sys.stderr)
+                return 1
+            shard_map.paths.extend(_shard_paths(config.database, args.count)[len(shard_map.paths):])
+        else:
+            shard_map = sharding.ShardMap.create(_shard_paths(config.database, args.count), config.shard_map)
+        shard_map.save()
+        print(f"{config.shard_map}: {len(shard_map.paths)} shards ({', '.join(shard_map.paths)})")
+
+    backend.init_storage(config)
+    if args.action == "rebalance":
+        def report(move, users):
+            print(f"bucket {move.bucket:>3}: shard {move.source} -> {move.target} ({users} users)")
+        moves = sharding.rebalance(backend.db, report)
+        print(f"{len(moves)} buckets moved" if moves else "Shards are balanced")
+    print(f"{'shard':>5} {'buckets':>8} {'users':>9} {'grades':>11}  path")
+    for row in sharding.shard_stats(backend.db):
+        print(f"{row.shard:>5} {row.buckets:>8} {row.users:>9} {row.grades:>11}  {row.path}")
+    backend.db.close()
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Marks E-Daybook maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("migrate", help="apply pending schema migrations").set_defaults(func=cmd_migrate)
+    commands.add_parser("check-plans", help="check model queries against EXPLAIN QUERY PLAN").set_defaults(
+        func=cmd_check_plans)
+    stats = commands.add_parser("stats", help="verify or rebuild the grade_stats aggregates")
+    stats.add_argument("action", choices=["verify", "rebuild"])
+    stats.set_defaults(func=cmd_stats)
+    grades = commands.add_parser("import", help="bulk-import grades from a CSV or JSON file")
+    grades.add_argument("file")
+    grades.add_argument("--user", type=int, required=True, help="Telegram id of the grades' owner")
+    grades.add_argument("--format", choices=["csv", "json"], help="default: from the file extension")
+    grades.add_argument("--chunk", type=int, default=5000, help="rows per transaction")
+    grades.add_argument("--max-errors", type=int, default=100, help="rejected rows to list")
+    grades.set_defaults(func=cmd_import)
+    shards = commands.add_parser("shards", help="create, inspect or rebalance the database shards")
+    shards.add_argument("action", choices=["init", "status", "rebalance"])
+    shards.add_argument("count", type=int, nargs="?", help="number of shards (init)")
+    shards.set_defaults(func=cmd_shards)
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,241 @@
+"""Per-handler latency and SQL instrumentation, exported as Prometheus text.
+
+``instrument(bot, database)`` wraps every message and callback handler
+registered on ``bot`` afterwards. Each call records its latency and the
+number of SQL statements it ran and rows it fetched. The counts come from the
+handler thread's connection, through ``Database.set_observer``. Each of these
+goes into a histogram per handler. Since telebot runs one handler per update,
+the SQL counts are per update.
+
+``MetricsServer`` serves the histograms, together with the outbox, dispatcher
+and cache counters, as Prometheus text at ``/metrics``. The admin-only
+``/stats`` command shows a summary built by ``HandlerMetrics.summary()``.
+"""
+
+import bisect
+import functools
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Sequence
+
+import backend
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 250, 500, 1000, 5000)
+
+
+class Histogram(object):
+    """Cumulative-bucket histogram in the Prometheus sense; callers serialize access."""
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the ``q`` quantile (the largest bound for +Inf)."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+
+class _Scope(object):
+    __slots__ = ("statements", "rows")
+
+    def __init__(self):
+        self.statements = 0
+        self.rows = 0
+
+
+class HandlerMetrics(object):
+    """Histograms of latency, SQL statements and rows per handler."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.latency: Dict[str, Histogram] = {}
+        self.sql_statements: Dict[str, Histogram] = {}
+        self.sql_rows: Dict[str, Histogram] = {}
+        self.errors: Dict[str, int] = {}
+
+    # Database observer interface; only counts inside a timed handler
+    def statement(self, text: str):
+        scope = getattr(self._local, "scope", None)
+        if scope is not None:
+            scope.statements += 1
+
+    def rows(self, count: int):
+        scope = getattr(self._local, "scope", None)
+        if scope is not None:
+            scope.rows += count
+
+    def timed(self, handler):
+        name = getattr(handler, "__name__", "handler")
+
+        @functools.wraps(handler)
+        def timed_handler(*args, **kwargs):
+            outer = getattr(self._local, "scope", None)
+            scope = self._local.scope = _Scope()
+            start = time.perf_counter()
+            failed = False
+            try:
+                return handler(*args, **kwargs)
+            except BaseException:
+                failed = True
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                self._local.scope = outer
+                self.record(name, elapsed, scope.statements, scope.rows, failed)
+        return timed_handler
+
+    def record(self, name: str, seconds: float, statements: int, rows: int, failed: bool = False):
+        with self._lock:
+            if name not in self.latency:
+                self.latency[name] = Histogram(LATENCY_BUCKETS)
+                self.sql_statements[name] = Histogram(COUNT_BUCKETS)
+                self.sql_rows[name] = Histogram(COUNT_BUCKETS)
+                self.errors[name] = 0
+            self.latency[name].observe(seconds)
+            self.sql_statements[name].observe(statements)
+            self.sql_rows[name].observe(rows)
+            self.errors[name] += failed
+
+    def summary(self) -> List[Dict[str, float]]:
+        """One dict per handler, busiest first: calls, errors, latency quantiles (ms), mean SQL counts."""
+        with self._lock:
+            result = []
+            for name, latency in self.latency.items():
+                calls = latency.count or 1
+                result.append({
+                    "handler": name,
+                    "calls": latency.count,
+                    "errors": self.errors[name],
+                    "avg_ms": latency.sum / calls * 1000.0,
+                    "p50_ms": latency.quantile(0.5) * 1000.0,
+                    "p95_ms": latency.quantile(0.95) * 1000.0,
+                    "statements": self.sql_statements[name].sum / calls,
+                    "rows": self.sql_rows[name].sum / calls,
+                })
+        result.sort(key=lambda row: -row["calls"])
+        return result
+
+    def render(self) -> str:
+        """Prometheus text exposition of the handler histograms and the runtime counters."""
+        lines: List[str] = []
+        with self._lock:
+            for metric, help_text, histograms in (
+                    ("marks_handler_seconds", "Handler latency in seconds.", self.latency),
+                    ("marks_handler_sql_statements", "SQL statements run per handled update.", self.sql_statements),
+                    ("marks_handler_sql_rows", "Rows fetched per handled update.", self.sql_rows)):
+                lines.append(f"# HELP {metric} {help_text}")
+                lines.append(f"# TYPE {metric} histogram")
+                for name, histogram in sorted(histograms.items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                        cumulative += count
+                        lines.append(f'{metric}_bucket{{handler="{name}",le="{bound}"}} {cumulative}')
+                    lines.append(f'{metric}_sum{{handler="{name}"}} {histogram.sum}')
+                    lines.append(f'{metric}_count{{handler="{name}"}} {histogram.count}')
+            lines.append("# HELP marks_handler_errors_total Handler calls that raised.")
+            lines.append("# TYPE marks_handler_errors_total counter")
+            for name, errors in sorted(self.errors.items()):
+                lines.append(f'marks_handler_errors_total{{handler="{name}"}} {errors}')
+        lines.extend(_runtime_lines())
+        return "\n".join(lines) + "\n"
+
+
+def _runtime_lines() -> List[str]:
+    """Gauges and counters kept by the caches, the outbox and the dispatcher."""
+    lines = []
+    caches = {"subject": backend.subject_cache.stats(), "term": backend.term_cache.stats()}
+    # Samples of one metric family have to be contiguous
+    for metric, kind, key in (("marks_cache_hits_total", "counter", "hits"),
+                              ("marks_cache_misses_total", "counter", "misses"),
+                              ("marks_cache_size", "gauge", "size")):
+        lines.append(f"# TYPE {metric} {kind}")
+        for cache_name, stats in caches.items():
+            lines.append(f'{metric}{{cache="{cache_name}"}} {stats[key]}')
+    if backend.outbox is not None:
+        outbox = backend.outbox.metrics()
+        lines.append("# TYPE marks_outbox_depth gauge")
+        lines.append(f"marks_outbox_depth {outbox['depth']}")
+        lines.append("# TYPE marks_outbox_calls_total counter")
+        for outcome in ("sent", "failed", "retried"):
+            lines.append(f'marks_outbox_calls_total{{outcome="{outcome}"}} {outbox[outcome]}')
+        lines.append("# TYPE marks_outbox_wait_p95_seconds gauge")
+        lines.append(f"marks_outbox_wait_p95_seconds {outbox['wait_p95_ms'] / 1000.0}")
+    if backend.dispatcher is not None:
+        shards = backend.dispatcher.metrics()
+        for metric, kind, key in (("marks_dispatch_queue_depth", "gauge", "depth"),
+                                  ("marks_dispatch_processed_total", "counter", "processed")):
+            lines.append(f"# TYPE {metric} {kind}")
+            for shard in shards:
+                lines.append(f'{metric}{{shard="{shard["shard"]}"}} {shard[key]}')
+    return lines
+
+
+def instrument(bot, database: Optional["backend.Database"] = None) -> HandlerMetrics:
+    """Time every handler registered on ``bot`` from now on and count ``database``'s SQL per handler."""
+    handler_metrics = HandlerMetrics()
+    for name in ("message_handler", "callback_query_handler"):
+        register = getattr(bot, name)
+
+        def timed_register(*args, register=register, **kwargs):
+            decorate = register(*args, **kwargs)
+
+            def decorator(handler):
+                decorate(handler_metrics.timed(handler))
+                return handler
+            return decorator
+        setattr(bot, name, timed_register)
+    if database is not None:
+        database.set_observer(handler_metrics)
+    return handler_metrics
+
+
+class MetricsServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler_metrics: HandlerMetrics, host: str, port: int):
+        self.handler_metrics = handler_metrics
+        super().__init__((host, port), MetricsHandler)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    server: MetricsServer
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.handler_metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(handler_metrics: HandlerMetrics, host: str, port: int) -> MetricsServer:
+    """Serve ``/metrics`` from a background thread."""
+    server = MetricsServer(handler_metrics, host, port)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    backend.log(f"Metrics on http://{host}:{server.server_address[1]}/metrics")
+    return server
@@ -0,0 +1,315 @@
+"""Rate-limited outbound queue for Bot API calls.
+
+Handlers used to call ``bot.send_message`` and friends synchronously, holding a
+worker thread for the whole HTTP round trip and for any throttling Telegram
+applied. ``attach()`` replaces those methods with versions that enqueue the call
+and return immediately; a small pool of sender threads performs the calls while
+respecting Telegram's limits:
+
+- about 30 messages per second across all chats (global bucket),
+- about 1 message per second in a private chat and 20 per minute in a group
+  (one bucket per chat).
+
+Calls to the same chat are sent one at a time in submission order. A 429 reply
+puts the call back at the head of its chat queue and pauses that chat for the
+``retry_after`` seconds Telegram asks for; network errors and 5xx replies are
+retried with exponential backoff. Other API errors (blocked bot, bad request)
+are logged and dropped.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+import backend
+
+# Reasonable defaults from https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+GLOBAL_RATE = 30.0
+CHAT_RATE = 1.0
+GROUP_RATE = 20.0 / 60.0
+
+
+class TokenBucket(object):
+    """Token bucket refilled at ``rate`` tokens per second, holding at most ``capacity``.
+
+    ``reserve()`` always takes a token, going into debt if necessary, and
+    returns how long the caller must wait before using it, so concurrent
+    callers line up instead of polling. A rate of 0 disables the limit.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready_in(self, now: float) -> float:
+        """Seconds until a token is available, without taking it."""
+        if self.rate <= 0:
+            return 0.0
+        self._refill(now)
+        return 0.0 if self.tokens >= 1.0 else (1.0 - self.tokens) / self.rate
+
+    def reserve(self, now: float) -> float:
+        if self.rate <= 0:
+            return 0.0
+        self._refill(now)
+        self.tokens -= 1.0
+        return 0.0 if self.tokens >= 0.0 else -self.tokens / self.rate
+
+    def full(self, now: float) -> bool:
+        if self.rate <= 0:
+            return True
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _Call(object):
+    __slots__ = ("enqueued", "method", "args", "kwargs", "attempt")
+
+    def __init__(self, method: Callable, args: Tuple, kwargs: Dict[str, Any]):
+        self.enqueued = time.monotonic()
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.attempt = 0
+
+
+class _ChatQueue(object):
+    __slots__ = ("calls", "bucket", "active", "resume_at")
+
+    def __init__(self, bucket: TokenBucket):
+        self.calls: Deque[_Call] = deque()
+        self.bucket = bucket
+        self.active = False  # scheduled in the ready heap or being sent
+        self.resume_at = 0.0  # set from a 429's retry_after
+
+
+class Outbox(object):
+    """Sends queued Bot API calls on ``workers`` threads under global and per-chat rate limits.
+
+    Chats waiting on their own bucket do not hold a sender thread: a chat is
+    only handed to a worker once its next call may go out. With ``max_queue``
+    > 0, ``submit()`` blocks while that many calls are pending.
+    """
+
+    def __init__(self, workers: int = 4, global_rate: float = GLOBAL_RATE, chat_rate: float = CHAT_RATE,
+                 chat_burst: float = 3.0, group_rate: float = GROUP_RATE, max_queue: int = 0,
+                 max_retries: int = 5, max_idle_chats: int = 10000):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.max_idle_chats = max_idle_chats
+        # Chat count at which _prune() next runs; doubles over what a prune keeps, so pruning is amortized O(1)
+        self._prune_at = max_idle_chats
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: Dict[Optional[int], _ChatQueue] = {}
+        self._ready: List[Tuple[float, int, Optional[int]]] = []  # (due, seq, chat_id)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._depth = 0
+        self._stopping = False
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._recent_waits: Deque[float] = deque(maxlen=1024)
+        self._send_total = 0.0
+        self._threads = [threading.Thread(target=self._run, name=f"outbox-{i}", daemon=True)
+                         for i in range(max(1, workers))]
+        for thread in self._threads:
+            thread.start()
+
+    def _bucket_for(self, chat_id: Optional[int]) -> TokenBucket:
+        if chat_id is None:
+            return TokenBucket(0.0)
+        if chat_id < 0:  # groups, supergroups and channels
+            return TokenBucket(self.group_rate, 1.0)
+        return TokenBucket(self.chat_rate, self.chat_burst)
+
+    def _schedule(self, chat_id: Optional[int], chat: _ChatQueue, now: float):
+        due = max(now + chat.bucket.ready_in(now), chat.resume_at)
+        heapq.heappush(self._ready, (due, next(self._seq), chat_id))
+        self._cond.notify()
+
+    def submit(self, chat_id: Optional[int], method: Callable, *args, **kwargs):
+        """Queue ``method(*args, **kwargs)`` behind earlier calls to the same chat.
+
+        Once ``stop()`` has been called the senders may already be gone, so a
+        call to a chat with nothing queued is sent right away on this thread.
+        """
+        call = _Call(method, args, kwargs)
+        with self._cond:
+            while self.max_queue and self._depth >= self.max_queue and not self._stopping:
+                self._cond.wait()
+            chat = self._chats.get(chat_id)
+            # A chat with calls still queued keeps its sender until they are sent, so queue behind them
+            if self._stopping and (chat is None or not chat.active):
+                delay = self._global.reserve(call.enqueued)
+            else:
+                if chat is None:
+                    if len(self._chats) >= self._prune_at:
+                        self._prune(call.enqueued)
+                    chat = self._chats[chat_id] = _ChatQueue(self._bucket_for(chat_id))
+                chat.calls.append(call)
+                self._depth += 1
+                if not chat.active:
+                    chat.active = True
+                    self._schedule(chat_id, chat, call.enqueued)
+                return
+        if delay > 0:
+            time.sleep(delay)
+        try:
+            method(*args, **kwargs)
+        except Exception as e:
+            backend.log(f"Outbox: {getattr(method, '__name__', 'call')} to chat {chat_id} "
+                        f"failed during shutdown: {e!r}")
+            with self._cond:
+                self.failed += 1
+        else:
+            with self._cond:
+                self.sent += 1
+
+    def _prune(self, now: float):
+        # Forget idle chats whose bucket has refilled; they would start full anyway
+        idle = [c for c, chat in self._chats.items()
+                if not chat.active and chat.bucket.full(now) and chat.resume_at <= now]
+        for chat_id in idle:
+            del self._chats[chat_id]
+        # Chats still waiting on a bucket are kept; rescan only once the map has doubled again
+        self._prune_at = max(self.max_idle_chats, 2 * len(self._chats))
+
+    def _next(self) -> Optional[Tuple[Optional[int], _ChatQueue, _Call, float]]:
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if self._ready and self._ready[0][0] <= now:
+                    chat_id = heapq.heappop(self._ready)[2]
+                    chat = self._chats[chat_id]
+                    call = chat.calls.popleft()
+                    chat.bucket.reserve(now)
+                    return chat_id, chat, call, self._global.reserve(now)
+                if self._stopping and not self._ready:
+                    return None
+                self._cond.wait(self._ready[0][0] - now if self._ready else None)
+
+    def _run(self):
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            chat_id, chat, call, delay = item
+            if delay > 0:
+                time.sleep(delay)
+            started = time.monotonic()
+            retry_in = None
+            try:
+                call.method(*call.args, **call.kwargs)
+                outcome = "sent"
+            except Exception as e:
+                retry_in = self._retry_delay(e, call.attempt)
+                if retry_in is not None and call.attempt < self.max_retries:
+                    outcome = "retry"
+                else:
+                    outcome = "failed"
+                    backend.log(f"Outbox: {getattr(call.method, '__name__', 'call')} to chat {chat_id} "
+                                f"failed after {call.attempt + 1} attempt(s): {e!r}")
+            finished = time.monotonic()
+            with self._cond:
+                if outcome == "retry":
+                    call.attempt += 1
+                    self.retried += 1
+                    chat.calls.appendleft(call)
+                    chat.resume_at = finished + retry_in
+                else:
+                    self._depth -= 1
+                    wait = started - call.enqueued
+                    if outcome == "sent":
+                        self.sent += 1
+                        self._wait_total += wait
+                        self._wait_max = max(self._wait_max, wait)
+                        self._recent_waits.append(wait)
+                        self._send_total += finished - started
+                    else:
+                        self.failed += 1
+                    self._cond.notify_all()  # wake submitters blocked on max_queue
+                if chat.calls:
+                    self._schedule(chat_id, chat, finished)
+                else:
+                    chat.active = False
+
+    @staticmethod
+    def _retry_delay(error: Exception, attempt: int) -> Optional[float]:
+        """Seconds to wait before retrying a failed call, or None if it should be dropped."""
+        code = getattr(error, "error_code", None)
+        if code == 429:
+            result = getattr(error, "result_json", None) or {}
+            retry_after = (result.get("parameters") or {}).get("retry_after")
+            if retry_after is not None:
+                return float(retry_after)
+        elif code is not None and code < 500:
+            return None
+        # Network error, 5xx or a 429 without retry_after
+        return min(30.0, 0.5 * 2 ** attempt)
+
+    def metrics(self) -> Dict[str, float]:
+        """Queue depth, outcome counters and queue latency (enqueue to send, milliseconds)."""
+        with self._cond:
+            sent = self.sent or 1
+            waits = sorted(self._recent_waits)
+            p95 = waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else 0.0
+            return {
+                "depth": self._depth,
+                "chats": sum(1 for chat in self._chats.values() if chat.active),
+                "sent": self.sent,
+                "failed": self.failed,
+                "retried": self.retried,
+                "wait_avg_ms": self._wait_total / sent * 1000.0,
+                "wait_p95_ms": p95 * 1000.0,
+                "wait_max_ms": self._wait_max * 1000.0,
+                "send_avg_ms": self._send_total / sent * 1000.0,
+            }
+
+    def stop(self, timeout: float = 10.0):
+        """Send what is already queued (up to ``timeout``), then stop the workers."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+
+
+def attach(bot, workers: int = 4, **limits) -> Outbox:
+    """Make ``bot.send_message``, ``bot.reply_to`` and ``bot.edit_message_text`` enqueue and return None.
+
+    Handlers must not rely on the returned Message; none of ours do.
+    """
+    outbox = Outbox(workers=workers, **limits)
+    send_message = bot.send_message
+    edit_message_text = bot.edit_message_text
+
+    def queued_send_message(chat_id, text, *args, **kwargs):
+        outbox.submit(chat_id, send_message, chat_id, text, *args, **kwargs)
+
+    def queued_reply_to(message, text, **kwargs):
+        outbox.submit(message.chat.id, send_message, message.chat.id, text,
+                      reply_to_message_id=message.message_id, **kwargs)
+
+    def queued_edit_message_text(text, chat_id=None, message_id=None, *args, **kwargs):
+        outbox.submit(chat_id, edit_message_text, text, chat_id, message_id, *args, **kwargs)
+
+    bot.send_message = queued_send_message
+    bot.reply_to = queued_reply_to
+    bot.edit_message_text = queued_edit_message_text
+    return outbox
@@ -0,0 +1,293 @@
+"""Per-user sharding of the database over several SQLite files.
+
+Every user is hashed by Telegram id into one of ``BUCKETS`` buckets, and the
+shard map assigns each bucket to a shard file. The map is a JSON file named
+by ``MARKS_SHARD_MAP``::
+
+    {"shards": ["db.db", "db-1.db", ...], "buckets": [0, 1, 0, ...]}
+
+``ShardedDatabase`` stands in for ``backend.Database``. Model methods call
+``db.shard(user_id)`` and get that user's shard, so each shard has its own
+writer lock. Admin code calls ``db.fan_out(fn)``, which runs ``fn`` on every
+shard in parallel and returns the results in shard order for the caller to
+merge. A user's rows never span shards, so no query has to join across them.
+
+Shard ``i`` allocates AUTOINCREMENT ids from ``i * ID_RANGE`` upwards (see
+``backend.reserve_id_range``), so ``move_bucket`` copies rows with their ids
+unchanged. The tool is ``manage.py shards``:
+
+    init N       create the map (or grow it) with N shards; existing data stays on shard 0
+    status       buckets, users and grades per shard
+    rebalance    move buckets until every shard holds the same number of them
+
+The bot reads the map once at start-up: stop it before rebalancing.
+"""
+
+import json
+import os
+import sqlite3 as sql
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, List, NamedTuple, Optional, Set
+
+import backend
+
+BUCKETS = 256
+ID_RANGE = 1 << 40
+# Every table keyed by user, with its user column. Moves copy them in reverse order and delete in this
+# order, so users rows are the first to arrive and the last to go
+USER_TABLES = (("grades", "user_id"), ("subjects", "user_id"), ("terms", "user_id"), ("schedule", "user_id"),
+               ("conversation_states", "chat_id"), ("users", "telegram_id"))
+
+
+def bucket_of(user_id: int) -> int:
+    return zlib.crc32(int(user_id).to_bytes(8, "little", signed=True)) % BUCKETS
+
+
+class ShardMap(object):
+    """Shard file paths and the shard index of every bucket."""
+
+    def __init__(self, paths: List[str], buckets: List[int], path: Optional[str] = None):
+        if len(buckets) != BUCKETS or not paths or any(not 0 <= shard < len(paths) for shard in buckets):
+            raise ValueError(f"Invalid shard map {path or ''}: expected {BUCKETS} buckets over {len(paths)} shards")
+        self.paths = list(paths)
+        self.buckets = list(buckets)
+        self.path = path
+
+    @classmethod
+    def create(cls, paths: List[str], path: Optional[str] = None) -> 'ShardMap':
+        """A map with every bucket on the first shard, which is where an unsharded database's rows are."""
+        return cls(paths, [0] * BUCKETS, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'ShardMap':
+        with open(path) as f:
+            data = json.load(f)
+        return cls(data["shards"], data["buckets"], path)
+
+    def save(self, path: Optional[str] = None):
+        """Write the map atomically, so a crash never leaves a half-written file."""
+        self.path = path or self.path
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"shards": self.paths, "buckets": self.buckets}, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def shard_of(self, user_id: Optional[int]) -> int:
+        return 0 if user_id is None else self.buckets[bucket_of(user_id)]
+
+    def bucket_counts(self) -> List[int]:
+        counts = [0] * len(self.paths)
+        for shard in self.buckets:
+            counts[shard] += 1
+        return counts
+
+
+class ShardedDatabase(object):
+    """``backend.Database`` look-alike that routes every user to the shard the map assigns them."""
+
+    def __init__(self, shard_map: ShardMap, profile: Optional[backend.StorageProfile] = None):
+        self.map = shard_map
+        self.path = shard_map.path
+        self.profile = profile or backend.StorageProfile()
+        self.shards = [backend.Database(path, self.profile, id_base=index * ID_RANGE)
+                       for index, path in enumerate(shard_map.paths)]
+        self.observer = None
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def shard(self, user_id: Optional[int]) -> backend.Database:
+        return self.shards[self.map.shard_of(user_id)]
+
+    def fan_out(self, fn: Callable[[backend.Database], Any]) -> List[Any]:
+        """``fn(shard)`` for every shard, run in parallel; results in shard order."""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=len(self.shards), thread_name_prefix="shard")
+        return list(self._executor.map(fn, self.shards))
+
+    def set_observer(self, observer):
+        self.observer = observer
+        for shard in self.shards:
+            shard.set_observer(observer)
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+        for shard in self.shards:
+            shard.close()
+
+
+class ShardStats(NamedTuple):
+    shard: int
+    path: str
+    buckets: int
+    users: int
+    grades: int
+
+
+def shard_stats(database: ShardedDatabase) -> List[ShardStats]:
+    """Buckets, signed-up users and grades per shard, counted on all shards in parallel."""
+    counts = database.fan_out(lambda shard: (shard.fetchone("SELECT COUNT(*) FROM users")[0],
+                                             shard.fetchone("SELECT COUNT(*) FROM grades")[0]))
+    buckets = database.map.bucket_counts()
+    return [ShardStats(index, path, buckets[index], users, grades)
+            for index, (path, (users, grades)) in enumerate(zip(database.map.paths, counts))]
+
+
+class Move(NamedTuple):
+    bucket: int
+    source: int
+    target: int
+
+
+def plan_rebalance(shard_map: ShardMap) -> List[Move]:
+    """The fewest bucket moves that leave every shard within one bucket of the others."""
+    counts = shard_map.bucket_counts()
+    quota, extra = divmod(BUCKETS, len(counts))
+    # The shards already holding the most keep the leftover buckets
+    order = sorted(range(len(counts)), key=lambda shard: -counts[shard])
+    targets = {shard: quota + (rank < extra) for rank, shard in enumerate(order)}
+    surplus = []
+    for bucket, shard in enumerate(shard_map.buckets):
+        if counts[shard] > targets[shard]:
+            counts[shard] -= 1
+            surplus.append(bucket)
+    moves = []
+    for shard in range(len(counts)):
+        while counts[shard] < targets[shard]:
+            bucket = surplus.pop()
+            moves.append(Move(bucket, shard_map.buckets[bucket], shard))
+            counts[shard] += 1
+    return moves
+
+
+def _connect(path: str, profile: backend.StorageProfile) -> sql.Connection:
+    conn = sql.connect(path, timeout=profile.busy_timeout / 1000.0, isolation_level=None)
+    profile.apply(conn)
+    conn.create_function("shard_bucket", 1, lambda user_id: None if user_id is None else bucket_of(user_id),
+                         deterministic=True)
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS moving (user_id INTEGER PRIMARY KEY)")
+    return conn
+
+
+@contextmanager
+def _transaction(conn: sql.Connection) -> Iterator[None]:
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+
+
+def _select_users(conn: sql.Connection, buckets: Set[int]) -> int:
+    """Fill ``temp.moving`` with every user id in ``buckets`` found in any user table."""
+    conn.execute("DELETE FROM temp.moving")
+    marks = ", ".join("?" * len(buckets))
+    for table, column in USER_TABLES:
+        conn.execute(f"INSERT OR IGNORE INTO temp.moving SELECT DISTINCT {column} FROM main.{table} "
+                     f"WHERE shard_bucket({column}) IN ({marks})", tuple(buckets))
+    return conn.execute("SELECT COUNT(*) FROM temp.moving").fetchone()[0]
+
+
+def _delete_users(conn: sql.Connection):
+    # Deleting grades through their triggers keeps this shard's grade_stats right
+    for table, column in USER_TABLES:
+        conn.execute(f"DELETE FROM main.{table} WHERE {column} IN (SELECT user_id FROM temp.moving)")
+
+
+def move_bucket(database: ShardedDatabase, bucket: int, target: int) -> int:
+    """Move every user in ``bucket`` to shard ``target``; returns the number of users moved.
+
+    In one transaction, whatever ``target`` still holds for the bucket from an
+    earlier, interrupted move is deleted and the source rows are copied over.
+    The copy is a plain INSERT, so an id collision aborts the move rather than
+    dropping a row, and the transaction only commits if every table counts the
+    same rows on both sides. The map is saved next and the source rows are
+    deleted last; a crash before that leaves copies that ``purge_strays``
+    removes.
+    """
+    shard_map = database.map
+    source = shard_map.buckets[bucket]
+    if source == target:
+        return 0
+    conn = _connect(shard_map.paths[source], database.profile)
+    try:
+        conn.execute("ATTACH DATABASE ? AS target", (shard_map.paths[target],))
+        with _transaction(conn):
+            users = _select_users(conn, {bucket})
+            # Include users only the stale copy has, or they would come back once target owns the bucket
+            for table, column in USER_TABLES:
+                conn.execute(f"INSERT OR IGNORE INTO temp.moving SELECT DISTINCT {column} FROM target.{table} "
+                             f"WHERE shard_bucket({column}) = ?", (bucket,))
+            sequences = dict(conn.execute("SELECT name, seq FROM target.sqlite_sequence"))
+            for table, column in USER_TABLES:
+                conn.execute(f"DELETE FROM target.{table} WHERE {column} IN (SELECT user_id FROM temp.moving)")
+            # Every shard runs the same migrations, so the column order matches
+            for table, column in reversed(USER_TABLES):
+                conn.execute(f"INSERT INTO target.{table} SELECT * FROM main.{table} "
+                             f"WHERE {column} IN (SELECT user_id FROM temp.moving)")
+            # The copied ids belong to the source's range; target keeps allocating from its own
+            for name, seq in conn.execute("SELECT name, seq FROM target.sqlite_sequence").fetchall():
+                conn.execute("UPDATE target.sqlite_sequence SET seq = ? WHERE name = ?",
+                             (sequences.get(name, target * ID_RANGE), name))
+            _check_copied(conn)
+        conn.execute("DETACH DATABASE target")
+        shard_map.buckets[bucket] = target
+        shard_map.save()
+        with _transaction(conn):
+            _delete_users(conn)
+    finally:
+        conn.close()
+    backend.log(f"Moved bucket {bucket} ({users} users) from shard {source} to shard {target}")
+    return users
+
+
+def _check_copied(conn: sql.Connection):
+    for table, column in USER_TABLES:
+        counts = [conn.execute(f"SELECT COUNT(*) FROM {schema}.{table} "
+                               f"WHERE {column} IN (SELECT user_id FROM temp.moving)").fetchone()[0]
+                  for schema in ("main", "target")]
+        if counts[0] != counts[1]:
+            raise sql.IntegrityError(f"{table}: {counts[0]} rows on the source but {counts[1]} on the target")
+
+
+def purge_strays(database: ShardedDatabase) -> int:
+    """Delete rows left on a shard that no longer owns their bucket (after an interrupted move)."""
+    shard_map = database.map
+    removed = 0
+    for index, path in enumerate(shard_map.paths):
+        foreign = {bucket for bucket, shard in enumerate(shard_map.buckets) if shard != index}
+        if not foreign:
+            continue
+        conn = _connect(path, database.profile)
+        try:
+            with _transaction(conn):
+                users = _select_users(conn, foreign)
+                if users:
+                    _delete_users(conn)
+                    backend.log(f"Purged {users} stray users from shard {index}")
+                removed += users
+        finally:
+            conn.close()
+    return removed
+
+
+def rebalance(database: ShardedDatabase, on_move: Optional[Callable[[Move, int], None]] = None) -> List[Move]:
+    """Purge strays, then carry out ``plan_rebalance``; ``on_move(move, users)`` reports progress."""
+    purge_strays(database)
+    moves = plan_rebalance(database.map)
+    for move in moves:
+        users = move_bucket(database, move.bucket, move.target)
+        if on_move is not None:
+            on_move(move, users)
+    return moves
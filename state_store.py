@@ -0,0 +1,223 @@
+"""Conversation state stores for the multi-step bot flows.
+
+A session is the small dict the handlers keep per chat (``state`` plus
+``term_name``, ``start_date`` or ``subject_id``). Stores hold it in a compact
+serialized form with a TTL, so abandoned flows expire instead of leaking.
+``MemoryStateStore`` is a bounded in-process LRU; ``SqliteStateStore`` keeps
+sessions in the ``conversation_states`` table so they survive restarts.
+Expired sessions are invisible to readers immediately and are removed by a
+background sweeper in small batches, never on a handler thread.
+"""
+
+import abc
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Known states are stored as small integers; unknown ones fall back to the name
+STATES = ["waiting_subject_name", "waiting_term_name", "waiting_term_start", "waiting_term_end",
+          "waiting_grade_value", "waiting_import_file"]
+_STATE_CODES = {name: code for code, name in enumerate(STATES, 1)}
+# Fields with a fixed slot in the payload, after the state
+_FIELDS = ("subject_id", "start_date", "term_name")
+
+
+def encode_state(session: Dict[str, Any]) -> bytes:
+    """Serialize a session as a compact JSON array: ``[state, subject_id, start_date, term_name, extras]``.
+
+    Dates are stored as ordinals and trailing empty slots are dropped.
+    """
+    state = session.get("state")
+    slots: List[Any] = [_STATE_CODES.get(state, state)]
+    for field in _FIELDS:
+        value = session.get(field)
+        slots.append(value.toordinal() if isinstance(value, date) else value)
+    extras = {key: value for key, value in session.items() if key != "state" and key not in _FIELDS}
+    if extras:
+        slots.append(extras)
+    while len(slots) > 1 and slots[-1] is None:
+        slots.pop()
+    return json.dumps(slots, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def decode_state(payload: bytes) -> Dict[str, Any]:
+    slots = json.loads(payload)
+    state = slots[0]
+    session: Dict[str, Any] = {"state": STATES[state - 1] if isinstance(state, int) else state}
+    for field, value in zip(_FIELDS, slots[1:]):
+        if value is not None:
+            session[field] = date.fromordinal(value) if field == "start_date" else value
+    if len(slots) > len(_FIELDS) + 1:
+        session.update(slots[len(_FIELDS) + 1])
+    return session
+
+
+class StateStore(abc.ABC):
+    """Dict-like per-chat session store with a TTL (seconds since the last write).
+
+    Sessions are returned as fresh dicts: modify the copy and assign it back.
+    """
+
+    def __init__(self, ttl: float = 3600.0):
+        self.ttl = ttl
+        self.expired = 0  # sessions removed by sweeps
+        self._stop = threading.Event()
+        self._sweeper: Optional[threading.Thread] = None
+
+    @abc.abstractmethod
+    def get(self, chat_id: int) -> Optional[Dict[str, Any]]:
+        ...
+
+    @abc.abstractmethod
+    def set(self, chat_id: int, session: Dict[str, Any]):
+        ...
+
+    @abc.abstractmethod
+    def delete(self, chat_id: int):
+        ...
+
+    @abc.abstractmethod
+    def sweep(self, batch: int = 500) -> int:
+        """Remove up to ``batch`` expired sessions; returns how many were removed."""
+
+    @abc.abstractmethod
+    def __len__(self) -> int:
+        ...
+
+    def __contains__(self, chat_id: int) -> bool:
+        return self.get(chat_id) is not None
+
+    def __getitem__(self, chat_id: int) -> Dict[str, Any]:
+        session = self.get(chat_id)
+        if session is None:
+            raise KeyError(chat_id)
+        return session
+
+    def __setitem__(self, chat_id: int, session: Dict[str, Any]):
+        self.set(chat_id, session)
+
+    def __delitem__(self, chat_id: int):
+        self.delete(chat_id)
+
+    def start_sweeper(self, log: Callable[[str], None], interval: float = 60.0, batch: int = 500):
+        """Sweep expired sessions every ``interval`` seconds on a daemon thread; errors go to ``log``."""
+        if self._sweeper is not None:
+            return
+
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    # Small batches keep every lock hold / write transaction short
+                    while self.sweep(batch) == batch and not self._stop.is_set():
+                        pass
+                except Exception as e:
+                    log(f"Error sweeping conversation states: {e!r}")
+
+        self._sweeper = threading.Thread(target=run, name="state-sweeper", daemon=True)
+        self._sweeper.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+class MemoryStateStore(StateStore):
+    """In-process sessions, at most ``max_sessions`` (least recently written are dropped first)."""
+
+    def __init__(self, ttl: float = 3600.0, max_sessions: int = 100000):
+        super().__init__(ttl)
+        self.max_sessions = max_sessions
+        # chat_id -> (expires_at, payload), ordered by last write, hence by expiry
+        self._data: 'OrderedDict[int, Tuple[float, bytes]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, chat_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._data.get(chat_id)
+        if entry is None or entry[0] <= time.time():
+            return None
+        return decode_state(entry[1])
+
+    def set(self, chat_id: int, session: Dict[str, Any]):
+        entry = (time.time() + self.ttl, encode_state(session))
+        with self._lock:
+            self._data[chat_id] = entry
+            self._data.move_to_end(chat_id)
+            while len(self._data) > self.max_sessions:
+                self._data.popitem(last=False)
+
+    def delete(self, chat_id: int):
+        with self._lock:
+            self._data.pop(chat_id, None)
+
+    def sweep(self, batch: int = 500) -> int:
+        now = time.time()
+        removed = 0
+        with self._lock:
+            while removed < batch and self._data:
+                chat_id, (expires_at, _) = next(iter(self._data.items()))
+                if expires_at > now:
+                    break
+                del self._data[chat_id]
+                removed += 1
+        self.expired += removed
+        return removed
+
+    def __len__(self) -> int:
+        """Live sessions; expired ones still waiting for the sweeper are not counted."""
+        now = time.time()
+        with self._lock:
+            # Entries are ordered by expiry, so the expired ones are at the front
+            expired = 0
+            for expires_at, _ in self._data.values():
+                if expires_at > now:
+                    break
+                expired += 1
+            return len(self._data) - expired
+
+
+class SqliteStateStore(StateStore):
+    """Sessions in the ``conversation_states`` table of a ``backend.Database``.
+
+    With a ``sharding.ShardedDatabase`` each chat's session lives on that chat's shard.
+    """
+
+    def __init__(self, database, ttl: float = 3600.0):
+        super().__init__(ttl)
+        self.database = database
+
+    def get(self, chat_id: int) -> Optional[Dict[str, Any]]:
+        row = self.database.shard(chat_id).fetchone(
+            "SELECT payload FROM conversation_states WHERE chat_id = ? AND expires_at > ?", (chat_id, time.time()))
+        return decode_state(row[0]) if row else None
+
+    def set(self, chat_id: int, session: Dict[str, Any]):
+        with self.database.shard(chat_id).transaction() as cursor:
+            cursor.execute(
+                "INSERT INTO conversation_states (chat_id, payload, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (chat_id) DO UPDATE SET payload = excluded.payload, expires_at = excluded.expires_at",
+                (chat_id, encode_state(session), time.time() + self.ttl))
+
+    def delete(self, chat_id: int):
+        with self.database.shard(chat_id).transaction() as cursor:
+            cursor.execute("DELETE FROM conversation_states WHERE chat_id = ?", (chat_id,))
+
+    def sweep(self, batch: int = 500) -> int:
+        removed = sum(self.database.fan_out(lambda shard: self._sweep(shard, batch)))
+        self.expired += removed
+        return removed
+
+    @staticmethod
+    def _sweep(shard, batch: int) -> int:
+        with shard.transaction() as cursor:
+            cursor.execute(
+                "DELETE FROM conversation_states WHERE chat_id IN "
+                "(SELECT chat_id FROM conversation_states WHERE expires_at <= ? LIMIT ?)", (time.time(), batch))
+            return cursor.rowcount
+
+    def __len__(self) -> int:
+        now = time.time()
+        return sum(self.database.fan_out(lambda shard: shard.fetchone(
+            "SELECT COUNT(*) FROM conversation_states WHERE expires_at > ?", (now,))[0]))
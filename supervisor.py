@@ -0,0 +1,285 @@
+"""Multi-process runtime (``--mode workers``): one receiver, N handler processes.
+
+The supervisor process long-polls ``getUpdates`` itself and forwards every
+update, still as JSON, to one of ``MARKS_WORKER_PROCESSES`` worker processes.
+The worker is picked by ``chat id % N``, so one chat always lands on the same
+worker. Each worker builds the bot with ``backend.create_app`` and handles its
+updates one at a time, in order, with the usual handlers against the shared
+database. Per-process state then stays consistent without any coordination:
+the in-memory conversation states, the subject and term caches, and the
+one-export-per-chat guards.
+
+Workers report the update they are handling and the last one they finished
+through two shared counters. The supervisor keeps every forwarded update
+until its worker has finished it, at most ``MARKS_WORKER_QUEUE`` per worker.
+When a worker falls behind, forwarding to it waits for room. Polling then
+pauses and the ``getUpdates`` offset stops advancing, so Telegram holds the
+backlog instead of our memory. A failed poll (a network error, a 5xx or 409
+reply) is logged and retried after a delay that grows up to 30 seconds.
+
+A worker that dies is restarted on a fresh queue, with a growing delay if it
+keeps dying right after start. The updates it had not started are sent to the
+new process. The one it was handling is dropped and logged, so an update that
+crashes its worker cannot crash the replacement too. On SIGINT/SIGTERM the
+supervisor stops polling and confirms the offset with Telegram. It then lets
+every worker finish its queue and stop its background threads, and terminates
+those that overrun ``shutdown_timeout``.
+"""
+
+import collections
+import copy
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import backend
+from dispatcher import chat_id_of_json
+
+POLL_LIMIT = 100
+# A worker that exits sooner than this after starting is restarted with a growing delay
+CRASH_WINDOW = 10.0
+MAX_RESTART_DELAY = 30.0
+MAX_POLL_RETRY_DELAY = 30.0
+
+
+def worker_config(config: backend.Config, index: int, workers: int) -> backend.Config:
+    """``config`` adjusted for worker ``index`` of ``workers``."""
+    worker = copy.copy(config)
+    stem, extension = os.path.splitext(config.logfile)
+    worker.logfile = f"{stem}-worker{index}{extension}"  # LogWriter rotation is not multi-process safe
+    worker.metrics_port = config.metrics_port + 1 + index if config.metrics_port else 0
+    # Telegram's global limit is per bot, not per process
+    worker.outbox_global_rate = config.outbox_global_rate / workers
+    return worker
+
+
+def worker_main(index: int, config: backend.Config, updates: "multiprocessing.Queue",
+                started: "multiprocessing.sharedctypes.Synchronized",
+                finished: "multiprocessing.sharedctypes.Synchronized"):
+    """Worker process body: handle updates from ``updates`` until the ``None`` sentinel."""
+    # Ctrl+C reaches the whole process group; the supervisor decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    from telebot.types import Update
+
+    bot = backend.create_app(config, threaded=False)
+    backend.log(f"Worker {index} started (pid {os.getpid()})")
+    try:
+        while True:
+            update = updates.get()
+            if update is None:
+                break
+            started.value = update["update_id"]
+            try:
+                bot.process_new_updates([Update.de_json(update)])
+            except Exception as e:
+                backend.log(f"Worker {index}: update {update['update_id']} failed: {e!r}")
+            finished.value = update["update_id"]
+    finally:
+        backend.stop_workers()
+        backend.log(f"Worker {index} stopped")
+        backend.log_writer.close()
+
+
+class _Worker(object):
+    __slots__ = ("index", "queue", "process", "started", "finished", "pending", "started_at", "restarts",
+                 "restart_delay", "restart_at", "forwarded", "dropped", "stalls")
+
+    def __init__(self, index: int, context):
+        self.index = index
+        self.queue: Optional[multiprocessing.Queue] = None
+        self.process: Optional[multiprocessing.process.BaseProcess] = None
+        # Update ids the process last took up and last finished; written only by the process
+        self.started = context.Value("q", 0, lock=False)
+        self.finished = context.Value("q", 0, lock=False)
+        self.pending: Deque[Tuple[int, Dict[str, Any]]] = collections.deque()  # forwarded, not yet finished
+        self.started_at = 0.0
+        self.restarts = 0
+        self.restart_delay = 0.0
+        self.restart_at = 0.0
+        self.forwarded = 0
+        self.dropped = 0
+        self.stalls = 0  # times forwarding had to wait for this worker
+
+    def prune(self, update_id: int):
+        while self.pending and self.pending[0][0] <= update_id:
+            self.pending.popleft()
+
+
+class Supervisor(object):
+    """Receives updates and fans them out to ``workers`` handler processes by chat id."""
+
+    def __init__(self, config: backend.Config, workers: int = 0, max_queue: int = 1000,
+                 poll_timeout: int = 20, lag_warning: float = 1.0, shutdown_timeout: float = 30.0):
+        self.config = config
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.max_queue = max(1, max_queue)
+        self.poll_timeout = poll_timeout
+        self.lag_warning = lag_warning  # seconds a forward may wait before the worker counts as lagging
+        self.shutdown_timeout = shutdown_timeout
+        self.offset = 0
+        self._context = multiprocessing.get_context("spawn")
+        self._workers: List[_Worker] = []
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def worker_for(self, chat_id: Optional[int]) -> int:
+        return 0 if chat_id is None else chat_id % self.workers
+
+    def run(self):
+        """Start the workers and poll until ``stop()`` or KeyboardInterrupt, then shut down."""
+        from telebot import apihelper
+
+        # Migrate once here rather than racing N workers to it
+        backend.init_storage(self.config)
+        if self.config.api_url:
+            apihelper.API_URL = backend.api_url_template(self.config.api_url)
+        with self._lock:
+            for index in range(self.workers):
+                self._workers.append(_Worker(index, self._context))
+                self._start(self._workers[index])
+        watcher = threading.Thread(target=self._watch, name="supervisor-watch", daemon=True)
+        watcher.start()
+        backend.log(f"Supervisor polling for {self.workers} workers (pid {os.getpid()})")
+        retry_delay = 0.0
+        try:
+            while not self._stopping.is_set():
+                try:
+                    updates = apihelper.get_updates(self.config.token, self.offset or None, POLL_LIMIT,
+                                                    self.poll_timeout + 5, None, self.poll_timeout)
+                except Exception as e:
+                    # Like bot.polling(none_stop=True): network errors and 5xx/409 replies do not stop the bot
+                    retry_delay = min(max(retry_delay * 2, 1.0), MAX_POLL_RETRY_DELAY)
+                    backend.log(f"Polling failed: {e!r}; retrying in {retry_delay:.0f}s")
+                    self._stopping.wait(retry_delay)
+                    continue
+                retry_delay = 0.0
+                for update in updates:
+                    self._forward(update)
+                    self.offset = update["update_id"] + 1
+        finally:
+            self._stopping.set()
+            watcher.join()
+            self._shutdown(apihelper)
+
+    def stop(self):
+        """Ask ``run()`` to return; it does so once the current long poll ends."""
+        self._stopping.set()
+
+    def _forward(self, update: Dict[str, Any]):
+        worker = self._workers[self.worker_for(chat_id_of_json(update))]
+        lagging_at = None
+        while True:
+            with self._lock:
+                worker.prune(worker.finished.value)
+                if len(worker.pending) < self.max_queue:
+                    worker.pending.append((update["update_id"], update))
+                    worker.queue.put(update)
+                    worker.forwarded += 1
+                    return
+            now = time.monotonic()
+            if lagging_at is None:
+                worker.stalls += 1
+                lagging_at = now + self.lag_warning
+            elif lagging_at <= now:
+                backend.log(f"Worker {worker.index} is lagging ({self.max_queue} updates queued); polling paused")
+                lagging_at = float("inf")
+            time.sleep(0.01)
+
+    def _start(self, worker: _Worker):
+        # Called with self._lock held
+        if worker.queue is not None:
+            # The dead process may have held the old queue's read lock: start over on a new one
+            worker.queue.cancel_join_thread()
+            worker.queue.close()
+            worker.prune(worker.finished.value)
+            if worker.pending and worker.pending[0][0] <= worker.started.value:
+                update_id, _ = worker.pending.popleft()
+                worker.dropped += 1
+                backend.log(f"Worker {worker.index}: dropped update {update_id}, which it was handling")
+        worker.queue = self._context.Queue()
+        for _, update in worker.pending:
+            worker.queue.put(update)
+        config = worker_config(self.config, worker.index, self.workers)
+        worker.process = self._context.Process(
+            target=worker_main, args=(worker.index, config, worker.queue, worker.started, worker.finished),
+            name=f"marks-worker-{worker.index}", daemon=True)
+        worker.process.start()
+        worker.started_at = time.monotonic()
+
+    def _watch(self):
+        while not self._stopping.wait(0.5):
+            now = time.monotonic()
+            with self._lock:
+                if self._stopping.is_set():
+                    return
+                for worker in self._workers:
+                    if worker.process.is_alive():
+                        continue
+                    if not worker.restart_at:
+                        uptime = now - worker.started_at
+                        worker.restart_delay = (min(max(worker.restart_delay * 2, 1.0), MAX_RESTART_DELAY)
+                                                if uptime < CRASH_WINDOW else 0.0)
+                        worker.restart_at = now + worker.restart_delay
+                        backend.log(f"Worker {worker.index} exited with code {worker.process.exitcode} "
+                                    f"after {uptime:.1f}s; restarting in {worker.restart_delay:.0f}s")
+                    if now >= worker.restart_at:
+                        worker.restart_at = 0.0
+                        worker.restarts += 1
+                        self._start(worker)
+
+    def _shutdown(self, apihelper):
+        # Confirm the forwarded updates, or Telegram would deliver them again on the next start
+        if self.offset:
+            try:
+                apihelper.get_updates(self.config.token, self.offset, 1, 5, None, 1)
+            except Exception as e:
+                backend.log(f"Could not confirm update offset {self.offset}: {e!r}")
+        with self._lock:
+            for worker in self._workers:
+                if worker.process.is_alive():
+                    worker.queue.put(None)
+            deadline = time.monotonic() + self.shutdown_timeout
+            for worker in self._workers:
+                worker.process.join(max(0.0, deadline - time.monotonic()))
+                if worker.process.is_alive():
+                    backend.log(f"Worker {worker.index} did not stop in time; terminating it")
+                    worker.process.terminate()
+                    worker.process.join()
+                worker.prune(worker.finished.value)
+                if worker.pending:
+                    backend.log(f"Worker {worker.index} stopped with {len(worker.pending)} updates unhandled")
+        backend.log(f"Supervisor stopped at update offset {self.offset}")
+
+    def metrics(self) -> List[Dict[str, Any]]:
+        """Per-worker pid, liveness, pending updates, forwarded, dropped, restarts and stalls."""
+        result = []
+        with self._lock:
+            for worker in self._workers:
+                worker.prune(worker.finished.value)
+                result.append({
+                    "worker": worker.index,
+                    "pid": worker.process.pid,
+                    "alive": worker.process.is_alive(),
+                    "depth": len(worker.pending),
+                    "forwarded": worker.forwarded,
+                    "dropped": worker.dropped,
+                    "restarts": worker.restarts,
+                    "stalls": worker.stalls,
+                })
+        return result
+
+
+def run(config: backend.Config):
+    """Run a Supervisor configured by ``MARKS_WORKER_PROCESSES`` and ``MARKS_WORKER_QUEUE``."""
+    supervisor = Supervisor(config, config.worker_processes, config.worker_queue)
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
+
+    # Treat SIGTERM like Ctrl+C: interrupt the long poll and shut down through run()'s finally
+    signal.signal(signal.SIGTERM, terminate)
+    supervisor.run()
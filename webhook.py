@@ -0,0 +1,199 @@
+"""Webhook serving mode: a small built-in HTTP server feeding updates to the bot.
+
+Telegram POSTs each update as JSON to ``Config.webhook_path``. Requests are
+parsed into ``telebot.types.Update`` and handed to ``bot.process_new_updates``,
+i.e. the same pipeline polling uses (including the per-chat dispatcher when
+``MARKS_DISPATCH_SHARDS`` is set). Connections are persistent (HTTP/1.1), so
+a client may pipeline several updates on one socket; they are answered in
+order. At most ``max_in_flight`` requests are processed at once, further ones
+get ``503`` and are retried by Telegram. A request holds its slot until
+``process_new_updates`` returns, so the bound covers handler work only for a
+non-threaded bot, which is what ``Marks.py --mode webhook`` starts. With the
+dispatcher the slot covers queuing the update, and ``MARKS_DISPATCH_QUEUE``
+is what bounds the work.
+
+Recorded updates (one JSON object per line) can be replayed against a running
+server for end-to-end testing::
+
+    python webhook.py replay updates.jsonl --url http://127.0.0.1:8443/webhook
+"""
+
+import argparse
+import json
+import socket
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import backend
+
+MAX_BODY = 1024 * 1024  # Telegram updates are far smaller
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, bot, host: str, port: int, path: str = "/webhook", secret: Optional[str] = None,
+                 max_in_flight: int = 64):
+        from telebot.types import Update
+
+        self.bot = bot
+        self.path = path
+        self.secret = secret
+        self.update_type = Update
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.received = 0
+        self.rejected = 0
+        super().__init__((host, port), WebhookHandler)
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, so clients can pipeline
+    server: WebhookServer
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length", ""))
+        except ValueError:
+            length = -1
+        if length < 0:
+            # Without a usable length the body cannot be skipped, so the connection cannot be reused
+            self._close(400)
+            return
+        if self.path != self.server.path:
+            self._close(404)
+            return
+        if self.server.secret and self.headers.get(SECRET_HEADER) != self.server.secret:
+            self._close(403)
+            return
+        if length > MAX_BODY:
+            self._close(413)
+            return
+        if not self.server.in_flight.acquire(blocking=False):
+            self.server.rejected += 1
+            self._reply(503, length)
+            return
+        try:
+            body = self.rfile.read(length)
+            try:
+                update = self.server.update_type.de_json(body.decode("utf-8"))
+            except (ValueError, KeyError, TypeError) as e:
+                backend.log(f"Webhook: malformed update: {e!r}")
+                self._reply(400)
+                return
+            self.server.received += 1
+            try:
+                self.server.bot.process_new_updates([update])
+            except Exception as e:
+                # Answer 200 anyway: a redelivered update would fail the same way
+                backend.log(f"Webhook: handler failed: {e!r}")
+            self._reply(200)
+        finally:
+            self.server.in_flight.release()
+
+    def _reply(self, status: int, unread: int = 0):
+        if unread:
+            self.rfile.read(unread)  # keep the connection usable for the next pipelined request
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _close(self, status: int):
+        """Answer without reading the body, then drop the connection rather than drain it."""
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass  # one line per update would swamp logs.txt
+
+
+def serve(bot, config: backend.Config) -> WebhookServer:
+    """Start the webhook server in a background thread and register the URL with Telegram if set."""
+    server = WebhookServer(bot, config.webhook_host, config.webhook_port, config.webhook_path,
+                           config.webhook_secret, config.webhook_max_in_flight)
+    threading.Thread(target=server.serve_forever, name="webhook", daemon=True).start()
+    if config.webhook_url:
+        bot.set_webhook(url=config.webhook_url, secret_token=config.webhook_secret,
+                        max_connections=config.webhook_max_in_flight)
+    backend.log(f"Webhook listening on {config.webhook_host}:{config.webhook_port}{config.webhook_path}")
+    return server
+
+
+# REPLAY CLIENT BEGIN
+def _read_response(rfile) -> int:
+    status_line = rfile.readline()
+    if not status_line:
+        raise ConnectionError("server closed the connection")
+    status = int(status_line.split()[1])
+    length = 0
+    while True:
+        line = rfile.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value.strip())
+    if length:
+        rfile.read(length)
+    return status
+
+
+def post_updates(url: str, updates: List[dict], secret: Optional[str] = None,
+                 pipeline: int = 16) -> Tuple[List[int], float]:
+    """POST updates over one keep-alive connection, ``pipeline`` requests at a time.
+
+    Returns the status of every request and the elapsed wall time in seconds.
+    """
+    parts = urlsplit(url)
+    sock = socket.create_connection((parts.hostname, parts.port or 80))
+    rfile = sock.makefile("rb")
+    statuses: List[int] = []
+    start = time.perf_counter()
+    try:
+        for i in range(0, len(updates), max(1, pipeline)):
+            batch = updates[i:i + max(1, pipeline)]
+            payload = b""
+            for update in batch:
+                body = json.dumps(update).encode("utf-8")
+                headers = [f"POST {parts.path or '/'} HTTP/1.1", f"Host: {parts.netloc}",
+                           "Content-Type: application/json", f"Content-Length: {len(body)}"]
+                if secret:
+                    headers.append(f"{SECRET_HEADER}: {secret}")
+                payload += ("\r\n".join(headers) + "\r\n\r\n").encode("latin-1") + body
+            sock.sendall(payload)
+            statuses.extend(_read_response(rfile) for _ in batch)
+    finally:
+        rfile.close()
+        sock.close()
+    return statuses, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded updates against a webhook server")
+    commands = parser.add_subparsers(dest="command", required=True)
+    replay = commands.add_parser("replay", help="POST updates from a JSON-lines file")
+    replay.add_argument("file", help="one Telegram update JSON object per line")
+    replay.add_argument("--url", default="http://127.0.0.1:8443/webhook")
+    replay.add_argument("--secret", default=None)
+    replay.add_argument("--pipeline", type=int, default=16, help="requests in flight per connection")
+    args = parser.parse_args()
+
+    with open(args.file, encoding="utf-8") as f:
+        updates = [json.loads(line) for line in f if line.strip()]
+    statuses, elapsed = post_updates(args.url, updates, args.secret, args.pipeline)
+    ok = statuses.count(200)
+    print(f"{len(updates)} updates in {elapsed:.2f}s ({len(updates) / elapsed if elapsed else 0:.0f}/s), "
+          f"{ok} accepted, {len(statuses) - ok} rejected")
+    sys.exit(0 if ok == len(statuses) else 1)
+# REPLAY CLIENT END
+
+
+if __name__ == "__main__":
+    main()